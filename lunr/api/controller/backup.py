@@ -46,7 +46,8 @@ class BackupController(BaseController):
         """
         PUT /v1.0/{account_id}/backups/{id}?volume={volume_id}
 
-        Create backup
+        Create backup, the first backup of a volume may specify the
+        block_size its backups are stored with.
         """
         # extract volume reference
         try:
@@ -103,7 +104,11 @@ class BackupController(BaseController):
             params = {
                 'account': self.account_id,
                 'timestamp': int(mktime(backup.created_at.timetuple())),
+                'volume_type': backup.volume.volume_type_name,
             }
+            # only used if this is the first backup of the volume
+            if 'block_size' in request.params:
+                params['block_size'] = request.params['block_size']
             info = self.node_request(backup.volume.node, 'PUT', path, **params)
         except NodeError:
             # Remove the backup record if the node failed to create the backup
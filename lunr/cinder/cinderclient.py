@@ -21,13 +21,15 @@ from lunr.common.exc import HTTPClientError
 from lunr.common import logger
 
 RETRIES = 5
+# Seconds a request to cinder may block on its socket
+TIMEOUT = 240
 
 
 class CinderError(HTTPClientError):
     pass
 
 
-def request(method, path, headers=None, data=None):
+def request(method, path, headers=None, data=None, timeout=TIMEOUT):
     """
     How many times must I write this function before I just add requests
     to our pip requires?
@@ -35,7 +37,7 @@ def request(method, path, headers=None, data=None):
     req = urllib2.Request(path, headers=headers, data=data)
     req.get_method = lambda *args: method
     try:
-        resp = urllib2.urlopen(req)
+        resp = urllib2.urlopen(req, timeout=timeout)
         data = resp.read()
     except HTTPClientError.exceptions, e:
         raise CinderError(req, e)
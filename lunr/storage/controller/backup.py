@@ -60,6 +60,18 @@ class BackupController(BaseController):
         if '.' in self.id:
             raise HTTPPreconditionFailed("backup id cannot contain '.'")
 
+        try:
+            block_size = self.helper.backups.block_size(
+                volume_type=req.params.get('volume_type'),
+                block_size=req.params.get('block_size'))
+            codec = self.helper.backups.codec(
+                volume_type=req.params.get('volume_type'))
+            domain = self.helper.backups.domain(
+                account=req.params.get('account'),
+                volume_type=req.params.get('volume_type'))
+        except ValueError, e:
+            raise HTTPBadRequest(str(e))
+
         try:
             snapshot = self.helper.volumes.create_snapshot(self.volume_id,
                                                            self.id, timestamp)
@@ -90,7 +102,9 @@ class BackupController(BaseController):
 
         self.helper.backups.create(snapshot, self.id, callback=callback,
                                    error_callback=error_callback,
-                                   lock=lock, cinder=cinder)
+                                   lock=lock, cinder=cinder,
+                                   block_size=block_size, codec=codec,
+                                   domain=domain)
 
         snapshot['status'] = 'SAVING'
         return Response(snapshot)
@@ -27,6 +27,7 @@ class StatusController(BaseController):
             'volumes': self.helper.volumes.status(),
             'exports': self.helper.exports.status(),
             'backups': self.helper.backups.status(),
+            'budget': self.helper.budget.status(),
         }
         return Response(status)
 
@@ -110,6 +110,10 @@ def snapshots(helper):
                     "reports status is '%s'" % volume['status'])
             continue
 
+        # Snapshot could be tracking changes for the next backup
+        if 'tracking' in snapshot:
+            continue
+
         # Snapshot could be for a clone
         if 'clone_id' in snapshot:
             # Match them up with a current clone
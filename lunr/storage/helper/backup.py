@@ -22,11 +22,16 @@ from setproctitle import setproctitle
 from time import time
 
 from lunr.common import logger, exc
-from lunr.common.lock import ResourceFile
+from lunr.common.lock import ResourceFile, JsonLockFile
 
 from lunr.storage.helper.utils import get_conn, NotFound, ServiceUnavailable
-from lunr.storage.helper.utils.manifest import Manifest, read_local_manifest, \
-    ManifestEmptyError
+from lunr.storage.helper.utils.manifest import Manifest, cached_manifest, \
+    ManifestEmptyError, validate_block_size
+from lunr.storage.helper.utils.blockhash import DEFAULT_ALGORITHM, \
+    validate_algorithm
+from lunr.storage.helper.utils.compression import LZ4, validate_codec
+from lunr.storage.helper.utils.domain import DedupDomain, domain_container, \
+    PREFIX as DOMAIN_PREFIX
 from lunr.storage.helper.utils.jobs import spawn
 from lunr.storage.helper.utils.worker import BLOCK_SIZE, Worker
 
@@ -36,6 +41,12 @@ class BackupHelper(object):
     def __init__(self, conf):
         self.run_dir = conf.string('storage', 'run_dir', conf.path('run'))
         self.skip_fork = conf.bool('storage', 'skip_fork', False)
+        self.default_block_size = conf.int('backup', 'block_size', BLOCK_SIZE)
+        # only new volumes start out with the configured algorithm
+        self.hash_algorithm = validate_algorithm(
+            conf.string('backup', 'hash_algorithm', DEFAULT_ALGORITHM))
+        self.default_codec = conf.string('backup', 'codec', LZ4)
+        self.dedup_domain = conf.string('backup', 'dedup_domain', '')
         self.conf = conf
 
     def _resource_file(self, id):
@@ -44,6 +55,23 @@ class BackupHelper(object):
     def _stats_file(self, id):
         return join(self.run_dir, 'volumes/%s/stats' % id)
 
+    def _changes_file(self, id):
+        return join(self.run_dir, 'volumes/%s/changes' % id)
+
+    def _read_changes(self, volume_id):
+        """
+        Changes recorded from the tracking snapshot when the backup
+        snapshot was created, None if there are none.
+        """
+        changes_file = self._changes_file(volume_id)
+        if not exists(changes_file):
+            return None
+        lock = JsonLockFile(changes_file)
+        with lock:
+            changes = lock.read()
+        lock.close()
+        return changes or None
+
     def _in_use(self, volume_id):
         resource_file = self._resource_file(volume_id)
         if not exists(resource_file):
@@ -71,7 +99,8 @@ class BackupHelper(object):
 
     def list(self, volume):
         """
-        Find all manifest in local cache, and running backups
+        Find all backups in the manifest, checking the local cache is still
+        current, and running backups
         """
         results = {}
 
@@ -82,7 +111,8 @@ class BackupHelper(object):
 
         try:
             manifest_file = Worker.build_lock_path(self.run_dir, volume['id'])
-            manifest = read_local_manifest(manifest_file)
+            manifest = cached_manifest(get_conn(self.conf), volume['id'],
+                                       manifest_file)
         except ManifestEmptyError:
             return results
 
@@ -108,11 +138,44 @@ class BackupHelper(object):
                 'status': 'RUNNING',
                 'stats': stats}
 
-    def save(self, snapshot, backup_id, cinder):
+    def block_size(self, volume_type=None, block_size=None):
+        """
+        Block size for the first backup of a volume, a block size requested
+        for the volume wins over one configured for its volume type.
+        Raises ValueError if the block size is not usable.
+        """
+        if block_size is None:
+            block_size = self.default_block_size
+            if volume_type:
+                block_size = self.conf.int('backup_block_size', volume_type,
+                                           block_size)
+        return validate_block_size(block_size)
+
+    def codec(self, volume_type=None):
+        """
+        Codec new blocks of a volume are compressed with, configured by
+        volume type.  Raises ValueError if the codec is unknown.
+        """
+        codec = self.default_codec
+        if volume_type:
+            codec = self.conf.string('backup_codec', volume_type, codec)
+        return validate_codec(codec)
+
+    def domain(self, account=None, volume_type=None):
+        """
+        Container of the deduplication domain the first backup of a volume
+        joins, None unless dedup_domain is configured.
+        """
+        return domain_container(self.dedup_domain, account=account,
+                                volume_type=volume_type)
+
+    def save(self, snapshot, backup_id, cinder, block_size=BLOCK_SIZE,
+             codec=LZ4, domain=None):
         job_stats_path = self._stats_file(snapshot['origin'])
         logger.rename('lunr.storage.helper.backup.save')
         setproctitle("lunr-save: " + backup_id)
         size = snapshot['size'] / 1024 / 1024 / 1024
+        changes = self._read_changes(snapshot['origin'])
 
         try:
             op_start = time()
@@ -126,29 +189,41 @@ class BackupHelper(object):
             conn.put_container(snapshot['origin'])
             logger.warning("failed to retrieve manifest;"
                            " first time backup for this volume?")
-            # TODO: write the block_size on the manifest at create?
-            block_count, remainder = divmod(snapshot['size'], BLOCK_SIZE)
+            if domain:
+                domain = DedupDomain(conn, domain)
+                # blocks are only shared with volumes of the same block size
+                block_size = domain.block_size or block_size
+            block_count, remainder = divmod(snapshot['size'], block_size)
             if remainder:
                 block_count += 1
             # initial backup is the only time the we need to worry about
-            # creating a new manifest for the worker
+            # creating a new manifest for the worker, after this the block
+            # size is whatever the manifest says
+            manifest = Manifest.blank(block_count, block_size,
+                                      self.hash_algorithm)
+            if domain:
+                domain.adopt(manifest, snapshot['origin'])
             worker = Worker(snapshot['origin'], conf=self.conf,
-                            manifest=Manifest.blank(block_count),
-                            stats_path=job_stats_path)
+                            manifest=manifest, stats_path=job_stats_path)
         try:
             worker.save(snapshot['path'], backup_id,
-                        timestamp=snapshot['timestamp'], cinder=cinder)
+                        timestamp=snapshot['timestamp'], cinder=cinder,
+                        changes=changes, codec=codec)
         finally:
             os.unlink(job_stats_path)
+            if changes:
+                os.unlink(self._changes_file(snapshot['origin']))
         duration = time() - op_start
         logger.info('STAT: worker save for backup_id %r on %r. '
                     'Size: %r GB Time: %r s Speed: %r MB/s' %
                     (backup_id, snapshot['path'], size,
                      duration, size * 1024 / duration))
 
-    def create(self, snapshot, backup_id,
-               callback=None, lock=None, cinder=None, error_callback=None):
-        spawn(lock, self.save, snapshot, backup_id, cinder,
+    def create(self, snapshot, backup_id, callback=None, lock=None,
+               cinder=None, error_callback=None, block_size=BLOCK_SIZE,
+               codec=LZ4, domain=None):
+        spawn(lock, self.save, snapshot, backup_id, cinder, block_size, codec,
+              domain,
               callback=callback, error_callback=error_callback,
               skip_fork=self.skip_fork)
 
@@ -195,9 +270,21 @@ class BackupHelper(object):
     def audit(self, volume):
         logger.rename('lunr.storage.helper.backup.audit')
         setproctitle("lunr-audit: " + volume['id'])
+        job_stats_path = self._stats_file(volume['id'])
+        try:
+            self._audit(volume, job_stats_path)
+        finally:
+            try:
+                os.unlink(job_stats_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _audit(self, volume, job_stats_path):
         try:
             op_start = time()
-            worker = Worker(volume['id'], self.conf)
+            worker = Worker(volume['id'], self.conf,
+                            stats_path=job_stats_path)
         except exc.ClientException, e:
             if e.http_status != 404:
                 raise
@@ -207,13 +294,32 @@ class BackupHelper(object):
             logger.warning("failed to retrieve manifest;"
                            " auditing volume with no backups")
             # creating a blank manifest for the worker
-            worker = Worker(volume['id'], conf=self.conf,
-                            manifest=Manifest.blank(0))
-        worker.audit()
+            manifest = Manifest.blank(0)
+            domain = self._read_domain(conn, volume['id'])
+            if domain:
+                # the blocks it left behind are in the domain's container
+                manifest['domain'] = domain
+            worker = Worker(volume['id'], conf=self.conf, manifest=manifest,
+                            stats_path=job_stats_path)
+            # keep pointing at the domain until it has been audited, the
+            # container is about to go so every block must
+            if worker.audit(sweep=True) and domain:
+                conn.delete_object(volume['id'], DOMAIN_PREFIX)
+        else:
+            worker.audit()
         duration = time() - op_start
         logger.info('STAT: auditing %r. Time: %r s ' % (volume['id'],
                                                         duration))
 
+    def _read_domain(self, conn, volume_id):
+        try:
+            _headers, domain = conn.get_object(volume_id, DOMAIN_PREFIX)
+        except exc.ClientException, e:
+            if e.http_status != 404:
+                raise
+            return None
+        return domain
+
     def run_audit(self, volume, lock=None, callback=None):
         spawn(lock, self.audit, volume, callback=callback,
               skip_fork=self.skip_fork, interruptible=True)
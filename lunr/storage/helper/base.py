@@ -26,6 +26,7 @@ from lunr.storage.helper.volume import VolumeHelper
 from lunr.storage.helper.export import ExportHelper
 from lunr.storage.helper.backup import BackupHelper
 from lunr.storage.helper.cgroup import CgroupHelper
+from lunr.storage.helper.utils.budget import Budget
 from lunr.storage.helper.utils import make_api_request, node_request, \
     ServiceUnavailable, APIError
 
@@ -90,6 +91,7 @@ class Helper(object):
         self.exports = ExportHelper(conf)
         self.backups = BackupHelper(conf)
         self.cgroups = CgroupHelper(conf)
+        self.budget = Budget(conf)
         self.api_server = conf.string('storage', 'api_server',
                                       "http://localhost:8080")
         self.api_retry = conf.int('storage', 'api_retry', 1)
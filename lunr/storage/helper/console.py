@@ -275,10 +275,12 @@ class BackupConsole(Console, Displayable):
     @opt('-f', '--force', action='store_true',
          help='automatically confirm all prompts')
     @opt('-t', '--timestamp', help='timestamp')
+    @opt('-b', '--block-size', type=int,
+         help='block size, if this is the first backup of the volume')
     @opt('--src', help="source volume id the backup is for")
     @opt('backup_id', help="id of the backup")
     def save(self, backup_id=None, src=None, timestamp=None,
-             force=None, scrub=None):
+             force=None, scrub=None, block_size=None):
         """
         Create a new backup for a given volume or snapshot
 
@@ -298,6 +300,11 @@ class BackupConsole(Console, Displayable):
         """
         helper = self.load_conf(self.config)
         helper.volumes.skip_fork = True
+        try:
+            block_size = helper.backups.block_size(block_size=block_size)
+        except ValueError, e:
+            print str(e)
+            return 1
 
         volume = helper.volumes.get(src or backup_id)
         if not src and not volume['origin']:
@@ -318,7 +325,7 @@ class BackupConsole(Console, Displayable):
             backup_id = volume['backup_id']
 
         # Start the backup job
-        helper.backups.save(volume, backup_id)
+        helper.backups.save(volume, backup_id, None, block_size)
         if scrub:
             helper.volumes.delete(volume)
         elif confirm('Remove snapshot', force=force):
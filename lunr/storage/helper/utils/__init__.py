@@ -28,6 +28,9 @@ from lunr.common import logger
 from lunr.common.exc import HTTPClientError, NodeError
 from lunr.storage.helper.utils.client import get_conn
 
+# Seconds a request to the api may block on its socket
+API_TIMEOUT = 240
+
 
 class StorageError(Exception):
     """
@@ -171,7 +174,7 @@ def make_api_request(resource, id=None, data=None, method=None,
     if method:
         request.get_method = lambda *args, **kwargs: method.upper()
     try:
-        return urlopen(request)
+        return urlopen(request, timeout=API_TIMEOUT)
     except (HTTPError, URLError), e:
         raise APIError(request, e)
 
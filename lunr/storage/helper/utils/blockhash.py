@@ -0,0 +1,73 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Salted block hashes, which are also the names of the block objects.
+
+md5 is what every manifest used before the algorithm was recorded, and is
+still the default.  blake2b is several times faster and keyed with the salt
+instead of having it appended, but it needs the optional pyblake2 on python
+2, so it's only used once configured.  Every node that may back up or
+restore the volume needs pyblake2 then.  Both produce 32 hex characters.
+"""
+
+import hashlib
+
+try:
+    from pyblake2 import blake2b
+except ImportError:
+    blake2b = None
+
+MD5 = 'md5'
+BLAKE2B = 'blake2b'
+ALGORITHMS = (MD5, BLAKE2B)
+# What new volumes are hashed with unless backup.hash_algorithm says otherwise
+DEFAULT_ALGORITHM = MD5
+# Keep object names the same length as the md5 ones
+DIGEST_SIZE = 16
+
+
+class HashAlgorithmError(ValueError):
+    pass
+
+
+def available(algorithm):
+    if algorithm == BLAKE2B:
+        return blake2b is not None
+    return algorithm in ALGORITHMS
+
+
+def validate_algorithm(algorithm):
+    if algorithm not in ALGORITHMS:
+        raise HashAlgorithmError('Unknown hash algorithm %s, must be one '
+                                 'of %s' % (algorithm, ', '.join(ALGORITHMS)))
+    if not available(algorithm):
+        raise HashAlgorithmError('Hash algorithm %s is not available, is '
+                                 'pyblake2 installed?' % algorithm)
+    return algorithm
+
+
+def block_hash(data, salt, algorithm=MD5):
+    """
+    Hex digest of data salted with salt, data may be a buffer.
+    """
+    validate_algorithm(algorithm)
+    if algorithm == BLAKE2B:
+        return blake2b(data, digest_size=DIGEST_SIZE,
+                       key=str(salt)).hexdigest()
+    hasher = hashlib.md5()
+    hasher.update(data)
+    hasher.update(salt)
+    return hasher.hexdigest()
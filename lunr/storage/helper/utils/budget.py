@@ -0,0 +1,202 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Node wide bandwidth and IOPS budget shared by every bulk job.
+
+Backups, restores, clones, image copies and scrubs all run in processes of
+their own, so the token buckets live in a small file in the run dir which
+every process maps and locks with flock, along with a lock for the threads
+of the process since flock doesn't exclude them.  There is a bucket for the
+node and one for each job type for every meter, a job type's bucket
+refills at its weight times the node's rate.  Every resource has a meter
+in bytes, reads and writes have another in operations.
+
+A job takes tokens for the bytes it has just moved, and for the reads or
+writes that moved them, going into debt if there aren't enough, then
+sleeps until the debt would be paid off.  Jobs queue up behind each other's
+debt, so the node never runs over its rate by more than the burst.  An
+operation is one call to take, a block or chunk read or written by the job,
+however many requests the kernel turns it into.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from time import sleep, time
+
+READ = 'read'
+WRITE = 'write'
+NETWORK = 'network'
+RESOURCES = (READ, WRITE, NETWORK)
+READ_IOPS = 'read_iops'
+WRITE_IOPS = 'write_iops'
+# the operations meter of each resource that has one
+IOPS = {READ: READ_IOPS, WRITE: WRITE_IOPS}
+_METERS = RESOURCES + (READ_IOPS, WRITE_IOPS)
+
+BACKUP = 'backup'
+RESTORE = 'restore'
+CLONE = 'clone'
+IMAGE = 'image'
+SCRUB = 'scrub'
+JOBS = (BACKUP, RESTORE, CLONE, IMAGE, SCRUB)
+
+NODE = 'node'
+_BUCKETS = (NODE,) + JOBS
+
+# tokens, last refill, bytes or operations taken, seconds waited
+RECORD = struct.Struct('<ddQd')
+SIZE = RECORD.size * len(_BUCKETS) * len(_METERS)
+
+# Seconds of the rate a bucket holds when full
+BURST = 1.0
+
+
+class Budget(object):
+
+    def __init__(self, conf):
+        run_dir = conf.string('storage', 'run_dir', conf.path('run'))
+        self.path = os.path.join(run_dir, 'budget')
+        # MB/s, 0 is unlimited
+        self.rates = dict(
+            (resource, conf.float('budget', '%s_mbps' % resource, 0) *
+             1024 ** 2) for resource in RESOURCES)
+        # operations/s, 0 is unlimited
+        self.rates.update(
+            (meter, conf.float('budget', meter, 0))
+            for meter in IOPS.values())
+        self.burst = conf.float('budget', 'burst', BURST)
+        self.weights = dict((job, conf.float('budget_weight', job, 1.0))
+                            for job in JOBS)
+        self._pid = None
+        self._fd = None
+        self._map = None
+        # restore threads share a budget, and our fd
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(self.rates.values())
+
+    def _open(self):
+        # flock doesn't exclude processes sharing an open file, so every
+        # process opens its own
+        if self._pid == os.getpid():
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        if os.fstat(fd).st_size < SIZE:
+            os.ftruncate(fd, SIZE)
+        self._fd = fd
+        self._map = mmap.mmap(fd, SIZE)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, bucket, meter):
+        return RECORD.size * (_BUCKETS.index(bucket) * len(_METERS) +
+                              _METERS.index(meter))
+
+    def _read(self, bucket, meter):
+        return list(RECORD.unpack_from(self._map,
+                                       self._offset(bucket, meter)))
+
+    def _write(self, bucket, meter, record):
+        RECORD.pack_into(self._map, self._offset(bucket, meter), *record)
+
+    def _rate(self, bucket, meter):
+        rate = self.rates[meter]
+        if bucket != NODE:
+            rate *= self.weights[bucket]
+        return rate
+
+    def _refill(self, record, rate, now):
+        tokens, updated = record[0], record[1]
+        record[0] = min(rate * self.burst, tokens + (now - updated) * rate)
+        record[1] = now
+
+    def take(self, job, resource, nbytes, ops=1):
+        """
+        Take tokens for nbytes the job just moved in ops reads or writes,
+        sleeping if the node or the job type is over budget.  Returns the
+        seconds slept.
+        """
+        charges = [(meter, amount) for meter, amount in
+                   ((resource, nbytes), (IOPS.get(resource), ops))
+                   if self.rates.get(meter)]
+        if not charges:
+            return 0
+        now = time()
+        wait = 0
+        with self._locked():
+            for meter, amount in charges:
+                for bucket in (NODE, job):
+                    rate = self._rate(bucket, meter)
+                    record = self._read(bucket, meter)
+                    if rate > 0:
+                        self._refill(record, rate, now)
+                        record[0] -= amount
+                        wait = max(wait, -record[0] / rate)
+                    record[2] += amount
+                    self._write(bucket, meter, record)
+            for meter, amount in charges:
+                record = self._read(job, meter)
+                record[3] += wait
+                self._write(job, meter, record)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def status(self):
+        status = {}
+        if not self.enabled:
+            return status
+        now = time()
+        with self._locked():
+            for meter in _METERS:
+                if not self.rates[meter]:
+                    continue
+                taken = 'ops' if meter in IOPS.values() else 'bytes'
+                info = {}
+                for bucket in _BUCKETS:
+                    rate = self._rate(bucket, meter)
+                    record = self._read(bucket, meter)
+                    if rate > 0:
+                        self._refill(record, rate, now)
+                    info[bucket] = {
+                        'rate': rate,
+                        'tokens': record[0],
+                        taken: record[2],
+                        'waited': record[3],
+                    }
+                status[meter] = info
+        return status
@@ -0,0 +1,154 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checkpoints of a save in progress.
+
+A save reads blocks in order but its uploads finish in any order.  The
+watermark is the last block which, along with every block read before it,
+is either unchanged or safely stored.  Every so often the save writes down
+the watermark, the hashes of the blocks up to it which differ from the
+last backup, the hashes uploaded past it and the deltas among them.
+
+The checkpoint only outlives a save that was killed, a save that fails
+cleans up along with its snapshot.  When the save is retried against the
+same snapshot it carries on from the watermark instead of reading the
+whole volume again.
+"""
+
+import errno
+import os
+from collections import deque
+from time import time
+
+from lunr.common.lock import JsonLockFile
+
+# Seconds between checkpoints, 0 disables them
+INTERVAL = 60
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return {}
+    lock = JsonLockFile(path)
+    try:
+        with lock:
+            return lock.read()
+    finally:
+        lock.close()
+
+
+class SaveCheckpoint(object):
+
+    def __init__(self, path, key, interval=INTERVAL):
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.watermark = -1
+        # blockno -> hash, for blocks up to the watermark
+        self.changed = {}
+        # hashes of blocks stored past the watermark
+        self.uploaded = set()
+        self.deltas = {}
+        # (blockno, hash, changed) read but not yet under the watermark
+        self._read = deque()
+        # blockno -> hash, queued for upload
+        self._pending = {}
+        self._written = time()
+
+    @classmethod
+    def load(cls, path, key, interval=INTERVAL):
+        """
+        The checkpoint left at path by a save of the same key, None if there
+        isn't one.
+        """
+        data = _read(path)
+        if not data or data.get('key') != key:
+            return None
+        checkpoint = cls(path, key, interval=interval)
+        checkpoint.watermark = data['watermark']
+        checkpoint.changed = dict((int(blockno), hash_) for blockno, hash_
+                                  in data['changed'].items())
+        checkpoint.uploaded = set(data['uploaded'])
+        checkpoint.deltas = data['deltas']
+        return checkpoint
+
+    @staticmethod
+    def referenced(path):
+        """
+        Every block hash a checkpoint at path depends on.
+        """
+        data = _read(path)
+        if not data:
+            return set()
+        return set(data['changed'].values()) | set(data['uploaded'])
+
+    def read(self, blockno, hash_, changed, upload):
+        """
+        Record a block read by the save, changed if it differs from the last
+        backup and upload if it was queued for upload.
+        """
+        self._read.append((blockno, hash_, changed))
+        if upload:
+            self._pending[blockno] = hash_
+        self._advance()
+
+    def stored(self, blockno):
+        """
+        Record the upload of a block finishing.
+        """
+        hash_ = self._pending.pop(blockno, None)
+        if hash_ is not None:
+            self.uploaded.add(hash_)
+        self._advance()
+
+    def _advance(self):
+        while self._read and self._read[0][0] not in self._pending:
+            blockno, hash_, changed = self._read.popleft()
+            if changed:
+                self.changed[blockno] = hash_
+                self.uploaded.discard(hash_)
+            self.watermark = blockno
+
+    def due(self):
+        return self.interval and time() - self._written >= self.interval
+
+    def write(self, deltas):
+        """
+        Write the checkpoint, along with any of deltas for our blocks.
+        """
+        hashes = set(self.changed.values()) | self.uploaded
+        data = {
+            'key': self.key,
+            'watermark': self.watermark,
+            'changed': self.changed,
+            'uploaded': list(self.uploaded),
+            'deltas': dict((hash_, parent) for hash_, parent
+                           in deltas.items() if hash_ in hashes),
+        }
+        lock = JsonLockFile(self.path)
+        try:
+            with lock:
+                lock.write(data)
+        finally:
+            lock.close()
+        self._written = time()
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -15,6 +15,7 @@
 
 
 import errno
+from hashlib import md5
 import os
 
 from lunr.common import exc
@@ -84,8 +85,10 @@ class Connection(object):
             while chunk:
                 writer.send(chunk)
                 chunk = body.read(DEFAULT_CHUNK_READ_SIZE)
-        else:
+        elif body:
+            # an empty chunk would end the writer
             writer.send(body)
+        writer.close()
 
     def put_container(self, container, *args, **kwargs):
         try:
@@ -101,7 +104,8 @@ class Connection(object):
             if e.errno != errno.ENOENT:
                 raise self.ClientException(str(e), 409)
 
-    def get_object(self, container, name, resp_chunk_size=None, **kwargs):
+    def get_object(self, container, name, resp_chunk_size=None,
+                   headers=None, **kwargs):
         obj = self.path(container, name)
         try:
             f = open(obj, 'r')
@@ -110,6 +114,16 @@ class Connection(object):
                 raise self.ClientException('object not found %s' %
                                            obj_name(container, name))
             raise
+        if headers and 'If-None-Match' in headers:
+            try:
+                contents = f.read()
+            finally:
+                f.close()
+            etag = md5(contents).hexdigest()
+            if etag == headers['If-None-Match']:
+                raise self.ClientException('not modified %s' %
+                                           obj_name(container, name), 304)
+            return {'etag': etag}, contents
         if resp_chunk_size:
             # return generator
             def body():
@@ -123,9 +137,10 @@ class Connection(object):
             return {}, body()
         else:
             try:
-                return {}, f.read()
+                contents = f.read()
             finally:
                 f.close()
+            return {'etag': md5(contents).hexdigest()}, contents
 
     def head_object(self, container, name, **kwargs):
         obj = self.path(container, name)
@@ -144,11 +159,13 @@ class Connection(object):
 
     def get_container(self, container, **kwargs):
         marker = kwargs.get('marker', None)
+        prefix = kwargs.get('prefix') or ''
         try:
             listing = os.listdir(self.path(container))
         except OSError, e:
             raise self.ClientException(str(e))
-        return {}, [{'name': obj} for obj in listing if obj > marker]
+        return {}, [{'name': obj} for obj in sorted(listing)
+                    if obj > marker and obj.startswith(prefix)]
 
     def head_account(self):
         if not os.path.exists(self.dir):
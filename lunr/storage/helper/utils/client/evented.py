@@ -0,0 +1,656 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Swift requests driven from one event loop rather than a process apiece.
+
+A save gets its concurrency by forking upload processes, each making one
+request at a time over a blocking connection.  An AsyncConnection keeps many
+requests in flight from a single thread over non-blocking sockets, polled
+with poll.  submit() starts a request and returns it, run() drives every
+request in flight until at least one finishes, and put_object(),
+get_object(), get_container() and delete_object() block for their result
+just like swift.Connection's.
+
+Auth, the token cache and the retry policy are those of the swift.Connection
+wrapped.  A request that fails with a socket error, a timeout, a 408 or a 5xx
+goes back in the queue after a backoff, without holding up the others.  Idle
+keep-alive sockets are used again for the next request to their endpoint,
+if the server closed one in the meantime the request just goes again.
+
+A request body is sent straight from the buffer it was handed after the
+request line and headers, never joined onto them, so a block upload holds
+no more copies of the block than the caller made.
+"""
+
+import errno
+import select
+import socket
+import ssl
+import sys
+from collections import defaultdict, deque
+from httplib import HTTPException
+from time import time
+from urlparse import urlparse
+
+from lunr.common import logger
+from lunr.storage.helper.utils.client.swift import ClientException, quote, \
+    json_loads
+
+LOGGER = logger.get_logger('lunr.client.evented')
+
+# Requests in flight at once
+MAX_IN_FLIGHT = 32
+# Seconds a request may go without any progress
+TIMEOUT = 60
+# Bytes read from a socket at once
+RECV_SIZE = 64 * 1024
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class Response(object):
+    """
+    A response parsed as its bytes arrive.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.status = None
+        self.reason = ''
+        self.headers = {}
+        self.body = None
+        self.complete = False
+        self.will_close = False
+        self._buf = ''
+        self._length = None
+        self._chunked = False
+        self._chunk = None
+        self._pieces = []
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def feed(self, data):
+        """
+        Parse data, '' once the server has closed the connection.
+        """
+        eof = not data
+        self._buf += data
+        if self.status is None and not self._head(eof):
+            return
+        if self._chunked:
+            self._chunks(eof)
+        elif self._length is not None:
+            if len(self._buf) >= self._length:
+                self._done(self._buf[:self._length])
+            elif eof:
+                raise HTTPException('Connection closed %d bytes short' %
+                                    (self._length - len(self._buf)))
+        elif eof:
+            self._done(self._buf)
+
+    def _head(self, eof):
+        end = self._buf.find('\r\n\r\n')
+        if end < 0:
+            if eof:
+                raise HTTPException('Connection closed before a response')
+            return False
+        head, self._buf = self._buf[:end], self._buf[end + 4:]
+        lines = head.split('\r\n')
+        version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+        try:
+            self.status = int(status)
+        except ValueError:
+            raise HTTPException('Bad status line %r' % lines[0])
+        self.reason = reason
+        for line in lines[1:]:
+            name, _sep, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        self.will_close = (version == 'HTTP/1.0' or
+                           self.getheader('connection', '').lower() ==
+                           'close')
+        if self.method == 'HEAD' or self.status in (204, 304):
+            self._length = 0
+        elif self.getheader('transfer-encoding', '').lower() == 'chunked':
+            self._chunked = True
+        elif self.getheader('content-length') is not None:
+            self._length = int(self.getheader('content-length'))
+        else:
+            # the body runs until the server closes the connection
+            self.will_close = True
+        return True
+
+    def _chunks(self, eof):
+        while not self.complete:
+            if self._chunk is None:
+                end = self._buf.find('\r\n')
+                if end < 0:
+                    break
+                self._chunk = int(self._buf[:end].split(';')[0], 16)
+                self._buf = self._buf[end + 2:]
+            elif self._chunk == 0:
+                # the last chunk is followed by trailers and a blank line
+                if self._buf.startswith('\r\n'):
+                    self._done(''.join(self._pieces))
+                    break
+                end = self._buf.find('\r\n\r\n')
+                if end < 0:
+                    break
+                self._done(''.join(self._pieces))
+            elif len(self._buf) >= self._chunk + 2:
+                self._pieces.append(self._buf[:self._chunk])
+                self._buf = self._buf[self._chunk + 2:]
+                self._chunk = None
+            else:
+                break
+        if eof and not self.complete:
+            raise HTTPException('Connection closed mid chunk')
+
+    def _done(self, body):
+        self.body = body
+        self._buf = ''
+        self._pieces = []
+        self.complete = True
+
+
+class Channel(object):
+    """
+    A non-blocking socket to one endpoint, carrying a request at a time.
+    """
+
+    def __init__(self, scheme, netloc):
+        self.endpoint = (scheme, netloc)
+        host, _sep, port = netloc.rpartition(':')
+        if not host or ']' in port:
+            host, port = netloc, None
+        port = int(port or (443 if scheme == 'https' else 80))
+        family, socktype, proto, _name, addr = socket.getaddrinfo(
+            host.strip('[]'), port, 0, socket.SOCK_STREAM)[0]
+        self.reused = False
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = self.sock.connect_ex(addr)
+        if err and err not in _WOULD_BLOCK:
+            self.sock.close()
+            raise socket.error(err, 'Unable to connect to %s' % netloc)
+        self.host = host
+        self.port = port
+        self.connecting = True
+        self.handshaking = scheme == 'https'
+        self.out = deque()
+        self.response = None
+        self.wants = 'write'
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self, head, method, body=''):
+        """
+        Send head and then body, which may be any buffer.
+        """
+        self.out = deque(memoryview(part) for part in (head, body) if part)
+        self.response = Response(method)
+        self.wants = 'write'
+
+    def _connected(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, 'Unable to connect to %s' % self.host)
+        self.connecting = False
+        if self.handshaking:
+            # verified just as httplib's HTTPSConnection would
+            context = ssl.create_default_context()
+            self.sock = context.wrap_socket(self.sock,
+                                            server_hostname=self.host,
+                                            do_handshake_on_connect=False)
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.wants = 'read'
+                return False
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.wants = 'write'
+                return False
+            raise
+        self.handshaking = False
+        self.wants = 'write'
+        return True
+
+    def _send(self):
+        while self.out:
+            try:
+                sent = self.sock.send(self.out[0])
+            except ssl.SSLError, e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                 ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error, e:
+                if e.errno in _WOULD_BLOCK:
+                    return
+                raise
+            if sent < len(self.out[0]):
+                self.out[0] = self.out[0][sent:]
+            else:
+                self.out.popleft()
+        self.wants = 'read'
+
+    def _recv(self):
+        while not self.response.complete:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except ssl.SSLError, e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                 ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error, e:
+                if e.errno in _WOULD_BLOCK:
+                    return
+                raise
+            self.response.feed(data)
+            if not data:
+                # complete, or feed() would have raised
+                self.response.will_close = True
+
+    def progress(self):
+        """
+        Carry on with the request, True once its response is complete.
+        """
+        if self.connecting:
+            self._connected()
+        if self.handshaking and not self._handshake():
+            return False
+        if self.out:
+            self._send()
+        if not self.out:
+            self._recv()
+        return self.response.complete
+
+    @property
+    def reusable(self):
+        return self.response and self.response.complete and \
+            not self.response.will_close
+
+    @property
+    def stale(self):
+        """
+        An idle socket the server closed before we sent anything on it.
+        """
+        return self.reused and self.response.status is None
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class Request(object):
+
+    def __init__(self, aconn, method, container, name=None, body='',
+                 headers=None, query=None, parse=None, failure=None):
+        self.aconn = aconn
+        self.method = method
+        self.container = container
+        self.name = name
+        self.body = body
+        self.headers = headers or {}
+        self.query = query
+        self.parse = parse
+        self.failure = failure or '%s failed' % method
+        self.attempts = 0
+        self.auth_attempts = 0
+        self.backoff = aconn.conn.starting_backoff
+        self.not_before = 0
+        self.deadline = None
+        self.channel = None
+        self.url = None
+        self.token = None
+        self.done = False
+        self._result = None
+        self._exc_info = None
+
+    def path(self, url):
+        path = '%s/%s' % (urlparse(url).path, quote(self.container))
+        if self.name is not None:
+            path += '/%s' % quote(self.name)
+        return path
+
+    def encode(self, url, token):
+        """
+        The request line and headers, the body goes separately.
+        """
+        path = self.path(url)
+        if self.query:
+            path += '?' + self.query
+        headers = dict(self.headers)
+        headers['X-Auth-Token'] = token
+        headers['Host'] = urlparse(url).netloc
+        headers['Content-Length'] = str(len(self.body))
+        lines = ['%s %s HTTP/1.1' % (self.method, path)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def finish(self, result=None, exc_info=None):
+        self._result = result
+        self._exc_info = exc_info
+        self.done = True
+
+    def result(self):
+        """
+        Block until the request has finished, raising anything it did.
+        """
+        while not self.done:
+            self.aconn.run()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+def _headers(resp):
+    return dict(resp.headers)
+
+
+class AsyncConnection(object):
+
+    def __init__(self, conn, max_in_flight=MAX_IN_FLIGHT, timeout=TIMEOUT):
+        """
+        :param conn: swift.Connection to authenticate and retry as
+        :param max_in_flight: most requests on the wire at once
+        :param timeout: seconds a request may go without any progress
+        """
+        self.conn = conn
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.queue = deque()
+        self.active = []
+        self.idle = defaultdict(list)
+        self.stats = defaultdict(int)
+
+    def __len__(self):
+        return len(self.queue) + len(self.active)
+
+    def submit(self, request):
+        self.queue.append(request)
+        self._start()
+        return request
+
+    def _start(self):
+        now = time()
+        waiting = deque()
+        while self.queue and len(self.active) < self.max_in_flight:
+            request = self.queue.popleft()
+            if request.not_before > now:
+                waiting.append(request)
+                continue
+            try:
+                self._send(request, now)
+            except (socket.error, HTTPException), e:
+                self._failed(request, e)
+            except Exception:
+                request.finish(exc_info=sys.exc_info())
+        self.queue.extendleft(reversed(waiting))
+
+    def _channel(self, url):
+        parsed = urlparse(url)
+        idle = self.idle[(parsed.scheme, parsed.netloc)]
+        if idle:
+            self.stats['reused'] += 1
+            channel = idle.pop()
+            channel.reused = True
+            return channel
+        self.stats['handshakes'] += 1
+        return Channel(parsed.scheme, parsed.netloc)
+
+    def _send(self, request, now):
+        conn = self.conn
+        if not conn.url or not conn.token:
+            conn.url, conn.token = conn.get_auth()
+        request.attempts += 1
+        request.channel = self._channel(conn.url)
+        request.channel.start(request.encode(conn.url, conn.token),
+                              request.method, request.body)
+        request.deadline = now + self.timeout
+        request.url, request.token = conn.url, conn.token
+        self.active.append(request)
+
+    def _release(self, request, reuse):
+        channel, request.channel = request.channel, None
+        if request in self.active:
+            self.active.remove(request)
+        if reuse and channel.reusable:
+            self.idle[channel.endpoint].append(channel)
+        else:
+            channel.close()
+
+    def _retry(self, request, err):
+        """
+        Queue request again after a backoff, unless it's out of attempts.
+        """
+        if request.attempts > self.conn.retries:
+            if isinstance(err, ClientException):
+                raise err
+            raise ClientException('Unable to make request: %s' % err)
+        LOGGER.warning('%s %s/%s attempt #%d failed, retrying in %d seconds'
+                       ': %s' % (request.method, request.container,
+                                 request.name, request.attempts,
+                                 request.backoff, err))
+        self.stats['retries'] += 1
+        request.not_before = time() + request.backoff
+        request.backoff *= 2
+        self.queue.append(request)
+
+    def _failed(self, request, err):
+        try:
+            self._retry(request, err)
+        except Exception:
+            request.finish(exc_info=sys.exc_info())
+
+    def _complete(self, request):
+        resp = request.channel.response
+        self._release(request, True)
+        if 200 <= resp.status < 300:
+            try:
+                result = resp
+                if request.parse:
+                    result = request.parse(resp)
+            except Exception:
+                request.finish(exc_info=sys.exc_info())
+            else:
+                request.finish(result)
+            return
+        parsed = urlparse(request.url)
+        err = ClientException(
+            request.failure, http_scheme=parsed.scheme,
+            http_host=parsed.hostname, http_port=parsed.port,
+            http_path=request.path(request.url), http_query=request.query,
+            http_status=resp.status, http_reason=resp.reason)
+        if resp.status == 401 and not request.auth_attempts:
+            # unless another request has already replaced it
+            request.auth_attempts += 1
+            if self.conn.token == request.token:
+                self.conn._invalidate()
+                self.conn.url = self.conn.token = None
+            self.queue.appendleft(request)
+        elif resp.status == 408 or 500 <= resp.status <= 599:
+            self._failed(request, err)
+        else:
+            request.finish(exc_info=(ClientException, err, None))
+
+    def _wait(self, timeout):
+        now = time()
+        wait = timeout
+        for request in self.active:
+            left = max(0, request.deadline - now)
+            wait = left if wait is None else min(wait, left)
+        if self.queue and len(self.active) < self.max_in_flight:
+            left = max(0, min(r.not_before for r in self.queue) - now)
+            wait = left if wait is None else min(wait, left)
+        return wait
+
+    def _poll(self, wait):
+        poller = select.poll()
+        for request in self.active:
+            channel = request.channel
+            if channel.wants == 'read':
+                poller.register(channel, select.POLLIN)
+            else:
+                poller.register(channel, select.POLLOUT)
+        if wait is not None:
+            wait *= 1000
+        try:
+            return set(fd for fd, _event in poller.poll(wait))
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return set()
+
+    def run(self, timeout=None):
+        """
+        Drive the requests in flight until at least one finishes or timeout
+        seconds pass.  Returns the requests which finished.
+        """
+        finished = []
+        start = time()
+        while len(self):
+            before = self.active + list(self.queue)
+            self._start()
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, timeout - (time() - start))
+            ready = self._poll(self._wait(remaining))
+            now = time()
+            for request in list(self.active):
+                if request.channel.fileno() in ready:
+                    request.deadline = now + self.timeout
+                    try:
+                        if request.channel.progress():
+                            self._complete(request)
+                    except (socket.error, HTTPException), e:
+                        stale = request.channel.stale
+                        self._release(request, False)
+                        if stale:
+                            self.stats['stale'] += 1
+                            request.attempts -= 1
+                            self.queue.appendleft(request)
+                        else:
+                            self._failed(request, e)
+                elif request.deadline <= now:
+                    self._release(request, False)
+                    self._failed(request, socket.timeout(
+                        'No progress in %s seconds' % self.timeout))
+            finished.extend(r for r in before if r.done)
+            if finished or (timeout is not None and
+                            time() - start >= timeout):
+                break
+        return finished
+
+    def close(self):
+        for request in list(self.active):
+            self._release(request, False)
+        for channels in self.idle.values():
+            for channel in channels:
+                channel.close()
+        self.idle.clear()
+
+    def submit_put_object(self, container, obj, contents,
+                          content_length=None, headers=None):
+        if hasattr(contents, 'getvalue'):
+            # a StringIO hands back the string it wraps, no copy is made
+            contents = contents.getvalue()
+        elif hasattr(contents, 'read'):
+            if content_length is None:
+                contents = contents.read()
+            else:
+                contents = contents.read(content_length)
+        body = memoryview(contents or '')
+        if content_length is not None:
+            body = body[:content_length]
+        return self.submit(Request(
+            self, 'PUT', container, obj, body=body,
+            headers=headers, failure='Object PUT failed',
+            parse=lambda resp: resp.getheader('etag', '').strip('"')))
+
+    def submit_get_object(self, container, obj, headers=None):
+        return self.submit(Request(
+            self, 'GET', container, obj, headers=headers,
+            failure='Object GET failed',
+            parse=lambda resp: (_headers(resp), resp.body)))
+
+    def submit_get_container(self, container, marker=None, limit=None,
+                             prefix=None, delimiter=None):
+        query = 'format=json'
+        if marker:
+            query += '&marker=%s' % quote(marker)
+        if limit:
+            query += '&limit=%d' % limit
+        if prefix:
+            query += '&prefix=%s' % quote(prefix)
+        if delimiter:
+            query += '&delimiter=%s' % quote(delimiter)
+
+        def parse(resp):
+            if resp.status == 204:
+                return _headers(resp), []
+            return _headers(resp), json_loads(resp.body)
+        return self.submit(Request(
+            self, 'GET', container, query=query, parse=parse,
+            failure='Container GET failed'))
+
+    def submit_delete_object(self, container, obj, headers=None):
+        return self.submit(Request(
+            self, 'DELETE', container, obj, headers=headers,
+            failure='Object DELETE failed', parse=lambda resp: None))
+
+    def put_object(self, container, obj, contents, content_length=None,
+                   headers=None):
+        """Blocking :func:`submit_put_object`, returns the etag"""
+        return self.submit_put_object(container, obj, contents,
+                                      content_length=content_length,
+                                      headers=headers).result()
+
+    def get_object(self, container, obj, headers=None):
+        """Blocking :func:`submit_get_object`"""
+        return self.submit_get_object(container, obj,
+                                      headers=headers).result()
+
+    def get_container(self, container, marker=None, limit=None, prefix=None,
+                      delimiter=None, full_listing=False):
+        """Blocking :func:`submit_get_container`"""
+        rv = self.submit_get_container(container, marker=marker, limit=limit,
+                                       prefix=prefix,
+                                       delimiter=delimiter).result()
+        listing = rv[1]
+        while full_listing and listing:
+            if not delimiter:
+                marker = listing[-1]['name']
+            else:
+                marker = listing[-1].get('name', listing[-1].get('subdir'))
+            listing = self.submit_get_container(
+                container, marker=marker, limit=limit, prefix=prefix,
+                delimiter=delimiter).result()[1]
+            rv[1].extend(listing)
+        return rv
+
+    def delete_object(self, container, obj, headers=None):
+        """Blocking :func:`submit_delete_object`"""
+        return self.submit_delete_object(container, obj,
+                                         headers=headers).result()
@@ -0,0 +1,147 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+When to send a second GET for an object that is slow to answer.
+
+A restore waits on every block it downloads, so one slow object server
+holds up a worker for as long as the read timeout.  The policy remembers how
+long recent GETs took to answer, and once it has seen enough of them a GET
+which hasn't answered by the given percentile is sent again on a connection
+of its own.  Whichever answers first is used.  Every Connection in a process
+shares its policy, so all the restore threads learn from each other, and a
+single thread of the policy's sends every GET that has to go again.
+"""
+
+import heapq
+import os
+import threading
+from collections import defaultdict, deque
+from itertools import count
+from time import time
+
+# GETs slower than this percentile of recent ones are sent again, 0 never
+PERCENTILE = 95
+# Never send a GET again sooner than this many seconds
+MIN_DELAY = 0.1
+# Recent GETs the percentile is taken over
+WINDOW = 200
+# GETs seen before any are sent again
+MIN_SAMPLES = 20
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(percentile=PERCENTILE, min_delay=MIN_DELAY, window=WINDOW):
+    """
+    The policy for this process.
+    """
+    with _policies_lock:
+        policy = _policies.get(os.getpid())
+        if not policy:
+            _policies.clear()
+            policy = _policies[os.getpid()] = HedgePolicy(
+                percentile, min_delay=min_delay, window=window)
+        return policy
+
+
+class HedgePolicy(object):
+
+    def __init__(self, percentile=PERCENTILE, min_delay=MIN_DELAY,
+                 window=WINDOW, min_samples=MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.pending = []
+        self.sequence = count()
+        self.timer = threading.Condition(threading.Lock())
+        self.thread = None
+
+    def delay(self):
+        """
+        Seconds to wait for an answer before sending a GET again, None
+        until enough have been seen to tell what's slow.
+        """
+        with self.lock:
+            if not self.samples or len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1,
+                    int(len(ordered) * self.percentile / 100.0))
+        return max(self.min_delay, ordered[index])
+
+    def record(self, seconds):
+        """
+        A GET answered after seconds.
+        """
+        with self.lock:
+            self.samples.append(seconds)
+            self.counts['requests'] += 1
+
+    def hedged(self, won):
+        """
+        A GET was sent again, won if the second one answered first.
+        """
+        with self.lock:
+            self.counts['hedged'] += 1
+            if won:
+                self.counts['hedge_wins'] += 1
+
+    def schedule(self, seconds, func):
+        """
+        Call func from the policy's thread after seconds, unless the
+        function returned is called first to cancel it.  The thread is only
+        around while there's something to call.
+        """
+        entry = [func]
+        with self.timer:
+            heapq.heappush(self.pending,
+                           (time() + seconds, next(self.sequence), entry))
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.timer.notify()
+
+        def cancel():
+            entry[0] = None
+        return cancel
+
+    def _run(self):
+        while True:
+            with self.timer:
+                if not self.pending:
+                    self.thread = None
+                    return
+                while self.pending[0][0] > time():
+                    self.timer.wait(self.pending[0][0] - time())
+                _when, _seq, entry = heapq.heappop(self.pending)
+            func, entry[0] = entry[0], None
+            if func:
+                try:
+                    func()
+                except Exception:
+                    # the GET that was to go again just waits on the first
+                    pass
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['delay'] = self.delay()
+        return stats
@@ -0,0 +1,127 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Listings fetched a page at a time.
+
+A block container can hold millions of objects.  Building the whole listing
+before returning it holds all of it in memory, and when a request failed
+late the retry started over from the first page.  These iterate the pages
+instead, each one asked for with the marker the last ended on, so a page
+which has to be retried is the only one fetched again.  They work with any
+client's get_container and get_account.
+"""
+
+import Queue
+import sys
+import threading
+
+# Seconds a prefetch thread waits on a full queue between looking to see if
+# the caller has stopped
+STOP_POLL = 0.1
+
+
+def next_marker(listing, delimiter=None):
+    """
+    The marker for the page after listing.
+    """
+    last = listing[-1]
+    if delimiter:
+        return last.get('name', last.get('subdir'))
+    return last['name']
+
+
+def container_pages(conn, container, marker=None, limit=None, prefix=None,
+                    delimiter=None):
+    """
+    Iterate the pages of the listing of container.
+    """
+    while True:
+        _headers, listing = conn.get_container(
+            container, marker=marker, limit=limit, prefix=prefix,
+            delimiter=delimiter)
+        if not listing:
+            return
+        yield listing
+        marker = next_marker(listing, delimiter)
+
+
+def account_pages(conn, marker=None, limit=None, prefix=None):
+    """
+    Iterate the pages of the listing of the account's containers.
+    """
+    while True:
+        _headers, listing = conn.get_account(marker=marker, limit=limit,
+                                             prefix=prefix)
+        if not listing:
+            return
+        yield listing
+        marker = next_marker(listing)
+
+
+def _put(queue, item, stop):
+    """
+    Put item on queue once there's room, unless stop is set first.  Returns
+    whether it was put.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=STOP_POLL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def prefetch_pages(pages, depth):
+    """
+    Iterate pages while a thread fetches up to depth of them ahead, so the
+    next is on its way while the caller works through this one.  The thread
+    is the only one to use the connection pages was made with, so that
+    connection has to be one of its own.
+    """
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def fetch():
+        # the caller may stop with the queue full at any point, every put
+        # gives up then rather than holding the connection forever
+        try:
+            for page in pages:
+                if not _put(queue, (page, None), stop):
+                    return
+            _put(queue, (None, None), stop)
+        except Exception:
+            _put(queue, (None, sys.exc_info()), stop)
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            page, exc_info = queue.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if page is None:
+                return
+            yield page
+    finally:
+        stop.set()
+        # make room for a page the thread may be waiting to hand over
+        try:
+            while True:
+                queue.get_nowait()
+        except Queue.Empty:
+            pass
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 
+from hashlib import md5
 from StringIO import StringIO
 from time import sleep
 
@@ -44,14 +45,20 @@ class Connection(object):
         self.data[container][name] = contents
 
     def put_container(self, container, *args, **kwargs):
-        self.data[container] = {}
+        # like swift, putting an existing container leaves it alone
+        self.data.setdefault(container, {})
 
-    def get_object(self, container, name, resp_chunk_size=None, **kwargs):
+    def get_object(self, container, name, resp_chunk_size=None,
+                   headers=None, **kwargs):
         try:
             contents = self.data[container][name]
         except KeyError:
             raise self.ClientException(
                 'object not found %r/%r' % (container, name))
+        etag = md5(contents).hexdigest()
+        if headers and headers.get('If-None-Match') == etag:
+            raise self.ClientException(
+                'not modified %r/%r' % (container, name), 304)
         if resp_chunk_size:
             # return generator
             f = StringIO(contents)
@@ -63,7 +70,7 @@ class Connection(object):
                     buf = f.read(resp_chunk_size)
             return {}, body()
         else:
-            return {}, contents
+            return {'etag': etag}, contents
 
     def delete_object(self, container, name, **kwargs):
         try:
@@ -74,12 +81,13 @@ class Connection(object):
 
     def get_container(self, container, **kwargs):
         marker = kwargs.get('marker', None)
+        prefix = kwargs.get('prefix') or ''
         if container not in self.data:
             raise self.ClientException(
                 'container does not exist %s' % container)
         listing = []
-        for obj in self.data[container].keys():
-            if obj > marker:
+        for obj in sorted(self.data[container].keys()):
+            if obj > marker and obj.startswith(prefix):
                 listing.append({'name': obj})
         return {}, listing
 
@@ -91,6 +99,21 @@ class Connection(object):
         except KeyError:
             pass
 
+    def get_capabilities(self):
+        return {'bulk_delete': {'max_deletes_per_request': 10000}}
+
+    def bulk_delete(self, objects):
+        result = {'Number Deleted': 0, 'Number Not Found': 0, 'Errors': [],
+                  'Response Status': '200 OK'}
+        for container, name in objects:
+            try:
+                self.delete_object(container, name)
+            except self.ClientException:
+                result['Number Not Found'] += 1
+            else:
+                result['Number Deleted'] += 1
+        return result
+
     def head_account(self):
         return {
             'containers': len(self.data),
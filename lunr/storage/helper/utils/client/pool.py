@@ -0,0 +1,180 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keep-alive HTTP connections shared by every swift Connection in a process.
+
+A Connection used to own a single HTTPConnection and throw it away after
+any error, and each of the Connections the threads of a restore or an audit
+make paid for handshakes of its own.  The pool keeps up to size idle
+connections for each storage endpoint.  A request checks one out, opening a
+new one if none are idle, and puts it back once its response has been read.
+A connection idle for longer than idle_timeout, or which the server closed
+while it sat in the pool, is thrown away rather than handed out.
+
+Sockets don't survive a fork, so every process gets a pool of its own.
+"""
+
+import os
+import select
+import socket
+import threading
+from collections import defaultdict
+from time import time
+from urlparse import urlparse
+
+# Idle connections kept for each endpoint
+SIZE = 8
+# Seconds an idle connection is kept
+IDLE_TIMEOUT = 30
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(size=SIZE, idle_timeout=IDLE_TIMEOUT):
+    """
+    The pool for this process.
+    """
+    with _pools_lock:
+        pool = _pools.get(os.getpid())
+        if not pool:
+            # anything left belongs to the process we forked from
+            _pools.clear()
+            pool = _pools[os.getpid()] = ConnectionPool(size, idle_timeout)
+        return pool
+
+
+def _endpoint(url):
+    parsed = urlparse(url)
+    return '%s://%s' % (parsed.scheme, parsed.netloc)
+
+
+def _dropped(conn):
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        return True
+    try:
+        readable, _writable, _errored = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    # there's nothing to read on an idle connection unless it was closed
+    return bool(readable)
+
+
+def _close(http_conn):
+    try:
+        http_conn[1].close()
+    except Exception:
+        pass
+
+
+class ConnectionPool(object):
+
+    def __init__(self, size=SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # endpoint -> [(checked in, (parsed, conn))], oldest first
+        self.idle = defaultdict(list)
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def _evict(self, endpoint, now):
+        idle = self.idle[endpoint]
+        while idle and (len(idle) > self.size or
+                        now - idle[0][0] > self.idle_timeout):
+            _close(idle.pop(0)[1])
+            self.counts[endpoint]['evicted'] += 1
+
+    def get(self, url, factory):
+        """
+        Check out a connection to url, factory(url) makes a new one if
+        there isn't a healthy one idle.
+        """
+        endpoint = _endpoint(url)
+        now = time()
+        with self.lock:
+            self._evict(endpoint, now)
+            counts = self.counts[endpoint]
+            counts['in_flight'] += 1
+            idle = self.idle[endpoint]
+            while idle:
+                _checked_in, http_conn = idle.pop()
+                if _dropped(http_conn[1]):
+                    _close(http_conn)
+                    counts['dropped'] += 1
+                    continue
+                counts['reused'] += 1
+                # the path is the account's, which may not be the same
+                return urlparse(url), http_conn[1]
+            counts['handshakes'] += 1
+        return factory(url)
+
+    def put(self, url, http_conn):
+        """
+        Check in a connection whose response has been read.
+        """
+        endpoint = _endpoint(url)
+        now = time()
+        with self.lock:
+            self.counts[endpoint]['in_flight'] -= 1
+            if getattr(http_conn[1], 'sock', None) is None:
+                # the server asked for it to be closed
+                self.counts[endpoint]['closed'] += 1
+                return
+            self.idle[endpoint].append((now, http_conn))
+            self._evict(endpoint, now)
+
+    def discard(self, url, http_conn):
+        """
+        Throw away a connection which may be in the middle of something.
+        """
+        endpoint = _endpoint(url)
+        with self.lock:
+            self.counts[endpoint]['in_flight'] -= 1
+            self.counts[endpoint]['discarded'] += 1
+        _close(http_conn)
+
+    def releasing(self, url, http_conn, body):
+        """
+        Iterate body, checking in http_conn once all of it has been read.
+        """
+        done = False
+        try:
+            for chunk in body:
+                yield chunk
+            done = True
+        finally:
+            if done:
+                self.put(url, http_conn)
+            else:
+                self.discard(url, http_conn)
+
+    def stats(self):
+        """
+        Counts for each endpoint, along with how many are idle and the
+        fraction of checkouts which reused a connection.
+        """
+        stats = {}
+        with self.lock:
+            for endpoint, counts in self.counts.items():
+                info = dict(counts)
+                info['idle'] = len(self.idle[endpoint])
+                checkouts = counts['reused'] + counts['handshakes']
+                info['reuse_rate'] = 0.0
+                if checkouts:
+                    info['reuse_rate'] = float(counts['reused']) / checkouts
+                stats[endpoint] = info
+        return stats
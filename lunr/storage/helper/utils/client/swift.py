@@ -24,18 +24,29 @@ from urllib import quote as _quote
 from urlparse import urlparse, urlunparse
 import errno
 import logging
+import os
+import Queue
 import socket
+import sys
+import threading
+from time import time
 
 from lunr.common import config, exc
+from lunr.storage.helper.utils.client.hedge import get_policy, \
+    MIN_DELAY as HEDGE_MIN_DELAY
+from lunr.storage.helper.utils.client.listing import account_pages, \
+    container_pages, next_marker, prefetch_pages
+from lunr.storage.helper.utils.client.pool import get_pool, \
+    SIZE as POOL_SIZE, IDLE_TIMEOUT as POOL_IDLE_TIMEOUT
+from lunr.storage.helper.utils.client.tokens import TokenCache, cache_key, \
+    TTL as TOKEN_TTL
 
 LOGGER = logging.getLogger('lunr.client.swift')
 
-
-# Very heavy handed solution to getting read/write socket timeouts with
-# swiftclient. This solves snapshots hanging due to network problems between
-# us and swift. FIXME(cory) In the future, a better swiftclient can set the
-# timeout value on each socket it uses instead.
-socket.setdefaulttimeout(240)
+# Seconds to wait for a connection to swift
+CONNECT_TIMEOUT = 10
+# Seconds to wait on any one read from or write to swift
+READ_TIMEOUT = 240
 
 
 def quote(value, safe='/'):
@@ -102,25 +113,54 @@ class ClientException(exc.ClientException):
         return b and '%s: %s' % (a, b) or a
 
 
-def http_connection(url):
+def _read_timeout(conn, timeout):
+    """
+    Connect within the connection's own timeout, then wait up to timeout on
+    each read or write.
+    """
+    connect = conn.connect
+
+    def timed_connect():
+        connect()
+        conn.sock.settimeout(timeout)
+    conn.connect = timed_connect
+
+
+def http_connection(url, connect_timeout=CONNECT_TIMEOUT,
+                    read_timeout=READ_TIMEOUT):
     """
     Make an HTTPConnection or HTTPSConnection
 
     :param url: url to connect to
+    :param connect_timeout: seconds to wait for the connection
+    :param read_timeout: seconds to wait on each read or write
     :returns: tuple of (parsed url, connection object)
     :raises ClientException: Unable to handle protocol scheme
     """
     parsed = urlparse(url)
     if parsed.scheme == 'http':
-        conn = HTTPConnection(parsed.netloc)
+        conn = HTTPConnection(parsed.netloc, timeout=connect_timeout)
     elif parsed.scheme == 'https':
-        conn = HTTPSConnection(parsed.netloc)
+        conn = HTTPSConnection(parsed.netloc, timeout=connect_timeout)
     else:
         raise ClientException('Cannot handle protocol scheme %s for url %s' %
                               (parsed.scheme, repr(url)))
+    _read_timeout(conn, read_timeout)
     return parsed, conn
 
 
+def _discard(rv):
+    """
+    Let go of what a GET nobody wants returned.
+    """
+    body = rv[1]
+    if hasattr(body, 'close'):
+        # a streamed body only gives up its connection once it has started
+        for _chunk in body:
+            break
+        body.close()
+
+
 def get_auth(url, user, key, region, snet=False):
     """
     Get authentication/authorization credentials.
@@ -475,7 +515,7 @@ def delete_container(url, token, container, http_conn=None):
 
 
 def get_object(url, token, container, name, http_conn=None,
-               resp_chunk_size=None, newest=False):
+               resp_chunk_size=None, newest=False, headers=None):
     """
     Get an object
 
@@ -492,16 +532,20 @@ def get_object(url, token, container, name, http_conn=None,
     :param newest:  Defaults to False if True then the header "x-newest = True"
                     is sent which will do a head on all three copies and make
                     sure the newest one is returned.
+    :param headers: additional headers to include in the request, such as
+                    If-None-Match
     :returns: a tuple of (response headers, the object's contents) The response
               headers will be a dict and all header names will be lowercase.
-    :raises ClientException: HTTP GET request failed
+    :raises ClientException: HTTP GET request failed, a 304 if the object
+                             matched If-None-Match
     """
     if http_conn:
         parsed, conn = http_conn
     else:
         parsed, conn = http_connection(url)
     path = '%s/%s/%s' % (parsed.path, quote(container), quote(name))
-    headers = {'X-Auth-Token': token}
+    headers = dict(headers or {})
+    headers['X-Auth-Token'] = token
     if newest:
         headers['X-Newest'] = 'True'
     conn.request('GET', path, '', headers)
@@ -692,11 +736,86 @@ def delete_object(url, token, container, name, headers=None, http_conn=None):
             http_reason=resp.reason)
 
 
+def get_capabilities(url, token, http_conn=None):
+    """
+    Get the cluster's capabilities.
+
+    :param url: storage URL, the capabilities are at /info on its host
+    :param token: auth token, /info doesn't need it
+    :param http_conn: HTTP connection object (If None, it will create the
+                      conn object)
+    :returns: a dict of the cluster's capabilities, keyed by middleware
+    :raises ClientException: HTTP GET request failed
+    """
+    if http_conn:
+        parsed, conn = http_conn
+    else:
+        parsed, conn = http_connection(url)
+    path = '/info'
+    conn.request('GET', path, '', {})
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException(
+            'Info GET failed',
+            http_scheme=parsed.scheme, http_host=conn.host,
+            http_port=conn.port, http_path=path, http_status=resp.status,
+            http_reason=resp.reason)
+    return json_loads(body)
+
+
+def bulk_delete(url, token, objects, http_conn=None):
+    """
+    Delete objects in one request through the bulk middleware.
+
+    :param url: storage URL
+    :param token: auth token
+    :param objects: list of (container, name), no more than the cluster's
+                    max_deletes_per_request
+    :param http_conn: HTTP connection object (If None, it will create the
+                      conn object)
+    :returns: a dict of the 'Number Deleted', the 'Number Not Found' and the
+              'Errors', [path, status] for each object that failed
+    :raises ClientException: HTTP DELETE request failed
+    """
+    if http_conn:
+        parsed, conn = http_conn
+    else:
+        parsed, conn = http_connection(url)
+    qs = 'bulk-delete'
+    body = '\n'.join(quote('/%s/%s' % (container, name))
+                     for container, name in objects)
+    conn.request('DELETE', '%s?%s' % (parsed.path, qs), body,
+                 {'X-Auth-Token': token, 'Accept': 'application/json',
+                  'Content-Type': 'text/plain'})
+    resp = conn.getresponse()
+    rv = resp.read()
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException(
+            'Bulk DELETE failed',
+            http_scheme=parsed.scheme, http_host=conn.host,
+            http_port=conn.port, http_path=parsed.path, http_query=qs,
+            http_status=resp.status, http_reason=resp.reason)
+    # the middleware sends 200 before it starts, how it went is in the body
+    rv = json_loads(rv)
+    status = rv.get('Response Status', '200 OK')
+    if not status.startswith('200') and not rv.get('Errors'):
+        code, _sep, reason = status.partition(' ')
+        raise ClientException(
+            'Bulk DELETE failed',
+            http_scheme=parsed.scheme, http_host=conn.host,
+            http_port=conn.port, http_path=parsed.path, http_query=qs,
+            http_status=int(code), http_reason=reason)
+    return rv
+
+
 class Connection(object):
     """Convenience class to make requests that will also retry the request"""
 
     def __init__(self, authurl, user, key, region, retries=5, preauthurl=None,
-                 preauthtoken=None, snet=False, starting_backoff=1):
+                 preauthtoken=None, snet=False, starting_backoff=1,
+                 token_cache=None, pool=None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, hedge=None):
         """
         :param authurl: authenitcation URL
         :param user: user name to authenticate as
@@ -706,6 +825,12 @@ class Connection(object):
         :param preauthtoken: authentication token (if you have already
                              authenticated)
         :param snet: use SERVICENET internal network default is False
+        :param token_cache: TokenCache shared with other processes, if any
+        :param pool: ConnectionPool to check connections out of, without
+                     one the connection is kept until it fails
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait on each read or write
+        :param hedge: HedgePolicy deciding when a slow GET is sent again
         """
         self.authurl = authurl
         self.user = user
@@ -717,13 +842,94 @@ class Connection(object):
         self.token = preauthtoken
         self.snet = snet
         self.starting_backoff = starting_backoff
+        self.token_cache = token_cache
+        self.pool = pool
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hedge = hedge
+        self.cancelled = False
+        # held by cancel() while it has the socket, so it can't have been
+        # handed back to the pool in the meantime
+        self.lock = threading.Lock()
+
+    def copy(self):
+        """
+        A connection of its own for another thread, sharing our token.
+        """
+        return Connection(self.authurl, self.user, self.key, self.region,
+                          retries=self.retries, preauthurl=self.url,
+                          preauthtoken=self.token, snet=self.snet,
+                          starting_backoff=self.starting_backoff,
+                          token_cache=self.token_cache, pool=self.pool,
+                          connect_timeout=self.connect_timeout,
+                          read_timeout=self.read_timeout, hedge=self.hedge)
+
+    def cancel(self):
+        """
+        Give up on the request another thread is making, it fails rather
+        than being retried.
+        """
+        with self.lock:
+            self.cancelled = True
+            http_conn = self.http_conn
+            sock = http_conn and getattr(http_conn[1], 'sock', None)
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def _detach(self):
+        """
+        Take the connection, after which cancel() can't get at it.  Returns
+        it along with whether the request was cancelled.
+        """
+        with self.lock:
+            http_conn, self.http_conn = self.http_conn, None
+            return http_conn, self.cancelled
 
-    def get_auth(self):
+    def _cache_key(self):
+        return cache_key(self.authurl, self.user, self.region, self.snet)
+
+    def _authenticate(self):
         return get_auth(self.authurl, self.user, self.key, self.region,
                         snet=self.snet)
 
+    def get_auth(self):
+        if not self.token_cache:
+            return self._authenticate()
+        return self.token_cache.get(self._cache_key(), self._authenticate)
+
+    def _invalidate(self):
+        if self.token_cache and self.token:
+            self.token_cache.invalidate(self._cache_key(), self.token)
+
+    def _new_http_connection(self, url):
+        return http_connection(url, connect_timeout=self.connect_timeout,
+                               read_timeout=self.read_timeout)
+
     def http_connection(self):
-        return http_connection(self.url)
+        if self.pool:
+            return self.pool.get(self.url, self._new_http_connection)
+        return self._new_http_connection(self.url)
+
+    def _release(self, reuse=True):
+        """
+        Done with the connection, which can be used again if reuse and the
+        response was read.  A cancelled request's never is, its socket may
+        have been shut down.
+        """
+        if not self.pool:
+            if not reuse:
+                self._detach()
+            return
+        http_conn, cancelled = self._detach()
+        if not http_conn:
+            return
+        if reuse and not cancelled:
+            self.pool.put(self.url, http_conn)
+        else:
+            self.pool.discard(self.url, http_conn)
 
     def _retry(self, reset_func, func, *args, **kwargs):
         auth_attempts, attempts = 0, 0
@@ -731,6 +937,8 @@ class Connection(object):
         while attempts <= self.retries:
             attempts += 1
             try:
+                if self.cancelled:
+                    raise ClientException('Request cancelled')
                 if not self.url or not self.token:
                     self.url, self.token = self.get_auth()
                     self.http_conn = None
@@ -738,6 +946,16 @@ class Connection(object):
                     self.http_conn = self.http_connection()
                 kwargs['http_conn'] = self.http_conn
                 rv = func(self.url, self.token, *args, **kwargs)
+                if self.pool and kwargs.get('resp_chunk_size'):
+                    # not done with it until the body has been read
+                    http_conn, cancelled = self._detach()
+                    if cancelled:
+                        self.pool.discard(self.url, http_conn)
+                        raise ClientException('Request cancelled')
+                    headers, body = rv
+                    return headers, self.pool.releasing(self.url, http_conn,
+                                                        body)
+                self._release()
                 return rv
             except (socket.error, HTTPException), e:
                 LOGGER.debug(
@@ -747,8 +965,8 @@ class Connection(object):
                 else:
                     netloc = urlparse(self.url or self.authurl).netloc
                     host = netloc.rsplit(':', 1)[0]
-                self.http_conn = None
-                if attempts > self.retries:
+                self._release(reuse=False)
+                if attempts > self.retries or self.cancelled:
                     if isinstance(e, socket.gaierror) and e.errno == -2:
                         raise ClientException("Could not resolve '%s'" % host)
                     if isinstance(e, socket.error) and \
@@ -758,18 +976,22 @@ class Connection(object):
                     LOGGER.exception('Unexpected socket/http error')
                     raise ClientException('Unable to make request: %s' % e)
             except ClientException, err:
-                if attempts > self.retries:
+                # the response was read, unless the server timed us out
+                self._release(reuse=err.http_status != 408)
+                if attempts > self.retries or self.cancelled:
                     raise
                 if not 500 <= err.http_status <= 599:
                     if err.http_status == 401:
                         # retry auth once after initial auth failure
                         if auth_attempts >= 1:
                             raise
-                        self.http_conn = self.url = self.token = None
+                        self._invalidate()
+                        self._release(reuse=False)
+                        self.url = self.token = None
                         auth_attempts += 1
                     elif err.http_status == 408:
                         # Try again on '408 Request TimeOut'
-                        self.http_conn = None
+                        pass
                     else:
                         raise
             LOGGER.warning('attempt #%d failed, retrying in %d seconds' %
@@ -786,16 +1008,39 @@ class Connection(object):
     def get_account(self, marker=None, limit=None, prefix=None,
                     full_listing=False):
         """Wrapper for :func:`get_account`"""
-        # TODO(unknown): With full_listing=True this will restart the entire
-        # listing with each retry. Need to make a better version that just
-        # retries where it left off.
-        return self._retry(None, get_account, marker=marker, limit=limit,
-                           prefix=prefix, full_listing=full_listing)
+        rv = self._retry(None, get_account, marker=marker, limit=limit,
+                         prefix=prefix)
+        if full_listing and rv[1]:
+            # each page is retried on its own, from where the last ended
+            for listing in account_pages(self, next_marker(rv[1]), limit,
+                                         prefix):
+                rv[1].extend(listing)
+        return rv
+
+    def iter_account(self, marker=None, limit=None, prefix=None,
+                     prefetch=0):
+        """
+        Iterate the pages of the account listing, see
+        :meth:`iter_container`.
+        """
+        conn = self.copy() if prefetch else self
+        pages = account_pages(conn, marker, limit, prefix)
+        if prefetch:
+            return prefetch_pages(pages, prefetch)
+        return pages
 
     def post_account(self, headers):
         """Wrapper for :func:`post_account`"""
         return self._retry(None, post_account, headers)
 
+    def get_capabilities(self):
+        """Wrapper for :func:`get_capabilities`"""
+        return self._retry(None, get_capabilities)
+
+    def bulk_delete(self, objects):
+        """Wrapper for :func:`bulk_delete`"""
+        return self._retry(None, bulk_delete, objects)
+
     def head_container(self, container):
         """Wrapper for :func:`head_container`"""
         return self._retry(None, head_container, container)
@@ -803,12 +1048,30 @@ class Connection(object):
     def get_container(self, container, marker=None, limit=None, prefix=None,
                       delimiter=None, full_listing=False):
         """Wrapper for :func:`get_container`"""
-        # TODO(unknown): With full_listing=True this will restart the entire
-        # listing with each retry. Need to make a better version that just
-        # retries where it left off.
-        return self._retry(None, get_container, container, marker=marker,
-                           limit=limit, prefix=prefix, delimiter=delimiter,
-                           full_listing=full_listing)
+        rv = self._retry(None, get_container, container, marker=marker,
+                         limit=limit, prefix=prefix, delimiter=delimiter)
+        if full_listing and rv[1]:
+            # each page is retried on its own, from where the last ended
+            for listing in container_pages(
+                    self, container, next_marker(rv[1], delimiter), limit,
+                    prefix, delimiter):
+                rv[1].extend(listing)
+        return rv
+
+    def iter_container(self, container, marker=None, limit=None,
+                       prefix=None, delimiter=None, prefetch=0):
+        """
+        Iterate the pages of the listing of container.  Each page is
+        retried on its own, starting from the marker the last ended on.
+        With prefetch, a copy of this connection fetches up to that many
+        pages ahead in a thread.
+        """
+        conn = self.copy() if prefetch else self
+        pages = container_pages(conn, container, marker, limit, prefix,
+                                delimiter)
+        if prefetch:
+            return prefetch_pages(pages, prefetch)
+        return pages
 
     def put_container(self, container, headers=None):
         """Wrapper for :func:`put_container`"""
@@ -826,11 +1089,100 @@ class Connection(object):
         """Wrapper for :func:`head_object`"""
         return self._retry(None, head_object, container, obj)
 
-    def get_object(self, container, obj, resp_chunk_size=None, newest=False):
-        """Wrapper for :func:`get_object`"""
+    def _attempt(self, func, args, kwargs, outcome, race):
+        """
+        Send the request again on a connection of its own in another
+        thread, unless it has already been answered.  Whichever attempt
+        answers first cancels the other, this one puts (conn, rv, exc_info)
+        in outcome unless it lost.
+        """
+        lock, won, sent = race
+        with lock:
+            if won:
+                return
+            conn = self.copy()
+            sent.append(conn)
+
+        def run():
+            start = time()
+            try:
+                rv = conn._retry(None, func, *args, **kwargs)
+            except Exception:
+                outcome.put((conn, None, sys.exc_info()))
+                return
+            with lock:
+                lost = bool(won)
+                won.append(conn)
+            if lost:
+                _discard(rv)
+                return
+            self.cancel()
+            self.hedge.record(time() - start)
+            outcome.put((conn, rv, None))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _hedged(self, func, *args, **kwargs):
+        """
+        Make the request, and again on another connection if it hasn't
+        answered by the time the hedge policy says it's slow.  Returns
+        whichever answers first.  Nothing more is done for a request that
+        answers in time than scheduling the one that would go again.
+        """
+        delay = self.hedge.delay()
+        start = time()
+        if delay is None:
+            rv = self._retry(None, func, *args, **kwargs)
+            self.hedge.record(time() - start)
+            return rv
+        outcome = Queue.Queue()
+        race = lock, won, sent = (threading.Lock(), [], [])
+        cancel = self.hedge.schedule(
+            delay, lambda: self._attempt(func, args, kwargs, outcome, race))
+        rv, exc_info = None, None
+        try:
+            rv = self._retry(None, func, *args, **kwargs)
+        except Exception:
+            exc_info = sys.exc_info()
+        cancel()
+        with lock:
+            lost = bool(won)
+            if not lost and (not exc_info or not sent):
+                won.append(self)
+        if not lost and not exc_info:
+            self.hedge.record(time() - start)
+        elif lost or sent:
+            if rv:
+                _discard(rv)
+            # the other cancelled us if it answered, or may yet answer
+            conn, other, other_exc_info = outcome.get()
+            self.cancelled = False
+            if not other_exc_info:
+                self.hedge.hedged(True)
+                self.url, self.token = conn.url, conn.token
+                return other
+        if sent:
+            sent[0].cancel()
+            self.hedge.hedged(False)
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return rv
+
+    def get_object(self, container, obj, resp_chunk_size=None, newest=False,
+                   headers=None):
+        """
+        Wrapper for :func:`get_object`, a block streamed with
+        resp_chunk_size is sent again if it's slow to answer when there's a
+        hedge policy
+        """
+        if self.hedge and self.hedge.percentile and resp_chunk_size:
+            return self._hedged(get_object, container, obj,
+                                resp_chunk_size=resp_chunk_size,
+                                newest=newest, headers=headers)
         return self._retry(None, get_object, container, obj,
                            resp_chunk_size=resp_chunk_size,
-                           newest=newest)
+                           newest=newest, headers=headers)
 
     def put_object(self, container, obj, contents, content_length=None,
                    etag=None, chunk_size=65536, content_type=None,
@@ -873,4 +1225,24 @@ def connect(conf):
     region = conf.string('swift', 'region', 'USA')
     snet = conf.bool('swift', 'snet', False)
     retries = conf.int('swift', 'retries', 5)
-    return Connection(auth_url, user, key, region, retries=retries, snet=snet)
+    connect_timeout = conf.float('swift', 'connect_timeout', CONNECT_TIMEOUT)
+    read_timeout = conf.float('swift', 'read_timeout', READ_TIMEOUT)
+    token_cache = None
+    if conf.bool('swift', 'token_cache', True):
+        run_dir = conf.string('storage', 'run_dir', conf.path('run'))
+        token_cache = TokenCache(os.path.join(run_dir, 'auth_tokens'),
+                                 ttl=conf.int('swift', 'token_ttl', TOKEN_TTL))
+    pool = None
+    pool_size = conf.int('swift', 'pool_size', POOL_SIZE)
+    if pool_size:
+        pool = get_pool(pool_size, conf.int('swift', 'pool_idle_timeout',
+                                            POOL_IDLE_TIMEOUT))
+    hedge = None
+    percentile = conf.float('swift', 'hedge_percentile', 0)
+    if percentile:
+        hedge = get_policy(percentile, conf.float('swift', 'hedge_min_delay',
+                                                  HEDGE_MIN_DELAY))
+    return Connection(auth_url, user, key, region, retries=retries, snet=snet,
+                      token_cache=token_cache, pool=pool,
+                      connect_timeout=connect_timeout,
+                      read_timeout=read_timeout, hedge=hedge)
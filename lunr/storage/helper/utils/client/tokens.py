@@ -0,0 +1,91 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Auth tokens shared by every process on the node.
+
+Every save, restore and audit process makes connections of its own, and
+each of them used to authenticate before its first request.  The cache
+keeps the storage url and token for each auth url, user and region in a
+locked file in the run dir.  A process only authenticates when there's no
+token or it has expired, and does so holding the lock, so the others wait
+for its token rather than authenticating as well.  A token swift rejects
+is dropped for every process, and replaced once.
+"""
+
+from hashlib import md5
+import os
+from time import time
+
+from lunr.common.lock import JsonLockFile
+
+# Seconds a token is used before authenticating again
+TTL = 60 * 60
+
+
+def cache_key(authurl, user, region, snet=False):
+    return md5('\n'.join([authurl, user, region, str(bool(snet))])).hexdigest()
+
+
+class TokenCache(object):
+
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _open(self):
+        lock = JsonLockFile(self.path)
+        # tokens are as good as the key they came from
+        os.fchmod(lock.fd, 0600)
+        return lock
+
+    def get(self, key, auth):
+        """
+        The (storage url, token) cached under key, auth() is called for a
+        new pair if there isn't one or it has expired.
+        """
+        lock = self._open()
+        try:
+            with lock:
+                tokens = lock.read()
+                now = time()
+                entry = tokens.get(key)
+                if entry and entry['expires'] > now:
+                    return str(entry['url']), str(entry['token'])
+                url, token = auth()
+                tokens = dict((k, v) for k, v in tokens.items()
+                              if v['expires'] > now)
+                tokens[key] = {'url': url, 'token': token,
+                               'expires': now + self.ttl}
+                lock.write(tokens)
+                return url, token
+        finally:
+            lock.close()
+
+    def invalidate(self, key, token):
+        """
+        Drop token, swift rejected it.  If another process has already
+        replaced it the new one is kept.
+        """
+        lock = self._open()
+        try:
+            with lock:
+                tokens = lock.read()
+                entry = tokens.get(key)
+                if entry and entry['token'] == token:
+                    del tokens[key]
+                    lock.write(tokens)
+        finally:
+            lock.close()
@@ -0,0 +1,149 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compressed block bodies.
+
+A body starts with MAGIC and the id of the codec the rest of it was
+compressed with.  Bodies written before codecs were recorded are plain lz4,
+which starts with the little endian uncompressed length.  That is never
+more than MAX_BLOCK_SIZE, far less than MAGIC would decode to, so the two
+can't be confused.
+"""
+
+import struct
+import zlib
+
+import lz4
+
+MAGIC = 'LBLK'
+HEADER = struct.Struct('<4sB')
+
+RAW = 'raw'
+LZ4 = 'lz4'
+ZLIB = 'zlib'
+CODECS = (RAW, LZ4, ZLIB)
+_CODEC_IDS = {RAW: 0, LZ4: 1, ZLIB: 2}
+_CODEC_NAMES = dict((v, k) for k, v in _CODEC_IDS.items())
+
+# Bytes at the start of a block compressed to decide if the rest is worth it
+SAMPLE_SIZE = 64 * 1024
+# Store the block raw unless the sample shrinks below this fraction
+MAX_RATIO = 0.9
+
+
+class CodecError(ValueError):
+    pass
+
+
+def validate_codec(codec):
+    if codec not in CODECS:
+        raise CodecError('Unknown codec %s, must be one of %s' %
+                         (codec, ', '.join(CODECS)))
+    return codec
+
+
+def _compress(codec, data):
+    if codec == LZ4:
+        return lz4.compress(data)
+    return zlib.compress(data)
+
+
+def compress(data, codec=LZ4, sample_size=SAMPLE_SIZE, max_ratio=MAX_RATIO):
+    """
+    Body for data, which may be a buffer.  Returns the codec actually used
+    along with the body, data that doesn't compress is stored raw.
+    """
+    validate_codec(codec)
+    if codec != RAW and len(data) > sample_size:
+        sample = buffer(data, 0, sample_size)
+        if len(_compress(codec, sample)) > sample_size * max_ratio:
+            codec = RAW
+    if codec != RAW:
+        payload = _compress(codec, data)
+        if len(payload) >= len(data):
+            codec = RAW
+    if codec == RAW:
+        payload = str(data)
+    return codec, HEADER.pack(MAGIC, _CODEC_IDS[codec]) + payload
+
+
+def codec_of(body):
+    if body[:len(MAGIC)] != MAGIC:
+        return LZ4
+    _magic, codec_id = HEADER.unpack_from(body)
+    try:
+        return _CODEC_NAMES[codec_id]
+    except KeyError:
+        raise CodecError('Unknown codec id %s' % codec_id)
+
+
+def decompress(body):
+    if body[:len(MAGIC)] != MAGIC:
+        # written before codecs were recorded
+        return lz4.decompress(body)
+    codec = codec_of(body)
+    payload = buffer(body, HEADER.size)
+    if codec == LZ4:
+        return lz4.decompress(payload)
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    return str(payload)
+
+
+class Decompressor(object):
+    """
+    Decompress a body as it arrives, feed() it the pieces in order and
+    finish() returns the data.  Raw and zlib bodies are decompressed a piece
+    at a time, the whole body is never held at once.  lz4 can only be
+    decompressed once all of it has arrived.
+    """
+
+    def __init__(self):
+        self.codec = None
+        self._head = ''
+        self._zlib = None
+        self._pieces = []
+
+    def feed(self, data):
+        if self.codec is None:
+            self._head += data
+            if len(self._head) < HEADER.size:
+                return
+            data, self._head = self._head, ''
+            if data[:len(MAGIC)] != MAGIC:
+                # written before codecs were recorded
+                self.codec = LZ4
+            else:
+                self.codec = codec_of(data)
+                data = data[HEADER.size:]
+                if self.codec == ZLIB:
+                    self._zlib = zlib.decompressobj()
+        if self.codec == ZLIB:
+            self._pieces.append(self._zlib.decompress(data))
+        else:
+            self._pieces.append(data)
+
+    def finish(self):
+        if self.codec is None:
+            # too short to have had a header
+            return decompress(self._head)
+        if self.codec == ZLIB:
+            self._pieces.append(self._zlib.flush())
+        data = ''.join(self._pieces)
+        self._pieces = []
+        if self.codec == LZ4:
+            return lz4.decompress(data)
+        return data
@@ -0,0 +1,132 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sub-block deltas.
+
+A delta object stores only the sub-chunks of a block which differ from
+its parent block, it is named by the hash of the whole new block like any
+other block object.  The body is::
+
+    magic, parent hash length, sub chunk size, block length, count
+    parent hash
+    count sub chunk indexes
+    compressed sub chunks, see compression.compress
+
+A legacy lz4 body starts with the little endian uncompressed length, the
+magic would decode to a length far past the largest block size so the two
+can't be confused.
+"""
+
+import hashlib
+import struct
+
+from lunr.storage.helper.utils.compression import LZ4, compress, decompress
+
+MAGIC = 'LDLT'
+HEADER = struct.Struct('<4sBIII')
+INDEX = struct.Struct('<I')
+# Fingerprints start with the sub chunk size they were taken with
+PREFIX = struct.Struct('<I')
+# Bytes of each sub-chunk's unsalted md5 kept as its fingerprint, a changed
+# sub-chunk whose fingerprint collides with the old one is left out
+FINGERPRINT_SIZE = 8
+
+
+class DeltaError(Exception):
+    pass
+
+
+def fingerprint(data, sub_chunk_size):
+    """
+    Concatenated fingerprints of each sub_chunk_size piece of data.
+    """
+    prints = [PREFIX.pack(sub_chunk_size)]
+    for offset in xrange(0, len(data), sub_chunk_size):
+        piece = buffer(data, offset, sub_chunk_size)
+        prints.append(hashlib.md5(piece).digest()[:FINGERPRINT_SIZE])
+    return ''.join(prints)
+
+
+def chunk_count(prints):
+    return (len(prints) - PREFIX.size) // FINGERPRINT_SIZE
+
+
+def diff(old, new):
+    """
+    Indexes of the sub-chunks whose fingerprints differ, None if the two
+    weren't taken the same way from blocks of the same length.
+    """
+    if len(old) != len(new) or old[:PREFIX.size] != new[:PREFIX.size]:
+        return None
+    indexes = []
+    for i in xrange(chunk_count(new)):
+        start = PREFIX.size + i * FINGERPRINT_SIZE
+        if old[start:start + FINGERPRINT_SIZE] != \
+                new[start:start + FINGERPRINT_SIZE]:
+            indexes.append(i)
+    return indexes
+
+
+def is_delta(body):
+    return body[:len(MAGIC)] == MAGIC
+
+
+def encode(parent, sub_chunk_size, data, indexes, codec=LZ4):
+    """
+    Build a delta body from the sub-chunks at indexes in data, returns the
+    codec the sub-chunks were compressed with and the body.
+    """
+    # hashes out of the manifest json are unicode
+    parent = str(parent)
+    pieces = [data[i * sub_chunk_size:(i + 1) * sub_chunk_size]
+              for i in indexes]
+    header = HEADER.pack(MAGIC, len(parent), sub_chunk_size, len(data),
+                         len(indexes))
+    codec, payload = compress(''.join(pieces), codec)
+    return codec, ''.join([header, parent] +
+                          [INDEX.pack(i) for i in indexes] + [payload])
+
+
+class Delta(object):
+
+    def __init__(self, body):
+        try:
+            (magic, parent_len, self.sub_chunk_size, self.length,
+             count) = HEADER.unpack_from(body)
+        except struct.error, e:
+            raise DeltaError('Short delta header: %s' % e)
+        if magic != MAGIC:
+            raise DeltaError('Not a delta')
+        offset = HEADER.size
+        self.parent = body[offset:offset + parent_len]
+        offset += parent_len
+        self.indexes = [INDEX.unpack_from(body, offset + i * INDEX.size)[0]
+                        for i in xrange(count)]
+        offset += count * INDEX.size
+        self._data = body[offset:]
+
+    def apply(self, pool, slab):
+        """
+        Patch the parent block already in the slab with our sub-chunks.
+        """
+        data = decompress(self._data)
+        position = 0
+        for index in self.indexes:
+            start = index * self.sub_chunk_size
+            size = min(self.sub_chunk_size, self.length - start)
+            pool.patch(slab, start, data[position:position + size])
+            position += size
+        pool.truncate(slab, self.length)
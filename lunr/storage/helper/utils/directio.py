@@ -14,7 +14,8 @@
 # limitations under the License.
 
 from ctypes import cdll, util, c_int, c_void_p, c_size_t, \
-    c_uint64, byref, get_errno, CDLL, string_at, memmove, c_char_p
+    c_uint64, byref, get_errno, CDLL, string_at, memmove, c_char_p, \
+    c_ssize_t, c_int64
 import os
 import io
 import resource
@@ -22,6 +23,10 @@ import resource
 
 libc = CDLL(util.find_library('c'), use_errno=True)
 
+_pwrite = libc.pwrite
+_pwrite.argtypes = [c_int, c_void_p, c_size_t, c_int64]
+_pwrite.restype = c_ssize_t
+
 
 def open(path, mode='+', buffered=-1):
     if buffered == -1:
@@ -45,6 +50,20 @@ def open(path, mode='+', buffered=-1):
         "invalid mode: '%s', must contain atleast one (r,w,+)", mode)
 
 
+def pwrite(fd, address, length, offset):
+    """ write length bytes of memory at address to fd at offset, leaves
+        the file position alone """
+    written = 0
+    while written < length:
+        result = _pwrite(fd, address + written, length - written,
+                         offset + written)
+        if result < 0:
+            errno = get_errno()
+            raise OSError(errno, os.strerror(errno))
+        written += result
+    return written
+
+
 def size(device):
     """ return the size of the device in bytes
 
@@ -116,6 +135,18 @@ class RawDirect(io.RawIOBase):
                       "; length must be a multiple of %d" %
                       (length, self._byte_alignment))
 
+    def aligned(self, *values):
+        return not any(value % self._byte_alignment for value in values)
+
+    def pwrite(self, address, length, offset):
+        """ write straight from memory that is already aligned, such as a
+            slab, without copying it """
+        if self.aligned(address, length, offset):
+            return pwrite(self._fd, address, length, offset)
+        raise OSError(22, "Refusing to write %d bytes from %x to offset %d"
+                      "; all must be multiples of %d" %
+                      (length, address, offset, self._byte_alignment))
+
     def read(self, length=None):
         # If length is -1 or None, call self.readall()
         if length == -1 or length is None:
@@ -0,0 +1,346 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deduplication domains.
+
+Volumes in a domain share a salt, and so block hashes, and store their
+blocks in the domain's container instead of their own.  Each volume keeps
+its manifest in its own container, the domain container holds the blocks
+and a few registry objects, all named with the 'domain.' prefix so they
+can never be mistaken for a block:
+
+    domain.info             salt, hash algorithm and block size shared by
+                            every member
+    domain.member.<id>      one for each volume with backups in the domain,
+                            or its first save in progress
+    domain.saving.<id>      one for each member with a save in progress
+    domain.audit            the member auditing the domain, if any
+    domain.swept            when the domain's container was last swept
+
+A block may only be deleted when no member's manifest references it, and
+while no member is saving, since a save may already have skipped uploading
+a block it found referenced by another member.  An audit registers itself
+before looking for saves, and looks again before it deletes anything, while
+a save waits for a registered audit to finish.  Container listings are only
+eventually consistent, so a save joins the domain before it registers and
+an audit reads every member's save marker by name rather than trusting the
+listing to show it.  Two members that register an audit at once both read
+the audit marker back, and only the one that wrote it last goes ahead.
+Saves and audits refresh their markers on a heartbeat, one that stops being
+refreshed was left behind by a save or audit that died.
+
+Every save reads each member's manifest to find the blocks it needn't
+upload.  Given a cache_dir the domain keeps a local copy of each of them,
+only downloaded again once swift's copy has changed.
+"""
+
+import errno
+import json
+import os
+import shutil
+from time import sleep, time
+
+from lunr.common import logger
+from lunr.storage.helper.utils.client.listing import container_pages
+from lunr.storage.helper.utils.manifest import fetch_manifest
+
+PREFIX = 'domain'
+INFO = 'domain.info'
+MEMBER = 'domain.member.'
+SAVING = 'domain.saving.'
+AUDIT = 'domain.audit'
+SWEPT = 'domain.swept'
+# Seconds between refreshes of the marker of a save or audit in progress
+HEARTBEAT_INTERVAL = 60
+# A marker not refreshed for this long was left behind by one that died
+MARKER_EXPIRY = 10 * HEARTBEAT_INTERVAL
+# Seconds a save waits between checks for an audit to finish
+AUDIT_POLL_INTERVAL = 10
+
+
+def domain_container(dedup_domain, account=None, volume_type=None):
+    """
+    Name of the container for the configured kind of dedup domain, None if
+    the volume isn't in one.
+    """
+    if dedup_domain == 'account' and account:
+        return 'dedup-account-%s' % account
+    if dedup_domain == 'volume_type' and volume_type:
+        return 'dedup-type-%s' % volume_type
+    return None
+
+
+class DedupDomain(object):
+
+    def __init__(self, conn, container, cache_dir=None):
+        self.conn = conn
+        self.container = container
+        self.cache_dir = cache_dir
+        # markers we hold -> (when we last refreshed them, owner)
+        self._marked = {}
+
+    def _listing(self, prefix):
+        names = []
+        for listing in container_pages(self.conn, self.container,
+                                       prefix=prefix):
+            names.extend(obj['name'] for obj in listing
+                         if obj['name'].startswith(prefix))
+        return names
+
+    def info(self):
+        try:
+            _headers, body = self.conn.get_object(self.container, INFO,
+                                                  newest=True)
+        except self.conn.ClientException, e:
+            if e.http_status != 404:
+                raise
+            return None
+        return json.loads(body)
+
+    @property
+    def block_size(self):
+        """
+        Block size new members should use, None until the domain has one.
+        """
+        info = self.info()
+        if info:
+            return info['block_size']
+        return None
+
+    def adopt(self, manifest, volume_id):
+        """
+        Set up a new manifest for volume_id to store its blocks in the
+        domain, the first volume decides the salt, hash algorithm and block
+        size.  The volume joins once its first backup is saved.
+        """
+        self.conn.put_container(self.container)
+        info = self.info()
+        if info is None:
+            info = {
+                'salt': manifest.salt,
+                'hash_algorithm': manifest.hash_algorithm,
+                'block_size': manifest.block_size,
+            }
+            self.conn.put_object(self.container, INFO, json.dumps(info))
+        manifest['salt'] = str(info['salt'])
+        manifest['hash_algorithm'] = str(info['hash_algorithm'])
+        if manifest.block_size != info['block_size']:
+            logger.warning('Volume %s block size %s does not match '
+                           'domain %s, its blocks will not be shared' %
+                           (volume_id, manifest.block_size, self.container))
+        manifest['domain'] = self.container
+        # lets an audit find the domain after the manifest is gone
+        self.conn.put_object(volume_id, PREFIX, self.container)
+
+    def join(self, volume_id):
+        self.conn.put_object(self.container, MEMBER + volume_id, volume_id)
+
+    def leave(self, volume_id):
+        try:
+            self.conn.delete_object(self.container, MEMBER + volume_id)
+        except self.conn.ClientException, e:
+            if e.http_status != 404:
+                raise
+
+    def members(self):
+        return [name[len(MEMBER):] for name in self._listing(MEMBER)]
+
+    def _mark(self, name, owner=''):
+        now = time()
+        self.conn.put_object(self.container, name,
+                             ('%r %s' % (now, owner)).strip())
+        self._marked[name] = (now, owner)
+
+    def _unmark(self, name):
+        self._marked.pop(name, None)
+        try:
+            self.conn.delete_object(self.container, name)
+        except self.conn.ClientException, e:
+            if e.http_status != 404:
+                raise
+
+    def _read_marker(self, name):
+        """
+        When the marker was last refreshed and who by, None if it's gone.
+        """
+        try:
+            _headers, body = self.conn.get_object(self.container, name,
+                                                  newest=True)
+        except self.conn.ClientException, e:
+            if e.http_status != 404:
+                raise
+            return None
+        parts = body.split(' ', 1)
+        return float(parts[0]), (parts[1:] or [''])[0]
+
+    def heartbeat(self):
+        """
+        Refresh the markers we hold, called often by a save or audit while
+        it works.  Returns False if another member took over one of them.
+        """
+        held = True
+        now = time()
+        for name, (marked, owner) in self._marked.items():
+            if now - marked < HEARTBEAT_INTERVAL:
+                continue
+            if owner:
+                marker = self._read_marker(name)
+                if not marker or marker[1] != owner:
+                    logger.warning('%s of domain %s was taken over from %s' %
+                                   (name, self.container, owner))
+                    del self._marked[name]
+                    held = False
+                    continue
+            self._mark(name, owner)
+        return held
+
+    def start_save(self, volume_id, poll_interval=AUDIT_POLL_INTERVAL):
+        """
+        Register a save of volume_id, waiting for an audit of the domain to
+        finish first.  The audit looks for saves again before deleting
+        anything, so it gives up rather than keep us waiting.
+        """
+        # audits look for the save markers of members by name
+        self.join(volume_id)
+        self._mark(SAVING + volume_id)
+        while True:
+            auditor = self.auditing()
+            if not auditor:
+                return
+            logger.info('Save of %s waiting for the audit of domain %s by '
+                        '%s' % (volume_id, self.container, auditor))
+            sleep(poll_interval)
+            self.heartbeat()
+
+    def finish_save(self, volume_id):
+        self._unmark(SAVING + volume_id)
+
+    def saving(self, expiry=MARKER_EXPIRY):
+        """
+        Members with a save in progress.
+        """
+        members = []
+        now = time()
+        # the listing may not show a marker yet, but it may show a save
+        # that hasn't joined
+        names = set(SAVING + volume_id for volume_id in self.members())
+        names.update(self._listing(SAVING))
+        for name in sorted(names):
+            marker = self._read_marker(name)
+            if not marker:
+                continue
+            volume_id = name[len(SAVING):]
+            if now - marker[0] < expiry:
+                members.append(volume_id)
+                continue
+            logger.warning('Removing save marker of %s from domain %s, not '
+                           'refreshed for %ds' % (volume_id, self.container,
+                                                  now - marker[0]))
+            self._unmark(name)
+        return members
+
+    def auditing(self, expiry=MARKER_EXPIRY):
+        """
+        The member auditing the domain, None if no audit is in progress.
+        """
+        marker = self._read_marker(AUDIT)
+        if marker and time() - marker[0] < expiry:
+            return marker[1]
+        return None
+
+    def start_audit(self, volume_id):
+        """
+        Register an audit of the domain by volume_id, False if another
+        member is already auditing it.
+        """
+        auditor = self.auditing()
+        if auditor and auditor != volume_id:
+            return False
+        self._mark(AUDIT, volume_id)
+        if not self.holds_audit(volume_id):
+            # another member registered at the same time, and won
+            self._marked.pop(AUDIT, None)
+            return False
+        return True
+
+    def holds_audit(self, volume_id):
+        """
+        True if volume_id's audit is still the one registered.
+        """
+        marker = self._read_marker(AUDIT)
+        return AUDIT in self._marked and bool(marker) and \
+            marker[1] == volume_id
+
+    def finish_audit(self, volume_id):
+        marker = self._read_marker(AUDIT)
+        if marker and marker[1] == volume_id:
+            self._unmark(AUDIT)
+        self._marked.pop(AUDIT, None)
+
+    def last_swept(self):
+        marker = self._read_marker(SWEPT)
+        if not marker:
+            return 0
+        return marker[0]
+
+    def swept(self, ts):
+        self.conn.put_object(self.container, SWEPT, repr(ts))
+
+    def block_set(self):
+        """
+        Every block referenced by a member's manifest.
+        """
+        blocks = set()
+        members = self.members()
+        for volume_id in members:
+            cache_file = None
+            if self.cache_dir:
+                cache_file = os.path.join(self.cache_dir, volume_id)
+            try:
+                manifest = fetch_manifest(self.conn, volume_id,
+                                          cache_file=cache_file)
+            except self.conn.ClientException, e:
+                if e.http_status != 404:
+                    raise
+                logger.warning('Domain %s member %s has no manifest' %
+                               (self.container, volume_id))
+                continue
+            blocks |= manifest.block_set
+        self._prune_cache(members)
+        return blocks
+
+    def _prune_cache(self, members):
+        """
+        Remove the local copies of the manifests of volumes that left.
+        """
+        if not self.cache_dir:
+            return
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.endswith('.d') or name in members:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            shutil.rmtree(path + '.d', ignore_errors=True)
@@ -0,0 +1,82 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Journal of the blocks a prune left without references.
+
+A prune knows exactly which blocks the backup it deleted was the last to
+reference, so it deletes just those instead of leaving them for an audit to
+find by listing the whole container.  The blocks go in the journal before
+the manifest without them is saved, and each batch comes out once its
+blocks are deleted.  A prune or audit which finds batches left behind by one
+that died finishes them, checking each block against the manifest first in
+case it died before the manifest was saved.
+
+The journal also records when an audit last listed the whole container, so
+audits only do that every so often to catch anything else.
+"""
+
+from contextlib import contextmanager
+
+from lunr.common.lock import JsonLockFile
+
+# Seconds between audits listing the whole container, 0 lists it every time
+SWEEP_INTERVAL = 7 * 24 * 60 * 60
+
+
+class GCJournal(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _data(self):
+        lock = JsonLockFile(self.path)
+        try:
+            with lock:
+                data = lock.read()
+                yield data
+                lock.write(data)
+        finally:
+            lock.close()
+
+    def batches(self):
+        """
+        The batches still to be deleted, as [timestamp, container, hashes].
+        """
+        with self._data() as data:
+            return data.get('batches', [])
+
+    def add(self, container, hashes, ts):
+        """
+        Record the blocks a prune at ts left unreferenced, before the
+        manifest is saved.
+        """
+        with self._data() as data:
+            data.setdefault('batches', []).append(
+                [ts, container, sorted(hashes)])
+
+    def done(self, ts):
+        with self._data() as data:
+            data['batches'] = [batch for batch in data.get('batches', [])
+                               if batch[0] != ts]
+
+    def last_swept(self):
+        with self._data() as data:
+            return data.get('swept', 0)
+
+    def swept(self, ts):
+        with self._data() as data:
+            data['swept'] = ts
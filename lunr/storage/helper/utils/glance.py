@@ -24,19 +24,22 @@ import glanceclient.exc as glance_exc
 from lunr.common.exc import HTTPClientError
 from lunr.common import logger
 
+# Seconds an auth request may block on its socket
+TIMEOUT = 240
+
 
 class GlanceError(Exception):
     pass
 
 
-def request(method, path, headers=None, data=None):
+def request(method, path, headers=None, data=None, timeout=TIMEOUT):
     """
     How many times must I write this function before I just add requests
     to our pip requires?
     """
     req = urllib2.Request(path, headers=headers, data=data)
     req.get_method = lambda *args: method
-    resp = urllib2.urlopen(req)
+    resp = urllib2.urlopen(req, timeout=timeout)
     data = resp.read()
     logger.debug(
         "%s on %s succeeded with %s" %
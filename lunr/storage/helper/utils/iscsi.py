@@ -19,6 +19,7 @@ import json
 import logging
 from lunr.common import logger
 from lunr.storage.helper.utils import execute, ProcessError
+from lunr.storage.helper.utils.budget import CLONE, READ, NETWORK
 
 import os
 import time
@@ -79,17 +80,18 @@ class ISCSIDevice(object):
         if not self.connected:
             raise ISCSINotConnected("ISCSI device doesn't exist")
 
-    def copy_file_out(self, path, callback=None):
+    def copy_file_out(self, path, callback=None, budget=None):
         """ copy file to the iscsi device """
         try:
-            self.copy_volume(path, self.device, callback=callback)
+            self.copy_volume(path, self.device, callback=callback,
+                             budget=budget)
         except IOError, e:
             logger.exception("copy_file_out failed with '%s'" % e)
             raise ISCSICopyFailed()
 
     @staticmethod
     def copy_volume(src_volume, dest_volume, block_size=4194304,
-                    callback=None):
+                    callback=None, budget=None):
         src, dest = None, None
         try:
             src = os.open(src_volume, os.O_RDONLY)
@@ -105,7 +107,12 @@ class ISCSIDevice(object):
                     logger.debug('cur_pos = %s (%d%%)' % (block, percent))
                     if callback:
                         callback(percent)
-                os.write(dest, os.read(src, block_size))
+                data = os.read(src, block_size)
+                if budget:
+                    # the destination is on another node
+                    budget.take(CLONE, READ, len(data))
+                    budget.take(CLONE, NETWORK, len(data))
+                os.write(dest, data)
         finally:
             if dest:
                 try:
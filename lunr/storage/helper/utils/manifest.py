@@ -13,9 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bisect import bisect_left, bisect_right
+from array import array
+from base64 import b64encode, b64decode
+from binascii import hexlify, unhexlify
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, Mapping, MutableMapping
 import errno
 import fcntl
+from hashlib import md5
+import shutil
+import struct
+import sys
+from threading import Thread
 from time import time
 import json
 from StringIO import StringIO
@@ -24,11 +33,50 @@ from uuid import UUID
 
 from lunr.common import logger
 from lunr.storage.helper.utils import NotFound
+from lunr.storage.helper.utils.blockhash import DIGEST_SIZE, MD5, \
+    validate_algorithm
 
 MOST_RECENT = float('inf')
 
 EMPTY_BLOCK = ''  # TODO: import this from block hash/salt magic
 
+# Version 1.0 manifests don't record a block size, they are all 4 MB.
+DEFAULT_BLOCK_SIZE = 4 * 1024 ** 2
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 64 * 1024 ** 2
+
+# Diffs between the replays a manifest keeps to start later replays from
+REPLAY_INTERVAL = 16
+
+# Version 2.0 manifests are binary, see Manifest.
+MAGIC = 'LMF2'
+HEADER = struct.Struct('<4sI')
+EMPTY_DIGEST = '\x00' * DIGEST_SIZE
+BLOCKNO_TYPE = 'I'
+# Objects holding the tables of a sharded manifest, named for their md5
+SEGMENT_PREFIX = 'manifest.'
+# Segments downloaded at once when loading a manifest
+SEGMENT_FETCHERS = 4
+# Kinds of table
+HASHES = 'hashes'
+DIFF = 'diff'
+PRINTS = 'fingerprints'
+JSON = 'json'
+
+
+def validate_block_size(block_size):
+    """
+    Block sizes must be a power of two between MIN_BLOCK_SIZE and
+    MAX_BLOCK_SIZE, which keeps every block page aligned on the volume.
+    """
+    block_size = int(block_size)
+    if block_size < MIN_BLOCK_SIZE or block_size > MAX_BLOCK_SIZE or \
+            block_size & (block_size - 1):
+        raise ValueError('Invalid block size %s, must be a power of two '
+                         'between %s and %s' % (block_size, MIN_BLOCK_SIZE,
+                                                MAX_BLOCK_SIZE))
+    return block_size
+
 
 def convert_numeric_keys(d):
     n = {}
@@ -44,15 +92,6 @@ def convert_numeric_keys(d):
     return n
 
 
-def _clear_cache(f):
-    def wrapper(self, *args, **kwargs):
-        if hasattr(self, '_history'):
-            del self._history
-        return f(self, *args, **kwargs)
-    wrapper.__name__ = f.__name__
-    return wrapper
-
-
 class InvalidTimestampError(Exception):
     pass
 
@@ -77,6 +116,313 @@ class ManifestVersionError(Exception):
     pass
 
 
+class PackedHashes(object):
+    """
+    The hashes of a version 2.0 base, left packed in the manifest body and
+    only turned into hex as they are read.  The first change unpacks them
+    into a list.
+    """
+
+    def __init__(self, digests):
+        self._digests = digests
+        self._list = None
+
+    def __len__(self):
+        if self._list is not None:
+            return len(self._list)
+        return len(self._digests) // DIGEST_SIZE
+
+    def _hash(self, offset):
+        return _hexlify(self._digests[offset:offset + DIGEST_SIZE])
+
+    def __getitem__(self, index):
+        if self._list is not None:
+            return self._list[index]
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('hash index out of range')
+        return self._hash(index * DIGEST_SIZE)
+
+    def __iter__(self):
+        if self._list is not None:
+            return iter(self._list)
+        return (self._hash(offset) for offset in
+                xrange(0, len(self._digests), DIGEST_SIZE))
+
+    def __setitem__(self, index, hash_):
+        if self._list is None:
+            self._list = list(self)
+        self._list[index] = hash_
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def packed(self):
+        """
+        The digests, None if they've changed since they were loaded.
+        """
+        if self._list is not None:
+            return None
+        return str(self._digests)
+
+
+class PackedDiff(MutableMapping):
+    """
+    A version 2.0 diff, block numbers sorted in an array alongside their
+    packed digests.  The first change unpacks it into a dict.
+    """
+
+    def __init__(self, blocknos, digests):
+        self._blocknos = blocknos
+        self._digests = digests
+        self._dict = None
+
+    def _hash(self, i):
+        offset = i * DIGEST_SIZE
+        return _hexlify(self._digests[offset:offset + DIGEST_SIZE])
+
+    def __getitem__(self, blockno):
+        if self._dict is not None:
+            return self._dict[blockno]
+        i = bisect_left(self._blocknos, blockno)
+        if i < len(self._blocknos) and self._blocknos[i] == blockno:
+            return self._hash(i)
+        raise KeyError(blockno)
+
+    def _unpack(self):
+        if self._dict is None:
+            self._dict = dict(self.iteritems())
+
+    def __setitem__(self, blockno, hash_):
+        self._unpack()
+        self._dict[blockno] = hash_
+
+    def __delitem__(self, blockno):
+        self._unpack()
+        del self._dict[blockno]
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+        return iter(self._blocknos)
+
+    def __len__(self):
+        if self._dict is not None:
+            return len(self._dict)
+        return len(self._blocknos)
+
+    def iteritems(self):
+        if self._dict is not None:
+            return self._dict.iteritems()
+        return ((blockno, self._hash(i))
+                for i, blockno in enumerate(self._blocknos))
+
+    def itervalues(self):
+        return (hash_ for _blockno, hash_ in self.iteritems())
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def packed(self):
+        """
+        The block numbers and digests, None if they've changed since they
+        were loaded.
+        """
+        if self._dict is not None:
+            return None
+        return _blocknos_string(self._blocknos), str(self._digests)
+
+
+class PackedFingerprints(Mapping):
+    """
+    The sub-chunk fingerprints of a version 2.0 manifest, the sorted
+    digests of the chunks followed by an array of the length of each one's
+    fingerprints and then the fingerprints.  A lookup searches the digests,
+    and fingerprints are only copied out as they're read.
+    """
+
+    def __init__(self, data, count):
+        self._data = data
+        self._count = count
+        itemsize = array(BLOCKNO_TYPE).itemsize
+        start = count * DIGEST_SIZE
+        lengths = _blocknos_array(data[start:start + count * itemsize])
+        self._offsets = array('L', [start + count * itemsize])
+        for length in lengths:
+            self._offsets.append(self._offsets[-1] + length)
+
+    def _digest(self, i):
+        offset = i * DIGEST_SIZE
+        return self._data[offset:offset + DIGEST_SIZE]
+
+    def _index(self, hash_):
+        digest = _pack([hash_])
+        if digest is None:
+            return None
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._digest(lo) == digest:
+            return lo
+        return None
+
+    def __getitem__(self, hash_):
+        i = self._index(hash_)
+        if i is None:
+            raise KeyError(hash_)
+        return self._data[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self):
+        return (_hexlify(self._digest(i)) for i in xrange(self._count))
+
+    def __len__(self):
+        return self._count
+
+    def iteritems(self):
+        for i in xrange(self._count):
+            yield (_hexlify(self._digest(i)),
+                   self._data[self._offsets[i]:self._offsets[i + 1]])
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def packed(self):
+        return str(self._data)
+
+
+class _Deferred(object):
+    """
+    A table left in its segment until it's needed, which a save names
+    again without uploading it if it never was.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    @property
+    def name(self):
+        return self.table[4]
+
+
+def _hexlify(digest):
+    if digest == EMPTY_DIGEST:
+        return EMPTY_BLOCK
+    return hexlify(digest)
+
+
+def _pack(hashes):
+    """
+    Concatenated digests of hashes, None if any of them isn't the hex of a
+    digest.
+    """
+    digests = []
+    for hash_ in hashes:
+        if hash_ == EMPTY_BLOCK:
+            digests.append(EMPTY_DIGEST)
+            continue
+        if len(hash_) != DIGEST_SIZE * 2:
+            return None
+        try:
+            digest = unhexlify(hash_)
+        except TypeError:
+            return None
+        # upper case, or one that would read back as the empty block
+        if hexlify(digest) != hash_ or digest == EMPTY_DIGEST:
+            return None
+        digests.append(digest)
+    return ''.join(digests)
+
+
+def _blocknos_string(blocknos):
+    if sys.byteorder == 'big':
+        blocknos = array(BLOCKNO_TYPE, blocknos)
+        blocknos.byteswap()
+    return blocknos.tostring()
+
+
+def _blocknos_array(data):
+    blocknos = array(BLOCKNO_TYPE)
+    blocknos.fromstring(data)
+    if sys.byteorder == 'big':
+        blocknos.byteswap()
+    return blocknos
+
+
+def _encode_table(value):
+    """
+    The kind of table and its bytes for a base or a diff.
+    """
+    if isinstance(value, (PackedHashes, PackedDiff)):
+        packed = value.packed()
+        if isinstance(value, PackedHashes) and packed is not None:
+            return HASHES, len(value), packed
+        if packed is not None:
+            return DIFF, len(value), ''.join(packed)
+    if isinstance(value, (list, PackedHashes)):
+        packed = _pack(value)
+        if packed is not None:
+            return HASHES, len(value), packed
+    else:
+        try:
+            blocknos = array(BLOCKNO_TYPE, sorted(value))
+        except (TypeError, OverflowError):
+            blocknos = None
+        if blocknos is not None:
+            packed = _pack(value[blockno] for blockno in blocknos)
+            if packed is not None:
+                return DIFF, len(blocknos), \
+                    _blocknos_string(blocknos) + packed
+    # hashes from tests and the like, that aren't digests
+    return JSON, len(value), json.dumps(value, default=_plain)
+
+
+def _encode_fingerprints(value):
+    """
+    The kind of table and its bytes for a mapping of fingerprints.
+    """
+    if isinstance(value, PackedFingerprints):
+        return PRINTS, len(value), value.packed()
+    items = sorted(value.iteritems())
+    digests = _pack(h for h, _f in items)
+    if digests is None:
+        # hashes from tests and the like, that aren't digests
+        return JSON, len(items), json.dumps(
+            [[h, b64encode(f)] for h, f in items])
+    lengths = array(BLOCKNO_TYPE, (len(f) for _h, f in items))
+    return PRINTS, len(items), ''.join(
+        [digests, _blocknos_string(lengths)] + [f for _h, f in items])
+
+
+def _plain(value):
+    """
+    json default for the packed tables.
+    """
+    if isinstance(value, PackedHashes):
+        return list(value)
+    if isinstance(value, PackedDiff):
+        return dict(value.iteritems())
+    raise TypeError('%r is not JSON serializable' % value)
+
+
 class Manifest(dict):
     """
     A manifest is a description of how to replay a collection of
@@ -88,7 +434,7 @@ class Manifest(dict):
     the chunks which are different from the current backup and the
     previous backup.
 
-    There are four special keys.
+    There are five special keys.
 
     The first is the 'version' key, which identifies the version of the
     manifest.
@@ -102,6 +448,55 @@ class Manifest(dict):
 
     There is also a key 'backups' which maps backup_ids to timestamps.
 
+    Since version 1.1 the 'block_size' key is the size in bytes of each
+    chunk, version 1.0 manifests don't have one and are all 4 MB.
+
+    Volumes backed up with sub-block deltas have two more keys, 'deltas'
+    lists [hash, parent hash] for each chunk stored as a delta against
+    another chunk, and 'fingerprints' lists [hash, sub-chunk fingerprints]
+    for the chunks of the most recent backup.  Both are lists of pairs
+    rather than mappings so hashes never get mistaken for numeric keys.
+    Version 2.0 keeps the fingerprints in a table of their own instead.
+
+    Since version 1.2 the 'hash_algorithm' key names the algorithm new
+    chunks are hashed with, older manifests are all md5.  A volume which
+    changed algorithm also lists every algorithm its chunks may have been
+    hashed with under 'hash_algorithms'.
+
+    Since version 1.3 volumes in a deduplication domain have a 'domain'
+    key naming the container their chunks are stored in, which they share
+    with the other volumes in the domain.
+
+    Version 2.0 manifests have the same keys but aren't stored as json,
+    which spends 32 hex characters and a python string on every chunk.
+    The body is::
+
+        MAGIC, length of the json
+        json of the named keys, with 'tables' listing
+            [timestamp, kind, count, length] for the base and every diff
+        the tables one after the other
+
+    A 'hashes' table is the packed 16 byte digest of every chunk in the
+    base, a 'diff' table is a sorted array of uint32 little endian chunk
+    numbers followed by the packed digest of each.  An empty chunk is a
+    digest of zeros.  The 'fingerprints' table, after the base and diffs,
+    is the sorted digests of the chunks with fingerprints, an array of the
+    length of each one's fingerprints, then the fingerprints.  Hashes which
+    aren't hex digests are stored in a 'json' table.  The loaded tables are
+    PackedHashes, PackedDiffs and PackedFingerprints which point into the
+    body, hashes are only decoded as they're read.
+
+    A version 2.0 manifest saved to swift is sharded, each table is a
+    segment object of its own named SEGMENT_PREFIX and the md5 of the table,
+    and its entry in 'tables' is [timestamp, kind, count, length, segment
+    name].  The body, the root, is just the header and the json.  A diff
+    never changes once its backup is done and a segment's name is its
+    contents, so a save only uploads the segments of the new diff and of a
+    base rewritten by a prune, along with the root.  Only delta encoding
+    reads the fingerprints, so their segment isn't downloaded until they're
+    asked for.  A json manifest is still saved whole, nodes older than 2.0
+    couldn't load its segments either.
+
     Example::
 
         {
@@ -110,16 +505,32 @@ class Manifest(dict):
             103: {0: 'x02', 5: 'x01'},
             107: {0: 'x03', 1: 'x02'},
             'backups': {'id0': 100, 'id1': 101, 'id2': 103, 'id3': 107},
+            'block_size': 4194304,
         }
 
     To construct a full volume before a given time start with the list
     of chunks in the base and "replay" the diffs up until that time in
     accending order.
 
+    The most recent diff is the one being filled in by a backup, every
+    other is only changed through the manifest.  So along with the sorted
+    history the manifest keeps a count of the references to each chunk
+    from all but the most recent diff, and the replay up to every
+    REPLAY_INTERVAL'th diff.  All of them are kept up to date as diffs are
+    set and deleted, and built when they're first needed.
+
     """
 
-    VERSION = '1.0'
-    NAMED_KEYS = ['backups', 'version', 'salt']
+    VERSION = '1.3'
+    # nodes older than it can't read it, so a manifest is only stored this
+    # way once it's been upgraded
+    BINARY_VERSION = '2.0'
+    VERSIONS = ('1.0', '1.1', '1.2', '1.3', '2.0')
+    NAMED_KEYS = ['backups', 'version', 'salt', 'block_size', 'deltas',
+                  'fingerprints', 'hash_algorithm', 'hash_algorithms',
+                  'domain']
+    # named keys stored as tables by version 2.0, and only loaded when read
+    DEFERRED_KEYS = ['fingerprints']
 
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
@@ -143,6 +554,123 @@ class Manifest(dict):
         except KeyError:
             raise ManifestSaltError('Manifest has no salt')
 
+    @property
+    def block_size(self):
+        """Shortcut to key 'block_size'."""
+        return self.get('block_size', DEFAULT_BLOCK_SIZE)
+
+    @property
+    def domain(self):
+        """Container shared by the deduplication domain, if any."""
+        return self.get('domain')
+
+    @property
+    def hash_algorithm(self):
+        """Shortcut to key 'hash_algorithm'."""
+        return self.get('hash_algorithm', MD5)
+
+    @property
+    def hash_algorithms(self):
+        """Every algorithm the chunks in the manifest were hashed with."""
+        return self.get('hash_algorithms', [self.hash_algorithm])
+
+    def set_hash_algorithm(self, algorithm):
+        """
+        Hash new chunks with algorithm, chunks hashed with any other will
+        be uploaded again the next time they are backed up.
+        """
+        validate_algorithm(algorithm)
+        if algorithm == self.hash_algorithm:
+            return
+        algorithms = list(self.hash_algorithms)
+        if algorithm not in algorithms:
+            algorithms.append(algorithm)
+        self['hash_algorithms'] = algorithms
+        self['hash_algorithm'] = algorithm
+        if self.version.startswith('1.'):
+            self['version'] = self.VERSION
+
+    @property
+    def deltas(self):
+        """Mapping of delta chunk hashes to their parent's hash."""
+        return dict(self.get('deltas', []))
+
+    def add_deltas(self, deltas):
+        if not deltas:
+            return
+        merged = self.deltas
+        merged.update(deltas)
+        self['deltas'] = sorted([h, p] for h, p in merged.iteritems())
+
+    def delta_depth(self, hash_, deltas=None):
+        """Number of deltas that must be applied to rebuild the chunk."""
+        if deltas is None:
+            deltas = self.deltas
+        depth = 0
+        while hash_ in deltas:
+            hash_ = deltas[hash_]
+            depth += 1
+        return depth
+
+    def _load_deferred(self, key):
+        """
+        Load a table left in its segment, raises ManifestParseError if
+        there's no way to.
+        """
+        deferred = self[key]
+        fetch = getattr(self, '_fetch_segment', None)
+        if not fetch:
+            raise ManifestParseError('Manifest segment %s is missing' %
+                                     deferred.name)
+        data = fetch(deferred.name)
+        key, kind, count, length = deferred.table[:4]
+        try:
+            self[key] = self._table(key, kind, count, data, 0, length)
+        except ValueError, e:
+            raise ManifestParseError(str(e))
+        return self[key]
+
+    @property
+    def fingerprints(self):
+        """Mapping of chunk hashes to their sub-chunk fingerprints."""
+        value = self.get('fingerprints', [])
+        if isinstance(value, _Deferred):
+            try:
+                value = self._load_deferred('fingerprints')
+            except Exception, e:
+                # only costs the next backup its deltas
+                logger.warning('Unable to load manifest fingerprints: %s' %
+                               e)
+                return {}
+        if isinstance(value, list):
+            return dict((h, b64decode(f)) for h, f in value)
+        return value
+
+    def set_fingerprints(self, fingerprints):
+        """
+        Add the fingerprints of the chunks just saved, only keeping those of
+        chunks in the most recent backup, any other chunk will never be the
+        parent of a new delta.
+        """
+        head = set(self.replay())
+        merged = dict((h, f) for h, f in self.fingerprints.iteritems()
+                      if h in head and h not in fingerprints)
+        merged.update((h, f) for h, f in fingerprints.iteritems()
+                      if h in head)
+        if self.version.startswith('1.'):
+            self['fingerprints'] = sorted([h, b64encode(f)]
+                                          for h, f in merged.iteritems())
+            return
+        self['fingerprints'] = merged
+
+    def _prune_deltas(self):
+        if 'deltas' not in self:
+            return
+        deltas = self.deltas
+        keep = self._with_parents(self._referenced(), deltas)
+        self['deltas'] = sorted([h, p] for h, p in deltas.iteritems()
+                                if h in keep)
+
     @property
     def backups(self):
         """Shortcut to key 'backups'."""
@@ -157,8 +685,9 @@ class Manifest(dict):
         """
         Return the current sorted list of timestamps for all restorable states.
 
-        The current sorted list is cached in the _history attribute, which will
-        be deleted on calls to __setitem__ or __delitem__.
+        The sorted list is built once into the _history attribute, after
+        that __setitem__ inserts new timestamps into it with insort and
+        __delitem__ removes them, rather than it being sorted again.
         """
         try:
             return self._history
@@ -166,8 +695,70 @@ class Manifest(dict):
             self._history = sorted(k for k in self if k not in self.NAMED_KEYS)
         return self._history
 
-    __setitem__ = _clear_cache(dict.__setitem__)
-    __delitem__ = _clear_cache(dict.__delitem__)
+    def _references(self):
+        """
+        Count of references to each chunk from all but the newest diff.
+        """
+        try:
+            return self._refs
+        except AttributeError:
+            self._refs = Counter()
+            for ts in self.history[:-1]:
+                self._count(self[ts], 1)
+        return self._refs
+
+    def _count(self, table, sign):
+        refs = getattr(self, '_refs', None)
+        if refs is None:
+            return
+        if hasattr(table, 'itervalues'):
+            table = table.itervalues()
+        for hash_ in table:
+            refs[hash_] += sign
+            if not refs[hash_]:
+                del refs[hash_]
+
+    def _forget_replays(self, ts):
+        """
+        Drop the replays that include the diff at ts.
+        """
+        replays = getattr(self, '_replays', None)
+        if replays:
+            for key in [key for key in replays if key >= ts]:
+                del replays[key]
+
+    def __setitem__(self, key, value):
+        if key in self.NAMED_KEYS:
+            return dict.__setitem__(self, key, value)
+        history = self.history
+        if key in self:
+            if key != history[-1]:
+                self._count(self[key], -1)
+                self._count(value, 1)
+        else:
+            if history and key > history[-1]:
+                # the newest diff is done with
+                self._count(self[history[-1]], 1)
+            else:
+                self._count(value, 1)
+            insort(history, key)
+        self._forget_replays(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key in self.NAMED_KEYS:
+            return dict.__delitem__(self, key)
+        history = self.history
+        if key == history[-1]:
+            if len(history) > 1:
+                # the diff before it is the newest again
+                self._count(self[history[-2]], -1)
+                self._forget_replays(history[-2])
+        else:
+            self._count(self[key], -1)
+        del history[bisect_left(history, key)]
+        self._forget_replays(key)
+        dict.__delitem__(self, key)
 
     @property
     def base(self):
@@ -207,10 +798,23 @@ class Manifest(dict):
 
     @property
     def block_set(self):
-        # TODO(clayg): mash into replay for backups?  leave out for restores?
-        blocks = set(self.base)
-        for ts in self.history[1:]:
-            for hash_ in self[ts].itervalues():
+        # the parents of deltas must be kept as long as the deltas are
+        return self._with_parents(self._referenced(), self.deltas)
+
+    def _referenced(self):
+        if not self.history:
+            return set(self.base)
+        blocks = set(self._references())
+        newest = self[self.history[-1]]
+        if hasattr(newest, 'itervalues'):
+            newest = newest.itervalues()
+        blocks.update(newest)
+        return blocks
+
+    def _with_parents(self, blocks, deltas):
+        for hash_ in list(blocks):
+            while hash_ in deltas:
+                hash_ = deltas[hash_]
                 blocks.add(hash_)
         return blocks
 
@@ -220,12 +824,27 @@ class Manifest(dict):
 
         :params until: a timestamp, stops playback, replay all if omitted
         """
-        blocks = list(self.base)
-        for ts in self.history[1:]:
-            if ts > until:
-                break
+        history = self.history
+        if not history:
+            return list(self.base)
+        replays = getattr(self, '_replays', None)
+        if replays is None:
+            replays = self._replays = {}
+        # start from the latest replay kept before until
+        kept = [ts for ts in replays if ts <= until]
+        if kept:
+            start = bisect_left(history, max(kept))
+            blocks = list(replays[history[start]])
+        else:
+            start = 0
+            blocks = list(self[history[0]])
+        stop = bisect_right(history, until)
+        for i in xrange(start + 1, stop):
+            ts = history[i]
             for blockno, hash_ in self[ts].iteritems():
                 blocks[blockno] = hash_
+            if not i % REPLAY_INTERVAL and i < len(history) - 1:
+                replays[ts] = list(blocks)
         return blocks
 
     def get_backup(self, backup_id):
@@ -344,6 +963,7 @@ class Manifest(dict):
         else:
             self.squash(start, next)
         del self.backups[backup_id]
+        self._prune_deltas()
 
     def create_backup(self, backup_id, timestamp=None):
         """
@@ -368,16 +988,17 @@ class Manifest(dict):
         return backup
 
     @classmethod
-    def blank(cls, size):
+    def blank(cls, size, block_size=DEFAULT_BLOCK_SIZE, hash_algorithm=MD5):
         m = cls()
+        m['block_size'] = validate_block_size(block_size)
+        m['hash_algorithm'] = validate_algorithm(hash_algorithm)
         m.block_count = size
         return m
 
     @classmethod
-    def load(cls, raw_json_fp):
-        content = json.load(raw_json_fp, object_hook=convert_numeric_keys)
+    def _from_content(cls, content):
         try:
-            if content['version'] != cls.VERSION:
+            if content['version'] not in cls.VERSIONS:
                 raise ManifestVersionError(
                     'Unknown manifest version: %s' % content['version'])
         except KeyError:
@@ -387,25 +1008,151 @@ class Manifest(dict):
             content['salt'] = ''
         return cls(content)
 
-    @classmethod
-    def loads(cls, raw_json_string):
-        content = json.loads(raw_json_string, object_hook=convert_numeric_keys)
+    def upgrade(self):
+        """
+        Store the manifest in the binary format from now on.
+        """
+        self['version'] = self.BINARY_VERSION
+
+    @staticmethod
+    def _meta(raw):
         try:
-            if content['version'] != cls.VERSION:
-                raise ManifestVersionError(
-                    'Unknown manifest version: %s' % content['version'])
-        except KeyError:
-            raise ManifestVersionError('Manifest has no version')
-        # compat for old manifests
-        if 'salt' not in content:
-            content['salt'] = ''
-        return cls(content)
+            _magic, length = HEADER.unpack_from(raw)
+        except struct.error, e:
+            raise ValueError('Short manifest header: %s' % e)
+        offset = HEADER.size + length
+        content = json.loads(raw[HEADER.size:offset],
+                             object_hook=convert_numeric_keys)
+        return content, offset
+
+    @staticmethod
+    def _table(key, kind, count, data, offset, length):
+        if offset + length > len(data):
+            raise ValueError('Manifest table %s is short' % key)
+        if kind == HASHES:
+            return PackedHashes(buffer(data, offset, length))
+        if kind == PRINTS:
+            return PackedFingerprints(buffer(data, offset, length), count)
+        if kind == DIFF:
+            split = offset + count * array(BLOCKNO_TYPE).itemsize
+            return PackedDiff(_blocknos_array(data[offset:split]),
+                              buffer(data, split, offset + length - split))
+        return json.loads(data[offset:offset + length],
+                          object_hook=convert_numeric_keys)
+
+    @classmethod
+    def _decode(cls, raw, segments=None):
+        """
+        Content of a version 2.0 body, the tables refer to raw and the
+        segments rather than copying them.
+        """
+        content, offset = cls._meta(raw)
+        for table in content.pop('tables'):
+            key, kind, count, length = table[:4]
+            if len(table) > 4:
+                if key in cls.DEFERRED_KEYS and \
+                        table[4] not in (segments or {}):
+                    content[key] = _Deferred(table)
+                    continue
+                try:
+                    data = segments[table[4]]
+                except (KeyError, TypeError):
+                    raise ValueError('Manifest segment %s is missing' %
+                                     table[4])
+                content[key] = cls._table(key, kind, count, data, 0,
+                                          length)
+            else:
+                content[key] = cls._table(key, kind, count, raw, offset,
+                                          length)
+                offset += length
+        return content
+
+    @classmethod
+    def segment_names(cls, raw, deferred=True):
+        """
+        Names of the segments a manifest body refers to, without deferred
+        just those it needs to load.
+        """
+        if raw[:len(MAGIC)] != MAGIC:
+            return []
+        content, _offset = cls._meta(raw)
+        return [table[4] for table in content['tables'] if len(table) > 4
+                and (deferred or table[0] not in cls.DEFERRED_KEYS)]
+
+    @classmethod
+    def load(cls, fp, segments=None):
+        return cls.loads(fp.read(), segments=segments)
+
+    @classmethod
+    def loads(cls, raw, segments=None):
+        """
+        Load a manifest body, segments maps the names of the segments it
+        needs to their contents.
+        """
+        if raw[:len(MAGIC)] == MAGIC:
+            content = cls._decode(raw, segments=segments)
+        else:
+            content = json.loads(raw, object_hook=convert_numeric_keys)
+        return cls._from_content(content)
+
+    def _encode(self, segments=None):
+        content = {}
+        tables = []
+        pieces = []
+        for key in self.NAMED_KEYS:
+            if key in self and key not in self.DEFERRED_KEYS:
+                content[key] = self[key]
+        # in order, so the same manifest always has the same body
+        for key in self.history + self.DEFERRED_KEYS:
+            if key not in self:
+                continue
+            value = self[key]
+            if isinstance(value, _Deferred):
+                if segments is not None:
+                    # never loaded, so swift's copy is still good
+                    segments[value.name] = None
+                    tables.append(value.table)
+                    continue
+                value = self._load_deferred(key)
+            if key in self.DEFERRED_KEYS:
+                kind, count, data = _encode_fingerprints(self.fingerprints)
+            else:
+                kind, count, data = _encode_table(value)
+            if segments is None:
+                tables.append([key, kind, count, len(data)])
+                pieces.append(data)
+                continue
+            name = SEGMENT_PREFIX + md5(data).hexdigest()
+            segments[name] = data
+            tables.append([key, kind, count, len(data), name])
+        content['tables'] = tables
+        meta = json.dumps(content, sort_keys=True)
+        return ''.join([HEADER.pack(MAGIC, len(meta)), meta] + pieces)
 
     def dump(self, f):
-        return json.dump(self, f)
+        f.write(self.dumps())
 
-    def dumps(self):
-        return json.dumps(self)
+    def dumps(self, segments=None):
+        """
+        The manifest body, if segments is given the tables are left out of
+        it and added to segments by name instead.
+        """
+        if self.version.startswith('1.'):
+            # written back the way it was found
+            content = dict(self)
+            if not isinstance(content.get('fingerprints', []), list):
+                content['fingerprints'] = sorted(
+                    [h, b64encode(f)]
+                    for h, f in self.fingerprints.iteritems())
+            return json.dumps(content, default=_plain)
+        return self._encode(segments=segments)
+
+    @property
+    def segments(self):
+        """
+        Names of the segments in swift's copy, as of the last load or save.
+        """
+        return getattr(self, '_segments', set())
 
 
 LOCK_MAP = {}
@@ -431,6 +1178,175 @@ def release_lock(local_cache_filename, close=True):
         os.close(fd)
 
 
+def _segment_dir(local_cache_filename):
+    return local_cache_filename + '.d'
+
+
+def _read_segment(local_cache_filename, name):
+    """
+    The local copy of a segment, None if there isn't a good one.
+    """
+    path = os.path.join(_segment_dir(local_cache_filename), name)
+    try:
+        with open(path) as f:
+            data = f.read()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    if SEGMENT_PREFIX + md5(data).hexdigest() != name:
+        return None
+    return data
+
+
+def _write_segment(local_cache_filename, name, data):
+    path = _segment_dir(local_cache_filename)
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp = os.path.join(path, '.' + name)
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, os.path.join(path, name))
+
+
+def _prune_segments(local_cache_filename, names):
+    """
+    Remove the local copies of any segments not in names.
+    """
+    path = _segment_dir(local_cache_filename)
+    try:
+        existing = os.listdir(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    for name in existing:
+        if name in names:
+            continue
+        try:
+            os.unlink(os.path.join(path, name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _copy_conn(conn):
+    # swift connections can't be shared between threads
+    copy = getattr(conn, 'copy', None)
+    if copy:
+        return copy()
+    return conn
+
+
+def _download_segments(conn, volume_id, names):
+    """
+    Download the named segments, SEGMENT_FETCHERS at a time.
+    """
+    segments = {}
+    errors = []
+    pending = list(names)
+
+    def fetch(conn):
+        try:
+            while pending and not errors:
+                try:
+                    name = pending.pop()
+                except IndexError:
+                    return
+                try:
+                    _headers, data = conn.get_object(volume_id, name,
+                                                     newest=True)
+                except conn.ClientException, e:
+                    if e.http_status != 404:
+                        raise
+                    raise ManifestParseError('Manifest segment %s/%s is '
+                                             'missing' % (volume_id, name))
+                if SEGMENT_PREFIX + md5(data).hexdigest() != name:
+                    raise ManifestParseError('Manifest segment %s/%s is '
+                                             'corrupt' % (volume_id, name))
+                segments[name] = data
+        except Exception:
+            errors.append(sys.exc_info())
+
+    count = min(SEGMENT_FETCHERS, len(pending))
+    if count < 2:
+        fetch(conn)
+    else:
+        threads = [Thread(target=fetch, args=(_copy_conn(conn),))
+                   for i in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return segments
+
+
+def _delete_segments(conn, volume_id, names):
+    for name in names:
+        try:
+            conn.delete_object(volume_id, name)
+        except conn.ClientException, e:
+            if e.http_status != 404:
+                # the audit's sweep will get it
+                logger.warning('Unable to delete manifest segment %s/%s: '
+                               '%s' % (volume_id, name, e))
+
+
+def _load(conn, volume_id, raw_json_string, local_cache_filename=None):
+    """
+    Load a manifest body along with its segments, from their local copies
+    where there are any.  The rest are downloaded at once.
+    """
+    names = Manifest.segment_names(raw_json_string, deferred=False)
+    segments = {}
+    missing = []
+    for name in names:
+        data = None
+        if local_cache_filename:
+            data = _read_segment(local_cache_filename, name)
+        if data is None:
+            missing.append(name)
+        else:
+            segments[name] = data
+    if missing:
+        op_start = time()
+        downloaded = _download_segments(conn, volume_id, missing)
+        duration = time() - op_start
+        logger.info("STAT: load_manifest segments for %r Duration: %r "
+                    "Count: %r" % (volume_id, duration, len(missing)))
+        if local_cache_filename:
+            for name, data in downloaded.iteritems():
+                _write_segment(local_cache_filename, name, data)
+        segments.update(downloaded)
+    manifest = Manifest.loads(raw_json_string, segments=segments)
+    manifest._segments = set(Manifest.segment_names(raw_json_string))
+    manifest._fetch_segment = lambda name: _fetch_segment(
+        conn, volume_id, name, local_cache_filename)
+    if local_cache_filename:
+        _prune_segments(local_cache_filename, manifest.segments)
+    return manifest
+
+
+def _fetch_segment(conn, volume_id, name, local_cache_filename=None):
+    """
+    A segment a manifest left to load later, from the local copy if there
+    is one.
+    """
+    data = None
+    if local_cache_filename:
+        data = _read_segment(local_cache_filename, name)
+    if data is None:
+        data = _download_segments(conn, volume_id, [name])[name]
+        if local_cache_filename:
+            _write_segment(local_cache_filename, name, data)
+    return data
+
+
 def read_local_manifest(local_cache_filename):
     try:
         with open(local_cache_filename) as f:
@@ -443,36 +1359,170 @@ def read_local_manifest(local_cache_filename):
         raise ManifestEmptyError('Manifest file at %s contained no content' %
                                  local_cache_filename)
     try:
-        return Manifest.loads(raw_json_string)
+        names = Manifest.segment_names(raw_json_string)
+        segments = {}
+        for name in Manifest.segment_names(raw_json_string, deferred=False):
+            data = _read_segment(local_cache_filename, name)
+            if data is not None:
+                segments[name] = data
+        manifest = Manifest.loads(raw_json_string, segments=segments)
     except ValueError:
         msg = 'Unable to parse manifest %s' % local_cache_filename
         logger.exception(msg + ':\n"""%s"""' % raw_json_string)
         raise ManifestParseError(msg + '.')
+    manifest._segments = set(names)
+    manifest._fetch_segment = lambda name: _local_segment(
+        local_cache_filename, name)
+    return manifest
 
 
-def load_manifest(conn, volume_id, lock_file):
-    fd = aquire_lock(lock_file)
+def _local_segment(local_cache_filename, name):
+    data = _read_segment(local_cache_filename, name)
+    if data is None:
+        raise ManifestParseError('Manifest segment %s is missing' % name)
+    return data
+
+
+def _write_cache(fd, raw_json_string):
+    os.ftruncate(fd, 0)
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, raw_json_string)
+
+
+def _read_cache(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    pieces = []
+    while True:
+        piece = os.read(fd, 1024 ** 2)
+        if not piece:
+            return ''.join(pieces)
+        pieces.append(piece)
+
+
+def _refresh(conn, volume_id, fd, local_cache_filename):
+    """
+    The manifest from the local copy in the locked file fd if swift still
+    has the same one, otherwise download it and update the local copy.
+
+    Swift's ETag for an object is the md5 of its contents, so the local
+    copy is its own validator and one that was only partly written never
+    matches.
+    """
+    headers = {}
+    cached = _read_cache(fd)
+    if cached:
+        headers['If-None-Match'] = md5(cached).hexdigest()
     op_start = time()
-    _headers, raw_json_string = conn.get_object(volume_id, 'manifest',
-                                                newest=True)
+    try:
+        _headers, raw_json_string = conn.get_object(
+            volume_id, 'manifest', newest=True, headers=headers)
+    except conn.ClientException, e:
+        if e.http_status != 304:
+            raise
+        raw_json_string = None
     duration = time() - op_start
-    logger.info("STAT: load_manifest for %r Duration: %r" % (volume_id,
-                                                             duration))
-    manifest = Manifest.loads(raw_json_string)
-    os.write(fd, raw_json_string)
+    logger.info("STAT: load_manifest for %r Duration: %r Cached: %r" % (
+        volume_id, duration, raw_json_string is None))
+    if raw_json_string is None:
+        return _load(conn, volume_id, cached, local_cache_filename)
+    manifest = _load(conn, volume_id, raw_json_string, local_cache_filename)
+    _write_cache(fd, raw_json_string)
     return manifest
 
 
+def fetch_manifest(conn, volume_id, attempts=2, cache_file=None):
+    """
+    Download the manifest without holding the lock on it, such as another
+    volume's in the same deduplication domain.  Given a cache_file a local
+    copy is kept there, which saves downloading it again until swift's copy
+    changes.
+    """
+    for attempt in xrange(attempts):
+        try:
+            if cache_file:
+                fd = aquire_lock(cache_file)
+                try:
+                    return _refresh(conn, volume_id, fd, cache_file)
+                finally:
+                    release_lock(cache_file)
+            _headers, raw_json_string = conn.get_object(
+                volume_id, 'manifest', newest=True)
+            return _load(conn, volume_id, raw_json_string)
+        except ManifestParseError:
+            # a save may have replaced the segments since we got the root
+            if attempt == attempts - 1:
+                raise
+
+
+def load_manifest(conn, volume_id, lock_file):
+    """
+    Load the manifest and hold the lock on it, the local copy in lock_file
+    saves downloading it again if swift's copy hasn't changed.
+    """
+    fd = aquire_lock(lock_file)
+    return _refresh(conn, volume_id, fd, lock_file)
+
+
+def cached_manifest(conn, volume_id, lock_file):
+    """
+    The manifest without holding the lock, the local copy is used as is
+    while a worker holds it.
+    """
+    if lock_file in LOCK_MAP or not os.path.exists(lock_file):
+        # we're the worker, or there was never a backup here
+        return read_local_manifest(lock_file)
+    fd = os.open(lock_file, os.O_RDWR)
+    try:
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            # a worker loaded it, it's as fresh as it gets
+            return read_local_manifest(lock_file)
+        try:
+            return _refresh(conn, volume_id, fd, lock_file)
+        except conn.ClientException, e:
+            if e.http_status == 404:
+                # every backup was deleted somewhere else
+                raise ManifestEmptyError('No manifest for %s' % volume_id)
+            logger.warning('Unable to check manifest for %s, using the '
+                           'local copy: %s' % (volume_id, e))
+            return read_local_manifest(lock_file)
+    finally:
+        os.close(fd)
+
+
 def save_manifest(manifest, conn, volume_id, lock_file):
+    """
+    Save the manifest, only uploading the segments swift doesn't already
+    have along with the root.  Segments the root no longer names are
+    deleted once it's saved.  Only version 2.0 manifests have segments,
+    json ones are uploaded whole.
+    """
     fd = aquire_lock(lock_file)
-    raw_json_string = manifest.dumps()
-    os.ftruncate(fd, 0)
-    os.write(fd, raw_json_string)
+    segments = {}
+    raw_json_string = manifest.dumps(segments=segments)
     op_start = time()
+    # the root must never name a segment that isn't there yet
+    uploaded = 0
+    for name, data in segments.iteritems():
+        if data is None:
+            # a table that was never loaded, swift already has it
+            continue
+        _write_segment(lock_file, name, data)
+        if name not in manifest.segments:
+            conn.put_object(volume_id, name, data)
+            uploaded += 1
+    _write_cache(fd, raw_json_string)
     conn.put_object(volume_id, 'manifest', raw_json_string)
     duration = time() - op_start
-    logger.info("STAT: save_manifest for %r Duration: %r" % (volume_id,
-                                                             duration))
+    logger.info("STAT: save_manifest for %r Duration: %r Segments: %r" % (
+        volume_id, duration, uploaded))
+    stale = manifest.segments - set(segments)
+    manifest._segments = set(segments)
+    _delete_segments(conn, volume_id, stale)
+    _prune_segments(lock_file, manifest.segments)
     release_lock(lock_file)
 
 
@@ -483,6 +1533,13 @@ def delete_manifest(conn, volume_id, lock_file):
     duration = time() - op_start
     logger.info("STAT: delete_manifest for %r Duration: %r" % (volume_id,
                                                                duration))
+    try:
+        names = Manifest.segment_names(_read_cache(fd))
+    except ValueError:
+        # the audit's sweep will get them
+        names = []
+    _delete_segments(conn, volume_id, names)
+    shutil.rmtree(_segment_dir(lock_file), ignore_errors=True)
     os.remove(lock_file)
     release_lock(lock_file)
 
@@ -508,14 +1565,12 @@ def main():
         return 'ERROR: Specify volume_id'
 
     conn = get_conn(conf)
-    _headers, raw_json_string = conn.get_object(volume_id, 'manifest',
-                                                newest=True)
-    manifest = Manifest.loads(raw_json_string)
+    manifest = fetch_manifest(conn, volume_id)
 
     banner = "manifest for volume %s available as 'm'" % volume_id
     c = ManifestConsole(banner=banner, locals={'m': manifest})
     return c()
 
+
 if __name__ == "__main__":
-    import sys
     sys.exit(main())
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from lunr.storage.helper.utils import directio, ProcessError, execute
+from lunr.storage.helper.utils.budget import Budget, SCRUB, WRITE
 from timeit import default_timer as Timer
 from struct import unpack_from
 from lunr.common import logger
@@ -40,6 +41,8 @@ class Scrub(object):
                                              'display-exceptions', False)
         # Throttle speed is in MB/s
         self._throttle_speed = conf.float('scrub', 'throttle_speed', 0)
+        # Shared with every other bulk job on the node
+        self.budget = Budget(conf)
         self.scrub_buf = ''
 
     def run(self, cmd, *args, **kwargs):
@@ -95,11 +98,30 @@ class Scrub(object):
             # Increment to the next exception in the metatdata store
             exception = exception + 1
 
-    def read_header(self, fd):
-        SECTOR_SHIFT = 9
+    def read_exceptions(self, fd, chunk_size):
+        """
+        Yield the origin chunk of every exception in the cow without
+        touching the metadata, stops at the first unused exception.
+        """
+        exceptions_per_chunk = chunk_size / 16
+        store = 0
+        while True:
+            store_offset = 1 + ((exceptions_per_chunk + 1) * store)
+            buf = self.read(fd, chunk_size * store_offset, chunk_size)
+            # Ran off the end of the cow
+            if len(buf) < chunk_size:
+                return
+            for exception in xrange(exceptions_per_chunk):
+                (old_chunk, new_chunk) = unpack_from('<QQ', buf,
+                                                     exception * 16)
+                if new_chunk == 0:
+                    return
+                yield old_chunk
+            store = store + 1
+
+    def unpack_header(self, fd):
         SNAPSHOT_DISK_MAGIC = 0x70416e53
         SNAPSHOT_DISK_VERSION = 1
-        SNAPSHOT_VALID_FLAG = 1
 
         # Read the cow metadata
         header = unpack_from("<IIII", self.read(fd, 0, 16))
@@ -108,26 +130,56 @@ class Scrub(object):
             raise ScrubError(
                 "Invalid COW device; header magic doesn't match")
 
-        if header[1] != SNAPSHOT_VALID_FLAG:
-            log.warning(
-                "Inactive COW device; valid flag not set '%d' got '%d'"
-                % (SNAPSHOT_VALID_FLAG, header[1]))
-
         if header[2] != SNAPSHOT_DISK_VERSION:
             raise ScrubError(
                 "Unknown metadata version; expected '%d' got '%d' "
                 % (SNAPSHOT_DISK_VERSION, header[2]))
+        return list(header)
+
+    def read_header(self, fd):
+        SECTOR_SHIFT = 9
+        SNAPSHOT_VALID_FLAG = 1
+
+        header = self.unpack_header(fd)
+
+        if header[1] != SNAPSHOT_VALID_FLAG:
+            log.warning(
+                "Inactive COW device; valid flag not set '%d' got '%d'"
+                % (SNAPSHOT_VALID_FLAG, header[1]))
 
         log.info("Magic: %X" % header[0])
         log.info("Valid: %d" % header[1])
         log.info("Version: %d" % header[2])
         log.info("Chunk Size: %d" % header[3])
 
-        header = list(header)
         # Chunk size is byte aligned to 512 bytes
         # (0 << SECTOR_SHIFT) == 512
         return header[3] << SECTOR_SHIFT
 
+    def changed_chunks(self, snapshot):
+        """
+        Read the exception table of a live snapshot, returns the chunk
+        size and the set of origin chunks written to since the snapshot
+        was taken.  The set is None if the snapshot overflowed and was
+        invalidated, in which case it can no longer be trusted.
+        """
+        SECTOR_SHIFT = 9
+        SNAPSHOT_VALID_FLAG = 1
+
+        cow_name, cow_path = self.get_cow(snapshot)
+        try:
+            fd = directio.open(cow_path, mode='r', buffered=32768)
+        except OSError, e:
+            raise ScrubError("Failed to open cow '%s'" % e)
+        try:
+            header = self.unpack_header(fd)
+            chunk_size = header[3] << SECTOR_SHIFT
+            if header[1] != SNAPSHOT_VALID_FLAG:
+                return chunk_size, None
+            return chunk_size, set(self.read_exceptions(fd, chunk_size))
+        finally:
+            fd.close()
+
     def scrub_cow(self, cow_path):
         try:
             log.info("Opening Cow '%s'" % cow_path)
@@ -173,6 +225,19 @@ class Scrub(object):
         """
         return re.sub('-', '--', value)
 
+    def _snapshot_names(self, snapshot):
+        path, vol = os.path.split(snapshot['path'])
+        path, vg = os.path.split(path)
+        path, dev = os.path.split(path)
+        snap_name = "%s-%s" % (self._dash(vg), self._dash(vol))
+        snap_path = os.path.join(os.sep, dev, 'mapper', snap_name)
+        return snap_name, snap_path
+
+    def get_cow(self, snapshot):
+        snap_name, snap_path = self._snapshot_names(snapshot)
+        cow_name = snap_name + "-cow"
+        return (cow_name, snap_path + "-cow")
+
     def get_writable_cow(self, snapshot, volume):
         """Remove the COWing from the volume so we can scrub it.
 
@@ -181,13 +246,8 @@ class Scrub(object):
         Remove the vg-vol-real.
         Only the vg-vol linear and vg-snap-cow linear devices remain.
         """
-        path, vol = os.path.split(snapshot['path'])
-        path, vg = os.path.split(path)
-        path, dev = os.path.split(path)
-        snap_name = "%s-%s" % (self._dash(vg), self._dash(vol))
-        snap_path = os.path.join(os.sep, dev, 'mapper', snap_name)
-        cow_name = snap_name + "-cow"
-        cow_path = os.path.join(os.sep, dev, 'mapper', cow_name)
+        snap_name, snap_path = self._snapshot_names(snapshot)
+        cow_name, cow_path = self.get_cow(snapshot)
 
         if self._display_only:
             return (cow_name, cow_path)
@@ -247,6 +307,18 @@ class Scrub(object):
         if not self._display_only:
             self.remove_cow(cow_name)
 
+    def scrub_live_cow(self, snapshot):
+        """
+        Scrub the cow of a snapshot whose origin has other snapshots.  The
+        origin's table is left alone, reloading it would take copy-on-write
+        away from the others along with this one, so the snapshot stays
+        active until lvremove detaches it.
+        """
+        cow_name, cow_path = self.get_cow(snapshot)
+        if not os.path.exists(cow_path):
+            raise ScrubError("snapshot '%s' has no cow" % snapshot['name'])
+        self.scrub_cow(cow_path)
+
     def scrub_volume(self, volume, byte='\x00'):
         CHUNKSIZE = 4 * 1024 ** 2  # 4 MB
         chunk = mmap(-1, CHUNKSIZE)
@@ -272,6 +344,7 @@ class Scrub(object):
             # TODO: this math only works if CHUNKSIZE is == lvm PE size
             for block_num in xrange(0, size, CHUNKSIZE):
                 os.write(fd, chunk)
+                self.budget.take(SCRUB, WRITE, CHUNKSIZE)
 
                 # Sample scrub progress every 'sample_size' ( in blocks )
                 if (block_num % sample_size) == 0 and block_num != 0:
@@ -0,0 +1,114 @@
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ctypes import c_char, addressof, memset
+import multiprocessing
+import mmap
+
+
+class SlabPool(object):
+    """
+    A fixed number of equal sized buffers carved out of one anonymous
+    shared mmap.
+
+    The pool must be created before the worker processes are forked, after
+    that every process sees the same memory and only slab indexes have to
+    travel through the queues.  acquire() blocks while every slab is in use,
+    so the memory used by a job never grows past count * slab_size.
+    """
+
+    def __init__(self, count, slab_size):
+        self.count = count
+        self.slab_size = slab_size
+        # mmap'd memory is page aligned, and so is every slab as long as
+        # slab_size is a multiple of the page size
+        self.buf = mmap.mmap(-1, count * slab_size)
+        self.lengths = multiprocessing.Array('l', count, lock=False)
+        self.free = multiprocessing.Queue()
+        for slab in xrange(count):
+            self.free.put(slab)
+
+    @property
+    def size(self):
+        return self.count * self.slab_size
+
+    def offset(self, slab):
+        return slab * self.slab_size
+
+    def acquire(self, timeout=None):
+        """
+        Take a slab out of the pool, raises Queue.Empty on timeout.
+        """
+        slab = self.free.get(timeout=timeout)
+        self.lengths[slab] = 0
+        return slab
+
+    def release(self, slab):
+        self.free.put(slab)
+
+    def view(self, slab):
+        """
+        A writable ctypes array over the slab, suitable for readinto.
+        """
+        return (c_char * self.slab_size).from_buffer(self.buf,
+                                                     self.offset(slab))
+
+    def address(self, slab):
+        return addressof(self.view(slab))
+
+    def readinto(self, slab, fp):
+        """
+        Fill the slab from the file like object fp, returns the length read.
+        """
+        length = fp.readinto(self.view(slab))
+        self.lengths[slab] = length
+        return length
+
+    def write(self, slab, data):
+        length = len(data)
+        offset = self.offset(slab)
+        self.buf[offset:offset + length] = data
+        self.lengths[slab] = length
+        return length
+
+    def patch(self, slab, offset, data):
+        """
+        Overwrite part of the slab, leaves the length alone.
+        """
+        start = self.offset(slab) + offset
+        self.buf[start:start + len(data)] = data
+
+    def truncate(self, slab, length):
+        self.lengths[slab] = length
+
+    def zero(self, slab, length=None):
+        if length is None:
+            length = self.slab_size
+        memset(self.address(slab), 0, length)
+        self.lengths[slab] = length
+        return length
+
+    def length(self, slab):
+        return self.lengths[slab]
+
+    def buffer(self, slab):
+        """
+        A read-only buffer over the filled part of the slab, hashlib and lz4
+        will both take this without making a copy.
+        """
+        return buffer(self.buf, self.offset(slab), self.lengths[slab])
+
+    def close(self):
+        self.buf.close()
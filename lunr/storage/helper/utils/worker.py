@@ -14,15 +14,16 @@
 # limitations under the License.
 
 
-import hashlib
+import errno
+import fcntl
 import logging
-import lz4
 import multiprocessing
 import os
 import Queue
+import struct
 import sys
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import contextmanager
 from setproctitle import setproctitle, getproctitle
 from StringIO import StringIO
@@ -33,14 +34,64 @@ import simplejson
 from lunr.cinder.cinderclient import CinderError
 from lunr.common import logger
 from lunr.common.lock import JsonLockFile
-from lunr.storage.helper.utils import get_conn
+from lunr.storage.helper.utils import directio, get_conn
+from lunr.storage.helper.utils.client.evented import AsyncConnection
+from lunr.storage.helper.utils.client.listing import container_pages, \
+    prefetch_pages
+from lunr.storage.helper.utils.client.swift import \
+    Connection as SwiftConnection
 from lunr.storage.helper.utils.manifest import Manifest, load_manifest, \
-    save_manifest, delete_manifest, DuplicateBackupIdError
-
-# TODO(clayg): need ability to override these from config
-BLOCK_SIZE = 4 * 1024 ** 2  # 4 MB
+    save_manifest, delete_manifest, DuplicateBackupIdError, \
+    DEFAULT_BLOCK_SIZE, EMPTY_BLOCK, SEGMENT_PREFIX
+from lunr.storage.helper.utils.slab import SlabPool
+from lunr.storage.helper.utils.budget import Budget, BACKUP, RESTORE, \
+    READ, WRITE, NETWORK
+from lunr.storage.helper.utils.checkpoint import SaveCheckpoint, \
+    INTERVAL as CHECKPOINT_INTERVAL
+from lunr.storage.helper.utils.gc import GCJournal, SWEEP_INTERVAL
+from lunr.storage.helper.utils.blockhash import MD5, block_hash, \
+    validate_algorithm
+from lunr.storage.helper.utils.compression import CODECS, LZ4, compress, \
+    Decompressor
+from lunr.storage.helper.utils.domain import DedupDomain, \
+    PREFIX as DOMAIN_PREFIX
+from lunr.storage.helper.utils.delta import Delta, is_delta, fingerprint, \
+    chunk_count, diff, encode as encode_delta
+
+# Block size of new manifests, unless configured otherwise.  Existing
+# manifests always use the block size they were created with.
+BLOCK_SIZE = DEFAULT_BLOCK_SIZE  # 4 MB
 NUM_WORKERS = 10
+NUM_READ_WORKERS = 2
 NUM_RESTORE_WORKERS = 5
+# Adjacent blocks a restore worker stages and writes out at once
+RESTORE_RUN_BLOCKS = 4
+# Downloads each restore worker keeps in flight
+RESTORE_PREFETCH = 4
+# Size of the pieces a download is streamed in
+RESP_CHUNK_SIZE = 64 * 1024
+# Uploads each save process keeps in flight from an event loop, 0 makes them
+# one at a time
+ASYNC_UPLOADS = 0
+# Save processes when uploads are made from an event loop
+ASYNC_UPLOAD_WORKERS = 1
+# Seconds an event loop waits on its uploads before looking for more blocks
+ASYNC_POLL_INTERVAL = 0.05
+# Threads deleting unreferenced blocks during an audit
+AUDIT_WORKERS = 8
+# Most blocks deleted in one request through swift's bulk delete middleware
+BULK_DELETE_SIZE = 1000
+# Pages of the container listing an audit fetches ahead
+LISTING_PREFETCH = 2
+# Number of sequential blocks each reader handles before moving on to the
+# next stripe, this is also the unit of readahead for a reader.
+READAHEAD_BLOCKS = 8
+# Sub-block deltas are off unless a sub chunk size is configured
+DELTA_CHUNK_SIZE = 0
+DELTA_MAX_CHAIN = 8
+DELTA_MAX_CHANGED = 0.25
+# ioctl zeroing a byte range of a block device, <linux/fs.h>
+BLKZEROOUT = 0x127f
 
 
 class BlockReadFailed(Exception):
@@ -65,11 +116,20 @@ def body_method(name):
 
 class Block(object):
 
-    def __init__(self, block_dev, blockno, salt):
+    def __init__(self, block_dev, blockno, salt, fp=None, pool=None,
+                 slab=None, block_size=BLOCK_SIZE, hash_algorithm=MD5,
+                 codec=LZ4):
         self.path = block_dev
         self.blockno = blockno
         self.salt = salt
+        self.block_size = block_size
+        self.hash_algorithm = hash_algorithm
+        self.codec = codec
         self.stats = defaultdict(int)
+        self._fp = fp
+        self.pool = pool
+        self.slab = slab
+        self.fingerprints = None
 
     @contextmanager
     def timeit(self, key):
@@ -89,40 +149,73 @@ class Block(object):
     def ignored(self):
         self.stats['ignored'] = 1
 
+    @property
+    def offset(self):
+        return self.blockno * self.block_size
+
     @contextmanager
     def open(self, *args, **kwargs):
+        if self._fp:
+            # reuse the reader's open file so kernel readahead isn't reset
+            if self._fp.tell() != self.offset:
+                self._fp.seek(self.offset)
+            yield self._fp
+            return
         try:
             with open(self.path, *args, **kwargs) as f:
-                f.seek(self.blockno * BLOCK_SIZE)
+                f.seek(self.offset)
                 yield f
         except IOError, e:
-            msg = (e.args, self, self.path, self.blockno,
-                   self.blockno * BLOCK_SIZE)
+            msg = (e.args, self, self.path, self.blockno, self.offset)
             raise Exception('%s' % repr(msg))
 
+    def _compressed(self, codec, bytes_in, bytes_out):
+        self.stats['%s_blocks' % codec] += 1
+        self.stats['%s_bytes_in' % codec] += bytes_in
+        self.stats['%s_bytes_out' % codec] += bytes_out
+
     def _compress_body(self):
         decompressed = self.decompressed_body
         with self.timeit('compress'):
-            data = lz4.compress(decompressed)
+            codec, data = compress(decompressed, self.codec)
+        self._compressed(codec, len(decompressed), len(data))
         self._compressed_body = StringIO(data)
 
-    def _hydrate(self):
-        """Populate hash and decompressed body attributes for block
+    def fingerprint(self, sub_chunk_size):
+        with self.timeit('fingerprint'):
+            self.fingerprints = fingerprint(self.decompressed_body,
+                                            sub_chunk_size)
+        return self.fingerprints
+
+    def delta(self, parent, sub_chunk_size, indexes):
         """
-        hasher = hashlib.md5()
-        read_amount = BLOCK_SIZE
-        data = ''
+        Make the body only the sub-chunks at indexes, as a delta against
+        the parent block.
+        """
+        with self.timeit('compress'):
+            codec, data = encode_delta(parent, sub_chunk_size,
+                                       self.decompressed_body, indexes,
+                                       self.codec)
+        self._compressed_body = StringIO(data)
+        self.stats['delta'] = 1
+
+    def _read(self):
         with self.open('rb') as fp:
             with self.timeit('read'):
                 try:
-                    data = fp.read(BLOCK_SIZE)
+                    if self.pool:
+                        self.pool.readinto(self.slab, fp)
+                        return self.pool.buffer(self.slab)
+                    return fp.read(self.block_size)
                 except IOError:
                     raise BlockReadFailed()
-            with self.timeit('hash'):
-                hasher.update(data)
+
+    def _hydrate(self):
+        """Populate hash and decompressed body attributes for block
+        """
+        data = self._read()
         with self.timeit('hash'):
-            hasher.update(self.salt)
-            self._hash = hasher.hexdigest()
+            self._hash = block_hash(data, self.salt, self.hash_algorithm)
         self._decompressed_body = data
 
     @property
@@ -130,7 +223,11 @@ class Block(object):
         try:
             return self._decompressed_body
         except AttributeError:
-            self._hydrate()
+            if self.pool and hasattr(self, '_hash'):
+                # a reader already filled the slab and hashed the block
+                self._decompressed_body = self.pool.buffer(self.slab)
+            else:
+                self._hydrate()
         return self._decompressed_body
 
     @property
@@ -149,6 +246,7 @@ class Block(object):
         return length
 
     read = body_method('read')
+    getvalue = body_method('getvalue')
     tell = body_method('tell')
     seek = body_method('seek')
 
@@ -172,6 +270,29 @@ def reinit_logging():
             pass
 
 
+def http_stats(conn, stats):
+    """
+    Add the handshakes and reuses of conn's connection pool, and the GETs
+    its hedge policy sent again, to stats.
+    """
+    pool = getattr(conn, 'pool', None)
+    if pool:
+        for info in pool.stats().values():
+            stats['http_handshakes'] += info.get('handshakes', 0)
+            stats['http_reused'] += info.get('reused', 0)
+    hedge = getattr(conn, 'hedge', None)
+    if hedge:
+        counts = hedge.stats()
+        stats['http_hedged'] += counts.get('hedged', 0)
+        stats['http_hedge_wins'] += counts.get('hedge_wins', 0)
+
+
+def http_reuse_rate(stats):
+    checkouts = stats.get('http_handshakes', 0) + stats.get('http_reused', 0)
+    if checkouts:
+        stats['http_reuse_rate'] = float(stats['http_reused']) / checkouts
+
+
 class StatsProcess(multiprocessing.Process):
     def __init__(self, cinder, cinder_id, stat_queue, block_count, stats_lock,
                  update_interval=1000):
@@ -247,6 +368,9 @@ class StatsSaveProcess(StatsProcess):
 
     def get_percentage(self):
         all_blocks = self.block_count + self.upload_count
+        if not all_blocks:
+            # Nothing changed since the last backup
+            return 100.0
         return self.blocks_handled * 100.0 / all_blocks
 
     def get_stats(self):
@@ -306,11 +430,250 @@ class StatsRestoreProcess(StatsProcess):
                                % e)
 
 
+class RestoreWriter(object):
+    """
+    The one fd a restore worker writes every block through, O_DIRECT
+    unless the device won't have it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.raw = directio.RawDirect(path, mode=os.O_WRONLY)
+            self.fd = self.raw.fileno()
+        except OSError, e:
+            if e.errno != errno.EINVAL:
+                raise
+            logger.info('%s does not support O_DIRECT' % path)
+            self.raw = None
+            self.fd = os.open(path, os.O_WRONLY)
+        self._buffered_fd = None
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+
+    def write(self, address, length, offset):
+        if not self.raw:
+            return directio.pwrite(self.fd, address, length, offset)
+        if self.raw.aligned(address, length, offset):
+            return self.raw.pwrite(address, length, offset)
+        # a short block at the end of a file
+        if self._buffered_fd is None:
+            self._buffered_fd = os.open(self.path, os.O_WRONLY)
+        return directio.pwrite(self._buffered_fd, address, length, offset)
+
+    def close(self):
+        for fd in (self.fd, self._buffered_fd):
+            if fd is not None:
+                os.fsync(fd)
+                os.close(fd)
+
+
+class Download(object):
+    """
+    The result of a download a Prefetcher is working on.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._exc_info:
+            t, v, tb = self._exc_info
+            raise t, v, tb
+        return self._result
+
+
+class Prefetcher(object):
+    """
+    Threads keeping up to size downloads in flight for a restore worker,
+    each with a connection of its own.  With a size of 0 submit() does the
+    download itself.
+    """
+
+    def __init__(self, conf, download, size):
+        self.conf = conf
+        self.download = download
+        self.requests = Queue.Queue()
+        self.threads = []
+        self.conn = None
+        if not size:
+            self.conn = get_conn(conf)
+        for i in xrange(size):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _fetch(self, conn, download, args):
+        try:
+            download.set_result(self.download(conn, *args))
+        except Exception:
+            download.set_exc_info(sys.exc_info())
+
+    def _run(self):
+        conn = get_conn(self.conf)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            self._fetch(conn, *request)
+
+    def submit(self, *args):
+        download = Download()
+        if self.threads:
+            self.requests.put((download, args))
+        else:
+            self._fetch(self.conn, download, args)
+        return download
+
+    def stop(self):
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Deleter(object):
+    """
+    Threads deleting objects, each with a connection of its own.  With a
+    bulk_size the objects go through swift's bulk delete middleware that
+    many at a time, otherwise one request each with the X-Timestamp they
+    were given.  With a size of 0 delete() does the deleting itself, and
+    raises any error straight away.
+
+    Otherwise the first error stops the deleting and is raised by the next
+    delete() or by finish().
+    """
+
+    def __init__(self, conf, size, bulk_size=0):
+        self.conf = conf
+        self.bulk_size = bulk_size
+        self.requests = Queue.Queue(max(size, 1) * 2)
+        self.threads = []
+        self.conn = None
+        self.deleted = 0
+        self.not_found = 0
+        self._batch = []
+        self._lock = threading.Lock()
+        self._exc_info = None
+        if not size:
+            self.conn = get_conn(conf)
+        for i in xrange(size):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _delete(self, conn, batch):
+        if self._exc_info:
+            return
+        try:
+            if self.bulk_size:
+                result = conn.bulk_delete([(container, name)
+                                           for container, name, ts in batch])
+                if result.get('Errors'):
+                    path, status = result['Errors'][0]
+                    raise conn.ClientException(
+                        'Bulk delete failed for %s objects, %s: %s' % (
+                            len(result['Errors']), path, status))
+                deleted = result['Number Deleted']
+                not_found = result['Number Not Found']
+            else:
+                deleted = not_found = 0
+                for container, name, ts in batch:
+                    try:
+                        conn.delete_object(container, name,
+                                           headers={'X-Timestamp': ts})
+                        deleted += 1
+                    except conn.ClientException, e:
+                        if e.http_status != 404:
+                            raise
+                        not_found += 1
+            with self._lock:
+                self.deleted += deleted
+                self.not_found += not_found
+        except Exception:
+            with self._lock:
+                if not self._exc_info:
+                    self._exc_info = sys.exc_info()
+
+    def _run(self):
+        conn = get_conn(self.conf)
+        while True:
+            batch = self.requests.get()
+            if batch is None:
+                break
+            self._delete(conn, batch)
+
+    def _check(self):
+        if self._exc_info:
+            t, v, tb = self._exc_info
+            raise t, v, tb
+
+    def _submit(self, batch):
+        if self.threads:
+            self.requests.put(batch)
+        else:
+            self._delete(self.conn, batch)
+            self._check()
+
+    def delete(self, container, name, ts):
+        self._check()
+        self._batch.append((container, name, ts))
+        if len(self._batch) >= max(self.bulk_size, 1):
+            batch, self._batch = self._batch, []
+            self._submit(batch)
+
+    def stop(self):
+        threads, self.threads = self.threads, []
+        for thread in threads:
+            self.requests.put(None)
+        for thread in threads:
+            thread.join()
+
+    def finish(self):
+        """
+        Wait for every delete, raising the first error.
+        """
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self._submit(batch)
+        self.stop()
+        self._check()
+
+
+def prefetch_listing(conf, container, depth, prefix=None):
+    """
+    Names of the objects in container, a thread with a connection of its
+    own fetches up to depth pages of the listing ahead.  With a depth of 0
+    each page is fetched as it's needed.
+    """
+    pages = container_pages(get_conn(conf), container, prefix=prefix)
+    if depth:
+        pages = prefetch_pages(pages, depth)
+    for listing in pages:
+        for obj in listing:
+            yield obj['name']
+
+
 class RestoreProcess(multiprocessing.Process):
     def __init__(self, conf, volume_id, block_queue, result_queue, stat_queue,
-                 salt):
+                 salt, block_size=BLOCK_SIZE, hash_algorithms=(MD5,),
+                 budget=None, run_blocks=RESTORE_RUN_BLOCKS,
+                 prefetch=RESTORE_PREFETCH):
         multiprocessing.Process.__init__(self)
-        self.conn = get_conn(conf)
+        self.conf = conf
+        self.budget = budget
         self.volume_id = volume_id
         self.block_queue = block_queue
         self.result_queue = result_queue
@@ -318,123 +681,520 @@ class RestoreProcess(multiprocessing.Process):
         self.stats = defaultdict(int)
         self.errors = defaultdict(int)
         self.salt = salt
+        self.block_size = block_size
+        self.hash_algorithms = hash_algorithms
+        self.run_blocks = run_blocks
+        self.prefetch = prefetch
+        self.pool = None
+        self.prefetcher = None
+        self.writers = {}
+        # cleared the first time the device turns down BLKZEROOUT
+        self.zero_out = True
 
     @property
-    def empty_block_hash(self):
+    def empty_block_hashes(self):
+        # backups taken before a volume changed hash algorithm name their
+        # empty blocks with the old one
         try:
-            return self._empty_block_hash
+            return self._empty_block_hashes
         except AttributeError:
-            hasher = hashlib.md5()
-            hasher.update(self.empty_block)
-            hasher.update(self.salt)
-            self._empty_block_hash = hasher.hexdigest()
-        return self._empty_block_hash
+            self._empty_block_hashes = set(
+                block_hash(self.empty_block, self.salt, algorithm)
+                for algorithm in self.hash_algorithms)
+        return self._empty_block_hashes
 
     @property
     def empty_block(self):
         # alloc as needed
-        return '\x00' * BLOCK_SIZE
+        return '\x00' * self.block_size
 
-    def _write_empty_block(self, hash_, block):
+    def _take(self, resource, nbytes, block):
+        if self.budget:
+            with block.timeit('budget_wait'):
+                self.budget.take(RESTORE, resource, nbytes)
+
+    def _writer(self, block_dev):
+        try:
+            return self.writers[block_dev]
+        except KeyError:
+            writer = self.writers[block_dev] = RestoreWriter(block_dev)
+        return writer
+
+    def _write(self, writer, slab, length, block):
+        self._take(WRITE, length, block)
+        with block.timeit('write'):
+            writer.write(self.pool.address(slab), length, block.offset)
+        block.stats['write_ops'] += 1
+
+    def _zero_out(self, writer, block):
+        """
+        Have the device zero the block itself, False if it can't.
+        """
+        if not self.zero_out:
+            return False
+        # the last block may run past the end of the device
+        length = max(0, min(self.block_size, writer.size - block.offset))
+        try:
+            fcntl.ioctl(writer.fd, BLKZEROOUT,
+                        struct.pack('QQ', block.offset, length))
+        except IOError, e:
+            if e.errno not in (errno.ENOTTY, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+            logger.info('%s does not support BLKZEROOUT, writing zeros' %
+                        block.path)
+            self.zero_out = False
+            return False
+        return True
+
+    def _write_empty_block(self, hash_, block, writer):
         logger.debug('Writing empty block %s - %s' % (
             block.blockno, hash_))
-        with block.open('w+b') as f:
-            with block.timeit('write'):
-                f.write(self.empty_block)
+        with block.timeit('write'):
+            if self._zero_out(writer, block):
+                block.stats['zeroed_out'] = 1
+                return block.stats
+        length = max(0, min(self.block_size, writer.size - block.offset))
+        self.pool.zero(0, length)
+        self._write(writer, 0, length, block)
         return block.stats
 
-    def _restore_block(self, hash_, block):
-        logger.debug("restore block: %s, hash: %s, empty_block_hash: %s" %
-                     (block.blockno, hash_, self.empty_block_hash))
-        if hash_ == self.empty_block_hash:
-            return self._write_empty_block(hash_, block)
-
+    def _get(self, conn, hash_, block):
+        """
+        Stream the object for hash_, decompressing as it arrives unless
+        it's a delta.  Returns the data or the Delta.
+        """
         with block.timeit('network_read'):
-            _headers, body = self.conn.get_object(self.volume_id, hash_)
-
-        with block.open('w+b') as f:
+            _headers, body = conn.get_object(
+                self.volume_id, hash_, resp_chunk_size=RESP_CHUNK_SIZE)
+            decompressor = None
+            pieces = []
+            for piece in body:
+                self._take(NETWORK, len(piece), block)
+                if decompressor is None and not pieces and \
+                        not is_delta(piece):
+                    decompressor = Decompressor()
+                if decompressor:
+                    decompressor.feed(piece)
+                else:
+                    pieces.append(piece)
+        if decompressor:
             with block.timeit('decompress'):
-                decompressed = lz4.decompress(body)
-            with block.timeit('write'):
-                f.write(decompressed)
-        block.restored()
+                return decompressor.finish()
+        return Delta(''.join(pieces))
+
+    def _download(self, conn, hash_, block):
+        """
+        The data for hash_ and the chain of deltas to apply to it, runs in
+        one of the prefetch threads.
+        """
+        chain = []
+        data = self._get(conn, hash_, block)
+        # follow the delta chain back to a whole block
+        while isinstance(data, Delta):
+            chain.append(data)
+            data = self._get(conn, data.parent, block)
+        block.stats['deltas_applied'] += len(chain)
+        return data, chain
+
+    def _fetch(self, download, slab, block):
+        """
+        Fill the slab with a block once its download is done.
+        """
+        data, chain = download.result()
+        with block.timeit('decompress'):
+            self.pool.write(slab, data)
+            for delta in reversed(chain):
+                delta.apply(self.pool, slab)
+
+    def _restore_blocks(self, hash_, blocks, download, writer):
+        """
+        Write the object for hash_, fetched once, to every block.
+        """
+        logger.debug("restore blocks: %s, hash: %s" % (
+            ', '.join(str(block.blockno) for block in blocks), hash_))
+        if download is None:
+            for block in blocks:
+                self._write_empty_block(hash_, block, writer)
+            return
+
+        self._fetch(download, 0, blocks[0])
+        blocks[0].stats['downloads_saved'] += len(blocks) - 1
+        for block in blocks:
+            self._write(writer, 0, self.pool.length(0), block)
+            block.restored()
         logger.debug('Restored Block "%s/%s"' % (self.volume_id, hash_))
 
-    def run(self):
-        setproctitle("%s %s" % (self.__class__.__name__, getproctitle()))
-        reinit_logging()
-        while True:
-            task = self.block_queue.get()
-            if task is None:
-                self.result_queue.put((self.stats, self.errors))
-                logger.debug('%s: exiting...' % self.name)
-                self.block_queue.task_done()
-                break
-            try:
-                block_dev, blockno, hash_ = task
-                block = Block(block_dev, blockno, self.salt)
-                self._restore_block(hash_, block)
+    def _restore_run(self, run, writer):
+        """
+        Fetch a run of adjacent blocks into adjacent slabs and write them
+        out all at once.
+        """
+        logger.debug("restore run: %s" % ', '.join(
+            '%s:%s' % (blocks[0].blockno, hash_)
+            for hash_, blocks, download in run))
+        length = 0
+        for slab, (hash_, blocks, download) in enumerate(run):
+            self._fetch(download, slab, blocks[0])
+            # only the last block of the volume may be short
+            if length != self.pool.offset(slab):
+                raise BlockReadFailed('Short block #%s in a run' %
+                                      run[slab - 1][1][0].blockno)
+            length += self.pool.length(slab)
+        first = run[0][1][0]
+        self._write(writer, 0, length, first)
+        first.stats['coalesced'] += len(run) - 1
+        for hash_, blocks, download in run:
+            blocks[0].restored()
+
+    def _start(self, task):
+        """
+        Get the downloads for a task going, returns its entries as
+        (hash, blocks, download) with no download for empty blocks.
+        """
+        block_dev, run = task
+        entries = []
+        for blocknos, hash_ in run:
+            blocks = [Block(block_dev, blockno, self.salt,
+                            block_size=self.block_size)
+                      for blockno in blocknos]
+            download = None
+            if hash_ not in self.empty_block_hashes:
+                download = self.prefetcher.submit(hash_, blocks[0])
+            entries.append((hash_, blocks, download))
+        return entries
+
+    def _restore(self, task, entries):
+        block_dev, run = task
+        blocks = [block for hash_, blocks, download in entries
+                  for block in blocks]
+        try:
+            writer = self._writer(block_dev)
+            if len(entries) == 1:
+                self._restore_blocks(entries[0][0], entries[0][1],
+                                     entries[0][2], writer)
+            else:
+                self._restore_run(entries, writer)
+            for block in blocks:
                 for stat in block.stats:
                     self.stats[stat] += block.stats[stat]
-                stat_task = ('restored', 1)
-                self.stat_queue.put(stat_task)
-                logger.debug('Finished block write %s - %s : %s' % (
-                    block.blockno, hash_, simplejson.dumps(block.stats)))
-            except Exception:
-                t, v, tb = sys.exc_info()
-                self.errors[t.__name__] += 1
-                logger.error('Error in block #%s' % block.blockno,
-                             exc_info=(t, v, tb))
+                logger.debug('Finished block write %s : %s' % (
+                    block.blockno, simplejson.dumps(block.stats)))
+            stat_task = ('restored', len(blocks))
+            self.stat_queue.put(stat_task)
+        except Exception:
+            t, v, tb = sys.exc_info()
+            self.errors[t.__name__] += 1
+            logger.error('Error in blocks #%s' %
+                         ', '.join(str(block.blockno) for block in blocks),
+                         exc_info=(t, v, tb))
 
+    def run(self):
+        setproctitle("%s %s" % (self.__class__.__name__, getproctitle()))
+        reinit_logging()
+        # slabs are laid out one after the other, so a run of blocks is
+        # staged in one piece
+        self.pool = SlabPool(self.run_blocks, self.block_size)
+        self.prefetcher = Prefetcher(self.conf, self._download,
+                                     self.prefetch)
+        # tasks taken off the queue early to keep the downloads going
+        pending = deque()
+        in_flight = 0
+        done = False
+        while pending or not done:
+            while not done and (not pending or in_flight < self.prefetch):
+                try:
+                    task = self.block_queue.get(block=not pending)
+                except Queue.Empty:
+                    break
+                if task is None:
+                    done = True
+                    break
+                entries = self._start(task)
+                in_flight += len(entries)
+                pending.append((task, entries))
+            if not pending:
+                continue
+            task, entries = pending.popleft()
+            in_flight -= len(entries)
+            self._restore(task, entries)
             self.block_queue.task_done()
 
+        self.prefetcher.stop()
+        for writer in self.writers.values():
+            writer.close()
+        self.pool.close()
+        # the prefetcher's threads share the process's connection pool
+        http_stats(get_conn(self.conf), self.stats)
+        self.result_queue.put((self.stats, self.errors))
+        logger.debug('%s: exiting...' % self.name)
+        # for the None that told us to quit
+        self.block_queue.task_done()
+
 
 class SaveProcess(multiprocessing.Process):
-    def __init__(self, conf, volume_id, block_queue, result_queue, stat_queue):
+    def __init__(self, conf, volume_id, block_queue, result_queue, stat_queue,
+                 pool, codec=LZ4, done_queue=None, budget=None):
         multiprocessing.Process.__init__(self)
         self.conn = get_conn(conf)
+        self.budget = budget
         self.volume_id = volume_id
         self.block_queue = block_queue
         self.result_queue = result_queue
         self.stat_queue = stat_queue
         self.stats = defaultdict(int)
         self.errors = defaultdict(int)
+        self.pool = pool
+        self.codec = codec
+        self.done_queue = done_queue
+
+    def _block(self, task):
+        blockno, hash_, slab, parent = task
+        block = Block(None, blockno, None, pool=self.pool, slab=slab,
+                      codec=self.codec)
+        block._hash = hash_
+        return block
+
+    def _prepare(self, block, parent):
+        """
+        Get block ready to upload, returns the length of its body.
+        """
+        if parent:
+            block.delta(*parent)
+        content_length = len(block)
+        if self.budget:
+            with block.timeit('budget_wait'):
+                self.budget.take(BACKUP, NETWORK, content_length)
+        return content_length
+
+    def _uploaded(self, block, content_length):
+        block.uploaded()
+        block.stats['network_bytes'] += content_length
+        for stat in block.stats:
+            self.stats[stat] += block.stats[stat]
+        stat_task = ('uploaded', 1)
+        self.stat_queue.put(stat_task)
+        if self.done_queue:
+            self.done_queue.put(block.blockno)
+        logger.debug('Finished upload %s - %s : %s' % (
+            block.blockno, block.hash, simplejson.dumps(block.stats)))
+
+    def _failed(self, block):
+        t, v, tb = sys.exc_info()
+        self.errors[t.__name__] += 1
+        logger.error('Error in block #%s' % block.blockno,
+                     exc_info=(t, v, tb))
+
+    def _exit(self):
+        self.result_queue.put((self.stats, self.errors))
+        logger.debug('%s: exiting...' % self.name)
+        self.block_queue.task_done()
 
     def run(self):
         setproctitle("%s %s" % (self.__class__.__name__, getproctitle()))
         reinit_logging()
         while True:
-            block = self.block_queue.get()
-            if block is None:
-                self.result_queue.put((self.stats, self.errors))
-                logger.debug('%s: exiting...' % self.name)
-                self.block_queue.task_done()
+            task = self.block_queue.get()
+            if task is None:
+                http_stats(self.conn, self.stats)
+                self._exit()
                 break
+            block = self._block(task)
             try:
-                content_length = len(block)
+                content_length = self._prepare(block, task[3])
                 with block.timeit('network_write'):
                     self.conn.put_object(self.volume_id, block.hash, block,
                                          content_length=content_length)
-                block.uploaded()
-                block.stats['network_bytes'] += content_length
-                for stat in block.stats:
-                    self.stats[stat] += block.stats[stat]
-                stat_task = ('uploaded', 1)
-                self.stat_queue.put(stat_task)
-                logger.debug('Finished upload %s - %s : %s' % (
-                    block.blockno, block.hash, simplejson.dumps(block.stats)))
+                self._uploaded(block, content_length)
             except Exception:
-                t, v, tb = sys.exc_info()
-                self.errors[t.__name__] += 1
-                logger.error('Error in block #%s' % block.blockno,
-                             exc_info=(t, v, tb))
+                self._failed(block)
+            finally:
+                self.pool.release(block.slab)
 
             self.block_queue.task_done()
 
 
+class AsyncSaveProcess(SaveProcess):
+    """
+    A SaveProcess keeping up to in_flight uploads going at once from one
+    event loop, rather than making them one after another.  Only swift
+    connections can be driven this way.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.in_flight = kwargs.pop('in_flight', ASYNC_UPLOADS)
+        super(AsyncSaveProcess, self).__init__(*args, **kwargs)
+
+    def _finish(self, block):
+        self.pool.release(block.slab)
+        self.block_queue.task_done()
+
+    def _submit(self, aconn, task, uploads):
+        block = self._block(task)
+        try:
+            content_length = self._prepare(block, task[3])
+            request = aconn.submit_put_object(self.volume_id, block.hash,
+                                              block,
+                                              content_length=content_length)
+        except Exception:
+            self._failed(block)
+            self._finish(block)
+            return
+        uploads[request] = (block, content_length, time())
+
+    def run(self):
+        setproctitle("%s %s" % (self.__class__.__name__, getproctitle()))
+        reinit_logging()
+        aconn = AsyncConnection(self.conn, max_in_flight=self.in_flight)
+        # request -> (block, content length, submitted)
+        uploads = {}
+        done = False
+        while uploads or not done:
+            while not done and len(uploads) < self.in_flight:
+                try:
+                    task = self.block_queue.get(block=not uploads)
+                except Queue.Empty:
+                    break
+                if task is None:
+                    done = True
+                    break
+                self._submit(aconn, task, uploads)
+            if not uploads:
+                continue
+            timeout = None
+            if not done and len(uploads) < self.in_flight:
+                # go back for more blocks soon
+                timeout = ASYNC_POLL_INTERVAL
+            for request in aconn.run(timeout=timeout):
+                block, content_length, submitted = uploads.pop(request)
+                block.stats['network_write'] += time() - submitted
+                try:
+                    request.result()
+                    self._uploaded(block, content_length)
+                except Exception:
+                    self._failed(block)
+                finally:
+                    self._finish(block)
+        aconn.close()
+        self.stats['http_handshakes'] += aconn.stats['handshakes']
+        self.stats['http_reused'] += aconn.stats['reused']
+        self._exit()
+
+
+class ReadWindow(object):
+    """
+    Bounds how far the readers may get ahead of the in-order consumer in
+    Worker.save, so at most size hashed blocks are ever waiting to be
+    reordered.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.cond = multiprocessing.Condition()
+        self.head = multiprocessing.Value('l', 0, lock=False)
+        self.stopped = multiprocessing.Value('b', 0, lock=False)
+
+    def wait(self, position):
+        with self.cond:
+            while position >= self.head.value + self.size:
+                if self.stopped.value:
+                    break
+                self.cond.wait(1)
+            return not self.stopped.value
+
+    def advance(self, position):
+        with self.cond:
+            self.head.value = position
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped.value = 1
+            self.cond.notify_all()
+
+
+class ReadProcess(multiprocessing.Process):
+    def __init__(self, block_dev, salt, blocknos, reader, num_readers,
+                 readahead, read_queue, window, pool, block_size=BLOCK_SIZE,
+                 sub_chunk_size=DELTA_CHUNK_SIZE, hash_algorithm=MD5,
+                 budget=None):
+        multiprocessing.Process.__init__(self)
+        self.block_dev = block_dev
+        self.budget = budget
+        self.salt = salt
+        self.block_size = block_size
+        self.hash_algorithm = hash_algorithm
+        self.sub_chunk_size = sub_chunk_size
+        self.blocknos = blocknos
+        self.reader = reader
+        self.num_readers = num_readers
+        self.readahead = readahead
+        self.read_queue = read_queue
+        self.window = window
+        self.pool = pool
+
+    def positions(self):
+        """
+        Yield the positions in blocknos this reader is responsible for.
+
+        Readers take turns on stripes of readahead blocks so each one reads
+        sequentially through its own stripe.
+        """
+        stripe = self.readahead * self.num_readers
+        count = len(self.blocknos)
+        for start in xrange(self.reader * self.readahead, count, stripe):
+            for position in xrange(start, min(start + self.readahead, count)):
+                yield position
+
+    def acquire(self):
+        while True:
+            try:
+                return self.pool.acquire(timeout=1)
+            except Queue.Empty:
+                if self.window.stopped.value:
+                    return None
+
+    def run(self):
+        setproctitle("%s %s" % (self.__class__.__name__, getproctitle()))
+        reinit_logging()
+        blockno = slab = None
+        try:
+            with open(self.block_dev, 'rb') as fp:
+                for position in self.positions():
+                    if not self.window.wait(position):
+                        break
+                    slab = self.acquire()
+                    if slab is None:
+                        break
+                    blockno = self.blocknos[position]
+                    block = Block(self.block_dev, blockno, self.salt, fp=fp,
+                                  pool=self.pool, slab=slab,
+                                  block_size=self.block_size,
+                                  hash_algorithm=self.hash_algorithm)
+                    hash_ = block.hash
+                    if self.budget:
+                        with block.timeit('budget_wait'):
+                            self.budget.take(BACKUP, READ,
+                                             self.pool.length(slab))
+                    if self.sub_chunk_size:
+                        block.fingerprint(self.sub_chunk_size)
+                    self.read_queue.put((blockno, slab, hash_, block.stats,
+                                         block.fingerprints))
+                    slab = None
+        except BlockReadFailed:
+            logger.error("BlockReadFailed blockno: %s" % blockno)
+            self.read_queue.put((blockno, slab, None, {}, None))
+        except Exception:
+            logger.exception("Unknown exception in %s" % self.name)
+            self.read_queue.put((blockno, slab, None, {}, None))
+        logger.debug('%s: exiting...' % self.name)
+
+
 class Worker(object):
 
     manifest_lock_path = 'volumes/%(volume_id)s/manifest'
+    checkpoint_path = 'volumes/%(volume_id)s/checkpoint'
+    gc_path = 'volumes/%(volume_id)s/gc'
 
     def __init__(self, volume_id, conf, manifest=None, stats_path=None):
         self.run_dir = conf.string('storage', 'run_dir', conf.path('run'))
@@ -446,9 +1206,48 @@ class Worker(object):
             with JsonLockFile(stats_path) as lock:
                 self.stats_lock = lock
 
-        self.block_queue = multiprocessing.JoinableQueue(NUM_WORKERS)
+        self.num_workers = conf.int('backup', 'upload_workers', NUM_WORKERS)
+        self.async_uploads = conf.int('backup', 'async_uploads',
+                                      ASYNC_UPLOADS)
+        if self.async_uploads and not isinstance(self.conn, SwiftConnection):
+            logger.warning('async_uploads needs the swift client, uploading '
+                           'one block at a time')
+            self.async_uploads = 0
+        if self.async_uploads:
+            self.num_workers = conf.int('backup', 'async_upload_workers',
+                                        ASYNC_UPLOAD_WORKERS)
+        self.num_readers = conf.int('backup', 'read_workers',
+                                    NUM_READ_WORKERS)
+        self.readahead = conf.int('backup', 'readahead_blocks',
+                                  READAHEAD_BLOCKS)
+        self.num_restore_workers = conf.int('backup', 'restore_workers',
+                                            NUM_RESTORE_WORKERS)
+        self.restore_run_blocks = conf.int('backup', 'restore_run_blocks',
+                                           RESTORE_RUN_BLOCKS)
+        self.restore_prefetch = conf.int('backup', 'restore_prefetch',
+                                         RESTORE_PREFETCH)
+        self.delta_chunk_size = conf.int('backup', 'delta_chunk_size',
+                                         DELTA_CHUNK_SIZE)
+        self.delta_max_chain = conf.int('backup', 'delta_max_chain',
+                                        DELTA_MAX_CHAIN)
+        self.delta_max_changed = conf.float('backup', 'delta_max_changed',
+                                            DELTA_MAX_CHANGED)
+        self.codec = conf.string('backup', 'codec', LZ4)
+        self.upgrade_manifest = conf.bool('backup', 'upgrade_manifest', False)
+        self.checkpoint_interval = conf.int('backup', 'checkpoint_interval',
+                                            CHECKPOINT_INTERVAL)
+        self.sweep_interval = conf.int('backup', 'audit_sweep_interval',
+                                       SWEEP_INTERVAL)
+        self.audit_workers = conf.int('backup', 'audit_workers',
+                                      AUDIT_WORKERS)
+        self.audit_bulk_delete = conf.bool('backup', 'audit_bulk_delete', True)
+        self.listing_prefetch = conf.int('backup', 'audit_listing_prefetch',
+                                         LISTING_PREFETCH)
+        self.budget = Budget(conf)
+        self.block_queue = multiprocessing.JoinableQueue(self.num_workers)
         self.result_queue = multiprocessing.Queue()
         self.stat_queue = multiprocessing.Queue()
+        self.done_queue = multiprocessing.Queue()
         self.update_interval = conf.int('storage',
                                         'stats_update_interval', 1000)
 
@@ -457,6 +1256,16 @@ class Worker(object):
                                           self._lock_path())
         else:
             self.manifest = manifest
+        if self.manifest.domain:
+            # a delta's parent is only known to the manifest that made it
+            self.delta_chunk_size = 0
+        if self.delta_chunk_size and not self.upgrade_manifest and \
+                self.manifest.version.startswith('1.'):
+            # json would carry the fingerprints of every block inline, and
+            # upload all of them again with every backup
+            logger.info('Not saving deltas of %s, its manifest is version '
+                        '%s' % (self.id, self.manifest.version))
+            self.delta_chunk_size = 0
 
     @classmethod
     def build_lock_path(cls, run_dir, volume_id):
@@ -466,6 +1275,35 @@ class Worker(object):
     def _lock_path(self):
         return self.build_lock_path(self.run_dir, self.id)
 
+    def _checkpoint_path(self):
+        return os.path.join(self.run_dir, self.checkpoint_path % {
+            'volume_id': self.id})
+
+    @property
+    def journal(self):
+        return GCJournal(os.path.join(self.run_dir, self.gc_path % {
+            'volume_id': self.id}))
+
+    @property
+    def block_container(self):
+        return self.manifest.domain or self.id
+
+    @property
+    def domain(self):
+        if not self.manifest.domain:
+            return None
+        # the same one throughout, it keeps the markers we hold fresh
+        try:
+            if self._domain.container == self.manifest.domain:
+                return self._domain
+        except AttributeError:
+            pass
+        cache_dir = os.path.join(self.run_dir, 'domains',
+                                 self.manifest.domain)
+        self._domain = DedupDomain(self.conn, self.manifest.domain,
+                                   cache_dir=cache_dir)
+        return self._domain
+
     @property
     def hash_set(self):
         try:
@@ -479,16 +1317,23 @@ class Worker(object):
         try:
             return self._empty_block_hash
         except AttributeError:
-            hasher = hashlib.md5()
-            hasher.update(self.empty_block)
-            hasher.update(self.manifest.salt)
-            self._empty_block_hash = hasher.hexdigest()
+            self._empty_block_hash = block_hash(
+                self.empty_block, self.manifest.salt,
+                self.manifest.hash_algorithm)
         return self._empty_block_hash
 
+    @property
+    def empty_block_hashes(self):
+        """
+        Empty block hashes under every algorithm the manifest has used.
+        """
+        return set(block_hash(self.empty_block, self.manifest.salt, algorithm)
+                   for algorithm in self.manifest.hash_algorithms)
+
     @property
     def empty_block(self):
         # alloc as needed
-        return '\x00' * BLOCK_SIZE
+        return '\x00' * self.manifest.block_size
 
     def _needs_upload(self, block, manifest_head, manifest_diff):
         upload = True
@@ -515,6 +1360,31 @@ class Worker(object):
 
         return upload
 
+    def _delta_parent(self, block, head, fingerprints, deltas):
+        """
+        Decide if a block that needs uploading can go up as a delta against
+        the block it replaces, returns the (parent, sub_chunk_size, indexes)
+        for Block.delta or None to upload the whole block.
+        """
+        parent = head[block.blockno]
+        if not block.fingerprints or parent == EMPTY_BLOCK or \
+                parent in self.empty_block_hashes:
+            return None
+        try:
+            indexes = diff(fingerprints[parent], block.fingerprints)
+        except KeyError:
+            return None
+        if not indexes:
+            return None
+        max_changed = int(chunk_count(block.fingerprints) *
+                          self.delta_max_changed)
+        if len(indexes) > max(1, max_changed):
+            return None
+        # re-base once the chain is long enough
+        if self.manifest.delta_depth(parent, deltas) >= self.delta_max_chain:
+            return None
+        return parent, self.delta_chunk_size, indexes
+
     def wait_for_stats(self, process, queue):
         # Wait for the stats process to finish.
         while process.is_alive():
@@ -522,62 +1392,278 @@ class Worker(object):
             logger.info('Waiting for stats process to die, qsize: %d',
                         queue.qsize())
 
-    def save(self, block_dev, backup_id, timestamp=None, cinder=None):
+    @property
+    def read_window_size(self):
+        return self.num_readers * self.readahead * 2
+
+    def _build_save_pool(self):
+        # A slab may be waiting to be put in order, queued for upload or in
+        # the hands of a reader or an upload in flight.
+        count = (self.read_window_size + self.num_readers + self.num_workers +
+                 self.num_workers * (self.async_uploads or 1))
+        pool = SlabPool(count, self.manifest.block_size)
+        logger.info('Save job slab pool: %d slabs, %d bytes' %
+                    (pool.count, pool.size))
+        return pool
+
+    def _start_readers(self, block_dev, blocknos, pool):
+        read_queue = multiprocessing.Queue()
+        window = ReadWindow(self.read_window_size)
+        readers = []
+        for i in xrange(self.num_readers):
+            reader = ReadProcess(block_dev, self.manifest.salt, blocknos, i,
+                                 self.num_readers, self.readahead,
+                                 read_queue, window, pool,
+                                 block_size=self.manifest.block_size,
+                                 sub_chunk_size=self.delta_chunk_size,
+                                 hash_algorithm=self.manifest.hash_algorithm,
+                                 budget=self.budget)
+            readers.append(reader)
+            reader.start()
+        return readers, read_queue, window
+
+    def _stop_readers(self, readers, read_queue, window):
+        window.stop()
+        # readers can't exit until everything they queued has been flushed
+        while any(reader.is_alive() for reader in readers):
+            try:
+                read_queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        for reader in readers:
+            reader.join()
+
+    def _read_blocks(self, block_dev, blocknos, readers, read_queue, window,
+                     pool):
+        """
+        Yield hashed blocks in the order of blocknos, reordering the results
+        coming back from the readers.
+        """
+        pending = {}
+        for position, blockno in enumerate(blocknos):
+            while blockno not in pending:
+                try:
+                    result = read_queue.get(timeout=1)
+                except Queue.Empty:
+                    if not any(reader.is_alive() for reader in readers):
+                        raise BlockReadFailed('Readers exited before '
+                                              'block #%s' % blockno)
+                    continue
+                read_blockno, slab, hash_, stats, prints = result
+                if hash_ is None:
+                    raise BlockReadFailed('Unable to read block #%s' %
+                                          read_blockno)
+                pending[read_blockno] = (slab, hash_, stats, prints)
+            slab, hash_, stats, prints = pending.pop(blockno)
+            window.advance(position + 1)
+            block = Block(block_dev, blockno, self.manifest.salt, pool=pool,
+                          slab=slab, block_size=self.manifest.block_size,
+                          hash_algorithm=self.manifest.hash_algorithm)
+            block._hash = hash_
+            block.stats.update(stats)
+            block.fingerprints = prints
+            yield block
+
+    def _changed_blocks(self, changes):
+        """
+        Map the chunks recorded from a tracking snapshot onto block numbers.
+        Returns None, meaning every block must be read, unless the tracking
+        snapshot was taken along with the most recent backup in the manifest.
+        """
+        if not changes or not self.manifest.history:
+            return None
+        if changes['timestamp'] != self.manifest.history[-1]:
+            logger.info('Tracking snapshot from %s does not match the most '
+                        'recent backup, doing a full scan' %
+                        changes['timestamp'])
+            return None
+        chunk_size = changes['chunk_size']
+        block_size = self.manifest.block_size
+        blocknos = set()
+        for chunk in changes['chunks']:
+            start = chunk * chunk_size
+            end = start + chunk_size - 1
+            blocknos.update(xrange(start // block_size,
+                                   end // block_size + 1))
+        return sorted(blockno for blockno in blocknos
+                      if blockno < self.manifest.block_count)
+
+    def _checkpoint(self, block_dev, backup_id, blocknos, head, diff,
+                    new_deltas):
+        """
+        Pick up where a save of the same backup from the same snapshot left
+        off, returns the checkpoint to keep up to date and the blocknos
+        still to be read.
+        """
+        key = {
+            'backup_id': backup_id,
+            'block_dev': block_dev,
+            # the new backup's timestamp and the one it is based on
+            'history': self.manifest.history[-2:],
+            'block_size': self.manifest.block_size,
+            'hash_algorithm': self.manifest.hash_algorithm,
+        }
+        path = self._checkpoint_path()
+        checkpoint = SaveCheckpoint.load(path, key,
+                                         interval=self.checkpoint_interval)
+        if not checkpoint:
+            return SaveCheckpoint(path, key,
+                                  interval=self.checkpoint_interval), blocknos
+        for blockno in blocknos:
+            if blockno > checkpoint.watermark:
+                break
+            diff[blockno] = checkpoint.changed.get(blockno, head[blockno])
+        self.hash_set.update(checkpoint.changed.values())
+        self.hash_set.update(checkpoint.uploaded)
+        new_deltas.update(checkpoint.deltas)
+        remaining = [blockno for blockno in blocknos
+                     if blockno > checkpoint.watermark]
+        logger.info('Resuming backup %s of volume %s after block #%s, '
+                    '%d of %d blocks left' % (backup_id, self.id,
+                                              checkpoint.watermark,
+                                              len(remaining), len(blocknos)))
+        return checkpoint, remaining
+
+    def _update_checkpoint(self, checkpoint, new_deltas):
+        while True:
+            try:
+                checkpoint.stored(self.done_queue.get_nowait())
+            except Queue.Empty:
+                break
+        if checkpoint.due():
+            checkpoint.write(new_deltas)
+
+    def save(self, block_dev, backup_id, timestamp=None, cinder=None,
+             changes=None, codec=None):
+        domain = self.domain
+        if not domain:
+            return self._save(block_dev, backup_id, timestamp=timestamp,
+                              cinder=cinder, changes=changes, codec=codec)
+        # audits of the domain won't delete blocks until we're done
+        first = not self.manifest.history
+        domain.start_save(self.id)
+        try:
+            # don't upload blocks any volume in the domain already has,
+            # our own saved manifest is in there after the first backup
+            self._hash_set = domain.block_set()
+            self._save(block_dev, backup_id, timestamp=timestamp,
+                       cinder=cinder, changes=changes, codec=codec)
+        except Exception:
+            if first:
+                # the first save joined, but there's nothing to show for it
+                domain.leave(self.id)
+            raise
+        finally:
+            domain.finish_save(self.id)
+
+    def _save(self, block_dev, backup_id, timestamp=None, cinder=None,
+              changes=None, codec=None):
+        # switching algorithm would upload every block again, the node
+        # needs what the volume was backed up with
+        validate_algorithm(self.manifest.hash_algorithm)
+        if self.upgrade_manifest:
+            self.manifest.upgrade()
+        # Must look at the history before the new backup is added to it
+        blocknos = self._changed_blocks(changes)
         try:
             diff = self.manifest.create_backup(backup_id, timestamp=timestamp)
         except DuplicateBackupIdError, e:
             logger.warning('Duplicate request to create existing backup.')
             return
 
+        if blocknos is None:
+            blocknos = range(self.manifest.block_count)
+        else:
+            logger.info('Tracking snapshot reports %d of %d blocks changed' %
+                        (len(blocknos), self.manifest.block_count))
+
         head = self.manifest.replay()
+        fingerprints = {}
+        new_fingerprints = {}
+        deltas = {}
+        new_deltas = {}
+        if self.delta_chunk_size:
+            fingerprints = self.manifest.fingerprints
+            deltas = self.manifest.deltas
+        checkpoint, blocknos = self._checkpoint(block_dev, backup_id,
+                                                blocknos, head, diff,
+                                                new_deltas)
+
+        pool = self._build_save_pool()
 
         processes = []
-        for i in xrange(NUM_WORKERS):
-            process = SaveProcess(self.conf, self.id, self.block_queue,
-                                  self.result_queue, self.stat_queue)
+        for i in xrange(self.num_workers):
+            kwargs = {}
+            process_class = SaveProcess
+            if self.async_uploads:
+                process_class = AsyncSaveProcess
+                kwargs['in_flight'] = self.async_uploads
+            process = process_class(self.conf, self.block_container,
+                                    self.block_queue, self.result_queue,
+                                    self.stat_queue, pool,
+                                    codec=codec or self.codec,
+                                    done_queue=self.done_queue,
+                                    budget=self.budget, **kwargs)
             processes.append(process)
 
         stats_process = StatsSaveProcess(
-            cinder, backup_id, self.stat_queue, self.manifest.block_count,
+            cinder, backup_id, self.stat_queue, len(blocknos),
             self.stats_lock, update_interval=self.update_interval)
         processes.append(stats_process)
 
         for process in processes:
             process.start()
 
+        readers, read_queue, window = self._start_readers(block_dev, blocknos,
+                                                          pool)
+
         total_results = defaultdict(int)
         block_failed = False
         blocks_to_upload = 0
-        for blockno in xrange(self.manifest.block_count):
-            block = Block(block_dev, blockno, self.manifest.salt)
-
-            try:
+        try:
+            for block in self._read_blocks(block_dev, blocknos, readers,
+                                           read_queue, window, pool):
                 needs_upload = self._needs_upload(block, head, diff)
+                checkpoint.read(block.blockno, block.hash,
+                                block.hash != head[block.blockno],
+                                needs_upload)
                 stat_task = ('read', 1)
                 self.stat_queue.put(stat_task)
-            except BlockReadFailed:
-                logger.error("BlockReadFailed blockno: %s" % blockno)
-                block_failed = True
-                break
-            except:
-                logger.exception("Unknown exception in worker.save")
-                block_failed = True
-                break
-
-            if needs_upload:
-                blocks_to_upload += 1
-                self.block_queue.put(block)
 
-            logger.debug("Block stats: %s" %
-                         simplejson.dumps(block.stats))
-            for stat in block.stats:
-                total_results[stat] += block.stats[stat]
+                if needs_upload:
+                    blocks_to_upload += 1
+                    parent = self._delta_parent(block, head, fingerprints,
+                                                deltas)
+                    if parent:
+                        new_deltas[block.hash] = parent[0]
+                    self.block_queue.put((block.blockno, block.hash,
+                                          block.slab, parent))
+                else:
+                    pool.release(block.slab)
+                if block.fingerprints:
+                    new_fingerprints[block.hash] = block.fingerprints
+
+                logger.debug("Block stats: %s" %
+                             simplejson.dumps(block.stats))
+                for stat in block.stats:
+                    total_results[stat] += block.stats[stat]
+                self._update_checkpoint(checkpoint, new_deltas)
+                if self.manifest.domain:
+                    self.domain.heartbeat()
+        except BlockReadFailed, e:
+            logger.error("BlockReadFailed: %s" % e)
+            block_failed = True
+        except:
+            logger.exception("Unknown exception in worker.save")
+            block_failed = True
+        finally:
+            self._stop_readers(readers, read_queue, window)
 
         stat_task = ('upload_count', blocks_to_upload)
         self.stat_queue.put(stat_task)
 
         # None is the special task to tell them to quit.
-        for i in xrange(NUM_WORKERS):
+        for i in xrange(self.num_workers):
             self.block_queue.put(None)
 
         # Waits until all tasks have been marked done.
@@ -587,68 +1673,333 @@ class Worker(object):
         self.stat_queue.put(None)
 
         logger.debug("Reading results")
-        for i in xrange(NUM_WORKERS):
+        for i in xrange(self.num_workers):
             result = self.result_queue.get()
             stats, errors = result
             logger.debug("Worker stats: %s" % simplejson.dumps(stats))
             logger.debug("Worker errors: %s" % simplejson.dumps(errors))
             for stat in stats:
                 total_results[stat] += stats[stat]
-
+        pool.close()
+
+        for name in CODECS:
+            if total_results.get('%s_bytes_in' % name):
+                total_results['%s_ratio' % name] = (
+                    float(total_results['%s_bytes_out' % name]) /
+                    total_results['%s_bytes_in' % name])
+        http_reuse_rate(total_results)
         logger.info('Save job stats: %s' % simplejson.dumps(total_results))
         # Any block read that throws an IOError will cause the backup to fail
         # completely and have the snap removed by the controller.
         if block_failed:
+            # the snapshot goes with it
+            checkpoint.remove()
             raise SaveFailedInvalidCow()
 
+        # a resumed save may have deltas even if they are now switched off
+        self.manifest.add_deltas(new_deltas)
+        if self.delta_chunk_size:
+            self.manifest.set_fingerprints(new_fingerprints)
         save_manifest(self.manifest, self.conn, self.id, self._lock_path())
+        checkpoint.remove()
 
         self.wait_for_stats(stats_process, self.stat_queue)
 
     def _iterblocks(self):
         """
         Iterate over object listing for container yielding out the object name
-        (block hash) for the blocks stored in the data store.
+        (block hash) for the blocks stored in the data store.  The next pages
+        of the listing are fetched while the caller works through this one.
         """
-        _headers, listing = self.conn.get_container(self.id)
-        while listing:
+        for name in prefetch_listing(self.conf, self.block_container,
+                                     self.listing_prefetch):
+            # the manifest root and its segments
+            if name.startswith('manifest') or name.startswith(DOMAIN_PREFIX):
+                continue
+            yield name
+
+    def _bulk_size(self):
+        """
+        Blocks to delete in each bulk request, 0 unless the cluster has the
+        middleware.  Blocks in a domain are always deleted one at a time,
+        with the X-Timestamp that spares a block another member uploads
+        meanwhile.
+        """
+        if not self.audit_bulk_delete or self.manifest.domain:
+            return 0
+        get_capabilities = getattr(self.conn, 'get_capabilities', None)
+        if not get_capabilities:
+            return 0
+        try:
+            capabilities = get_capabilities()
+        except self.conn.ClientException, e:
+            logger.info('Unable to get capabilities, deleting blocks one at '
+                        'a time: %s' % e)
+            return 0
+        bulk = capabilities.get('bulk_delete')
+        if not bulk:
+            return 0
+        return min(BULK_DELETE_SIZE,
+                   bulk.get('max_deletes_per_request', BULK_DELETE_SIZE))
+
+    def _deleter(self):
+        return Deleter(self.conf, self.audit_workers,
+                       bulk_size=self._bulk_size())
+
+    def _object_count(self, container):
+        try:
+            headers = self.conn.head_container(container)
+        except self.conn.ClientException, e:
+            logger.warning('Unable to count objects in %s: %s' % (
+                container, e))
+            return 0
+        return int(headers.get('x-container-object-count', 0))
+
+    def _audit_stats(self, start, listed, total, deleter, done=False):
+        if not self.stats_lock:
+            return
+        elapsed = time() - start
+        if total and not done:
+            # the total counts the manifest and such as well
+            progress = min(100.0, listed * 100.0 / total)
+        else:
+            progress = 100.0
+        stats = {
+            'blocks_listed': listed,
+            'object_count': total,
+            'blocks_deleted': deleter.deleted,
+            'delete_rate': deleter.deleted / elapsed if elapsed else 0.0,
+            'progress': progress,
+        }
+        try:
+            with self.stats_lock as lock:
+                lock.update(stats)
+        except OSError, e:
+            logger.error('Failed updating stats: %s' % e)
+
+    def _delete_block(self, container, hash_, ts):
+        try:
+            self.conn.delete_object(container, hash_,
+                                    headers={'X-Timestamp': ts})
+        except self.conn.ClientException, e:
+            if e.http_status != 404:
+                raise
+
+    def _block_set(self):
+        if not self.manifest.history:
+            # every backup is gone
+            return set()
+        return set(self.manifest.block_set)
+
+    def collect(self):
+        """
+        Delete the blocks in the journal which are still unreferenced.
+        """
+        journal = self.journal
+        batches = journal.batches()
+        if not batches:
+            return
+        block_set = self._block_set()
+        # blocks of a save that died, it may yet be resumed
+        block_set |= SaveCheckpoint.referenced(self._checkpoint_path())
+        deleter = self._deleter()
+        try:
+            for ts, container, hashes in batches:
+                for hash_ in hashes:
+                    if hash_ not in block_set:
+                        deleter.delete(container, hash_, ts)
+            deleter.finish()
+        finally:
+            deleter.stop()
+        logger.info('Deleted %s unreferenced blocks from %s' %
+                    (deleter.deleted, self.block_container))
+        for ts, container, hashes in batches:
+            journal.done(ts)
+
+    def _sweep_segments(self):
+        """
+        Delete the manifest segments left behind by saves that died.
+        """
+        keep = self.manifest.segments
+        for listing in container_pages(self.conn, self.id,
+                                       prefix=SEGMENT_PREFIX):
             for obj in listing:
-                if obj['name'] == 'manifest':
-                    continue
-                yield obj['name']
-            _headers, listing = self.conn.get_container(self.id,
-                                                        marker=obj['name'])
+                if obj['name'] not in keep:
+                    self._delete_block(self.id, obj['name'], time())
+
+    def _last_swept(self):
+        if self.manifest.domain:
+            # a sweep by any member covers the whole domain
+            return self.domain.last_swept()
+        return self.journal.last_swept()
+
+    def _sweep_due(self):
+        if not self.sweep_interval:
+            return True
+        return time() - self._last_swept() >= self.sweep_interval
+
+    def _postpone_sweep(self, domain, saving):
+        last = self._last_swept()
+        msg = 'Not auditing domain %s, saves in progress for %s' % (
+            domain.container, ', '.join(saving))
+        if self.sweep_interval and time() - last > 2 * self.sweep_interval:
+            logger.error('%s, last swept %s' % (msg, last))
+        else:
+            logger.info(msg)
 
-    def audit(self):
-        block_set = set(self.manifest.block_set)
-        ts = time()
-        for hash_ in self._iterblocks():
-            if hash_ not in block_set:
-                logger.debug('Found Unreferenced Block "%s/%s.%s"' % (
-                    self.id, hash_, ts))
-                self.conn.delete_object(self.id, hash_,
-                                        headers={'X-Timestamp': ts})
+    def audit(self, sweep=False):
+        """
+        Finish any deletes left in the journal.  Then, if sweep or it's
+        been a while, delete every other block nothing references.  Returns
+        False if that had to wait because of saves in progress elsewhere in
+        the domain, or another member's audit of it.
+        """
+        self.collect()
+        if not sweep and not self._sweep_due():
+            logger.info('Skipping audit sweep of %s, last swept %s' % (
+                self.block_container, self._last_swept()))
+            return True
+        domain = self.domain
+        if not domain:
+            return self._sweep()
+        if not domain.start_audit(self.id):
+            logger.info('Not auditing domain %s, %s is auditing it' % (
+                domain.container, domain.auditing()))
+            return False
+        try:
+            # saves that start from here on wait for us
+            saving = domain.saving()
+            if saving:
+                self._postpone_sweep(domain, saving)
+                return False
+            return self._sweep(domain)
+        finally:
+            domain.finish_audit(self.id)
+
+    def _sweep(self, domain=None):
+        start = time()
+        block_set = self._block_set()
+        if domain:
+            block_set |= domain.block_set()
+        # blocks of a save that died, it may yet be resumed
+        block_set |= SaveCheckpoint.referenced(self._checkpoint_path())
+        container = self.block_container
+        ts = start
+        total = self._object_count(container)
+        listed = 0
+        orphans = []
+        deleter = self._deleter()
+        try:
+            for hash_ in self._iterblocks():
+                listed += 1
+                if hash_ not in block_set:
+                    logger.debug('Found Unreferenced Block "%s/%s.%s"' % (
+                        container, hash_, ts))
+                    if domain:
+                        orphans.append(hash_)
+                    else:
+                        deleter.delete(container, hash_, ts)
+                if domain and not domain.heartbeat():
+                    return False
+                if not listed % self.update_interval:
+                    self._audit_stats(start, listed, total, deleter)
+            if domain:
+                # a save that began before we registered may only just
+                # have shown up in the listing
+                saving = domain.saving()
+                if saving:
+                    self._postpone_sweep(domain, saving)
+                    return False
+                if not domain.holds_audit(self.id):
+                    logger.info('Not deleting from domain %s, another '
+                                'member took over its audit' %
+                                domain.container)
+                    return False
+                for hash_ in orphans:
+                    if not domain.heartbeat():
+                        return False
+                    deleter.delete(container, hash_, ts)
+            deleter.finish()
+        finally:
+            deleter.stop()
+        self._audit_stats(start, listed, total, deleter, done=True)
+        duration = time() - start
+        logger.info('Deleted %s of %s blocks from %s in %.1fs' % (
+            deleter.deleted, listed, container, duration))
+        self._sweep_segments()
+        self.journal.swept(start)
+        if domain:
+            domain.swept(start)
+        return True
 
     def delete(self, backup_id):
         """Delete a backup.
 
-        This used to actually delete the blocks. Now it only deletes the
-        backup entry in the manifest. Audit does the actual block delete.
+        The blocks only the backup referenced are deleted along with it,
+        through the journal.  Blocks in a domain are left to the audit,
+        since other volumes may reference them.
         """
-        orig_block_set = set(self.manifest.block_set)
+        orig_block_set = self._block_set()
         # after this point a block could become valid for a new backup
         ts = time()
         self.manifest.delete_backup(backup_id)
+        new_block_set = self._block_set()
+        orphans = orig_block_set - new_block_set - set([EMPTY_BLOCK])
+        if orphans and not self.manifest.domain:
+            self.journal.add(self.block_container, orphans, ts)
         if self.manifest.history:
-            new_block_set = set(self.manifest.block_set)
             save_manifest(self.manifest, self.conn, self.id, self._lock_path())
         else:
-            new_block_set = set()
             delete_manifest(self.conn, self.id, self._lock_path())
+            if self.domain:
+                self.domain.leave(self.id)
+        self.collect()
         # Caller may want to know how many backups remain
         return self.manifest.history
 
-    def restore(self, backup_id, block_dev, volume_id=None, cinder=None):
+    def _restore_plan(self, backup, zeroed=False):
+        """
+        Break a backup up into the runs of (blocknos, hash) each restore
+        task handles, in block order.
+
+        Blocks sharing a hash make up a run of their own, so the object is
+        only fetched once.  Empty blocks aren't fetched at all and are
+        handed out one at a time, or left out if the destination is zeroed
+        already.  The rest are gathered into runs of adjacent blocks which
+        are written out at once.
+        """
+        empty = self.empty_block_hashes
+        counts = defaultdict(int)
+        for hash_ in backup:
+            counts[hash_] += 1
+        plan = []
+        groups = {}
+        run = []
+        for blockno, hash_ in enumerate(backup):
+            if counts[hash_] == 1 and hash_ not in empty:
+                if run and (len(run) >= self.restore_run_blocks or
+                            run[-1][0][0] != blockno - 1):
+                    run = []
+                if not run:
+                    plan.append(run)
+                run.append(([blockno], hash_))
+                continue
+            if hash_ in empty:
+                if not zeroed:
+                    plan.append([([blockno], hash_)])
+            elif hash_ in groups:
+                groups[hash_].append(blockno)
+            else:
+                groups[hash_] = [blockno]
+                plan.append([(groups[hash_], hash_)])
+        return plan
+
+    def restore(self, backup_id, block_dev, volume_id=None, cinder=None,
+                zeroed=False):
+        """
+        Write the blocks of a backup to block_dev, zeroed says block_dev
+        was created for this restore and already reads as zeros.
+        """
         logger.debug('Restoring %s/%s to %s' % (self.id, backup_id, block_dev))
         if not os.path.exists(block_dev):
             raise Exception('ENOENT on %s' % block_dev)
@@ -656,11 +2007,19 @@ class Worker(object):
         self.update_volume_metadata(cinder, volume_id,
                                     {'restore-progress': "%.2f%%" % 0})
 
+        # empty blocks aren't stored, so we must be able to recognize them
+        for algorithm in self.manifest.hash_algorithms:
+            validate_algorithm(algorithm)
+
         processes = []
-        for i in xrange(NUM_RESTORE_WORKERS):
-            process = RestoreProcess(self.conf, self.id, self.block_queue,
-                                     self.result_queue, self.stat_queue,
-                                     self.manifest.salt)
+        for i in xrange(self.num_restore_workers):
+            process = RestoreProcess(
+                self.conf, self.block_container, self.block_queue,
+                self.result_queue, self.stat_queue, self.manifest.salt,
+                block_size=self.manifest.block_size,
+                hash_algorithms=self.manifest.hash_algorithms,
+                budget=self.budget, run_blocks=self.restore_run_blocks,
+                prefetch=self.restore_prefetch)
             processes.append(process)
 
         stats_process = StatsRestoreProcess(
@@ -672,13 +2031,18 @@ class Worker(object):
             process.start()
 
         total_results = defaultdict(int)
-        blocks_to_upload = 0
-        for blockno, hash_ in enumerate(backup):
-            task = (block_dev, blockno, hash_)
+        plan = self._restore_plan(backup, zeroed=zeroed)
+        empty_skipped = len(backup) - sum(len(blocknos) for run in plan
+                                          for blocknos, hash_ in run)
+        if empty_skipped:
+            total_results['empty_skipped'] = empty_skipped
+            self.stat_queue.put(('restored', empty_skipped))
+        for run in plan:
+            task = (block_dev, run)
             self.block_queue.put(task)
 
         # None is the special task to tell them to quit.
-        for i in xrange(NUM_RESTORE_WORKERS):
+        for i in xrange(self.num_restore_workers):
             self.block_queue.put(None)
 
         # Waits until all tasks have been marked done.
@@ -687,13 +2051,14 @@ class Worker(object):
         # Now kill the stat worker
         self.stat_queue.put(None)
 
-        for i in xrange(NUM_RESTORE_WORKERS):
+        for i in xrange(self.num_restore_workers):
             result = self.result_queue.get()
             stats, errors = result
             logger.debug("Worker stats: %s" % simplejson.dumps(stats))
             logger.debug("Worker errors: %s" % simplejson.dumps(errors))
             for stat in stats:
                 total_results[stat] += stats[stat]
+        http_reuse_rate(total_results)
 
         logger.info('Restore job stats: %s' % simplejson.dumps(total_results))
 
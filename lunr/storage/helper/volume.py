@@ -31,7 +31,7 @@ from tempfile import mkdtemp
 import uuid
 
 from lunr.common import logger
-from lunr.common.lock import ResourceFile, NullResource
+from lunr.common.lock import ResourceFile, NullResource, JsonLockFile
 from lunr.storage.helper.utils import execute, NotFound, \
     ProcessError, AlreadyExists, InvalidImage, ServiceUnavailable
 from lunr.storage.helper.utils.glance import GlanceError, \
@@ -39,6 +39,7 @@ from lunr.storage.helper.utils.glance import GlanceError, \
 
 from lunr.cinder.cinderclient import CinderError
 from lunr.storage.helper.utils.jobs import spawn
+from lunr.storage.helper.utils.budget import Budget, IMAGE, WRITE, NETWORK
 from lunr.storage.helper.utils.worker import Worker
 from lunr.storage.helper.utils.scrub import Scrub, ScrubError
 from lunr.storage.helper.utils.iscsi import ISCSIDevice, ISCSILoginFailed, \
@@ -56,6 +57,9 @@ def decode_tag(tag):
     # Is a snapshot undergoing a backup
     if parts[0] == 'backup':
         return {'timestamp': float(parts[1]), 'backup_id': parts[2]}
+    # Is a snapshot tracking changes since a backup
+    if parts[0] == 'track':
+        return {'timestamp': float(parts[1]), 'tracking': True}
     if parts[0] == 'clone':
         return {'clone_id': parts[1]}
     if parts[0] == 'convert':
@@ -65,9 +69,12 @@ def decode_tag(tag):
 
 
 def encode_tag(backup_source_volume_id=None, backup_id=None, timestamp=None,
-               zero=False, clone_id=None, image_id=None, **kwargs):
+               zero=False, clone_id=None, image_id=None, tracking=False,
+               **kwargs):
     if zero:
         return 'zero'
+    if tracking and timestamp:
+        return 'track.%d' % int(timestamp)
     if timestamp and backup_id:
         return 'backup.%d.%s' % (int(timestamp), backup_id)
     if backup_source_volume_id and backup_id:
@@ -107,6 +114,12 @@ class VolumeHelper(object):
                                                    4.0)
         self.skip_fork = conf.bool('storage', 'skip_fork', False)
         self.scrub = Scrub(conf)
+        # Every volume is scrubbed before its extents are freed, so a new
+        # volume reads as zeros, unless scrubs only display
+        self.new_volumes_zeroed = conf.bool(
+            'volume', 'new_volumes_zeroed', True) and \
+            not conf.bool('scrub', 'display-only', False)
+        self.budget = Budget(conf)
         self.conf = conf
         self.max_snapshot_bytes = conf.int('volume', 'max_snapshot_bytes',
                                            None)
@@ -117,6 +130,12 @@ class VolumeHelper(object):
             if max_bytes != self.max_snapshot_bytes:
                 logger.info("Setting max_snapshot_size to %s" % max_bytes)
                 self.max_snapshot_bytes = max_bytes
+        # Keep a small snapshot between backups whose exception table
+        # tells the next backup which chunks have been written to.
+        self.track_changes = conf.bool('volume', 'track_changes', False)
+        tracking_bytes = conf.int('volume', 'tracking_snapshot_bytes',
+                                  1073741824)
+        self.tracking_snapshot_bytes = tracking_bytes - tracking_bytes % 512
         self.has_old_mkfs = self.old_mkfs()
 
     def check_config(self):
@@ -163,6 +182,9 @@ class VolumeHelper(object):
     def _stats_file(self, id):
         return join(self.run_dir, 'volumes/%s/stats' % id)
 
+    def _changes_file(self, id):
+        return join(self.run_dir, 'volumes/%s/changes' % id)
+
     def _get_path(self, id):
         return join(self.device_prefix, self.volume_group, id)
 
@@ -206,12 +228,18 @@ class VolumeHelper(object):
 
     def _get_snapshot(self, id):
         for volume in self._scan_volumes():
-            if volume['origin'] == id:
+            if volume['origin'] == id and 'tracking' not in volume:
                 return volume
         return None
 
+    def _get_tracking_snapshots(self, id):
+        trackers = [volume for volume in self._scan_volumes()
+                    if volume['origin'] == id and 'tracking' in volume]
+        return sorted(trackers, key=lambda v: v['timestamp'])
+
     def list(self):
-        return self._scan_volumes()
+        return [volume for volume in self._scan_volumes()
+                if 'tracking' not in volume]
 
     def _in_use(self, volume_id):
         resource_file = self._resource_file(volume_id)
@@ -245,7 +273,7 @@ class VolumeHelper(object):
         return volume
 
     def restore(self, dest_volume, backup_source_volume_id,
-                backup_id, size, cinder):
+                backup_id, size, cinder, zeroed=False):
         op_start = time()
         logger.rename('lunr.storage.helper.volume.restore')
         setproctitle("lunr-restore: " + dest_volume['id'])
@@ -254,7 +282,7 @@ class VolumeHelper(object):
                         stats_path=job_stats_path)
         try:
             worker.restore(backup_id, dest_volume['path'],
-                           dest_volume['id'], cinder)
+                           dest_volume['id'], cinder, zeroed=zeroed)
         finally:
             os.unlink(job_stats_path)
         self.update_tags(dest_volume, {})
@@ -277,6 +305,8 @@ class VolumeHelper(object):
 
                 try:
                     for chunk in chunks:
+                        self.budget.take(IMAGE, NETWORK, len(chunk))
+                        self.budget.take(IMAGE, WRITE, len(chunk))
                         f.write(chunk)
                     break
                 # Glanceclient doesn't handle socket timeouts for chunk reads.
@@ -456,6 +486,10 @@ class VolumeHelper(object):
 
     def _do_create(self, volume_id, size_str, tag,
                    backup_source_volume_id=None):
+        """
+        Create the logical volume, returns False if it was left over from
+        an earlier attempt at the same restore.
+        """
         try:
             out = execute('lvcreate', self.volume_group,
                           name=volume_id, size=size_str, addtag=tag)
@@ -473,10 +507,12 @@ class VolumeHelper(object):
             if backup_source_volume_id and backup_source_volume_id == \
                     self.get(volume_id).get('backup_source_volume_id', False):
                 logger.info("Restarting failed restore on '%s'" % volume_id)
+                return False
             else:
                 raise AlreadyExists("Unable to create a new volume named "
                                     "'%s' because one already exists." %
                                     volume_id)
+        return True
 
     def create_convert_scratch(self, image, size):
         volume_id = uuid.uuid4()
@@ -535,7 +571,8 @@ class VolumeHelper(object):
                          backup_id=backup_id)
 
         try:
-            self._do_create(volume_id, size_str, tag, backup_source_volume_id)
+            created = self._do_create(volume_id, size_str, tag,
+                                      backup_source_volume_id)
         except Exception, e:
             # If we ran out of space due to the tmp_vol
             logger.error('Failed to create volume: %s' % e)
@@ -577,6 +614,7 @@ class VolumeHelper(object):
             size = (dest_volume['size'] / 1024 / 1024 / 1024)
             spawn(lock, self.restore, dest_volume,
                   backup_source_volume_id, backup_id, size, cinder,
+                  created and self.new_volumes_zeroed,
                   callback=callback_wrap, skip_fork=self.skip_fork)
         elif image_id:
             # TODO: clean up this volume if the spawn fails
@@ -627,16 +665,76 @@ class VolumeHelper(object):
         else:
             raise ValueError("Invalid snapshot type: %s" % type_)
 
+        tracker = None
+        if type_ == 'backup' and self.track_changes:
+            trackers = self._get_tracking_snapshots(volume_id)
+            # The new tracking snapshot must exist before the backup
+            # snapshot, so no write can slip in between the two.
+            tracker = self._create_tracking_snapshot(origin, timestamp)
+
         try:
             # Create an lvm snapshot
             execute('lvcreate', origin['path'], name=snapshot_id,
                     size=sizestr, snapshot=None, addtag=tag)
-            return self.get(snapshot_id)
         except ProcessError, e:
+            if tracker:
+                self.remove_lvm_snapshot(tracker)
             if e.errcode != 5 or 'already exists' not in e.err:
                 raise
             raise AlreadyExists("snapshot id '%s' already in use" % id)
 
+        if tracker:
+            trackers = [t for t in trackers if t['id'] != tracker['id']]
+            self._save_changes(volume_id, trackers)
+        return self.get(snapshot_id)
+
+    def _create_tracking_snapshot(self, origin, timestamp):
+        tracker_id = '%s.track.%d' % (origin['id'], timestamp)
+        size = min(self.tracking_snapshot_bytes,
+                   self._max_snapshot_size(origin['size']))
+        tag = encode_tag(tracking=True, timestamp=timestamp)
+        try:
+            execute('lvcreate', origin['path'], name=tracker_id,
+                    size='%sB' % size, snapshot=None, addtag=tag)
+        except ProcessError, e:
+            # A retry of the same backup, the existing tracker has been
+            # around longer than this one would be, so it is still good.
+            if e.errcode != 5 or 'already exists' not in e.err:
+                raise
+        return self.get(tracker_id)
+
+    def _save_changes(self, volume_id, trackers):
+        """
+        Record the chunks written since the most recent tracking snapshot
+        was taken for the backup about to run, and remove the old trackers.
+        """
+        changes = {}
+        if trackers:
+            tracker = trackers[-1]
+            try:
+                chunk_size, chunks = self.scrub.changed_chunks(tracker)
+                if chunks is None:
+                    logger.warning("Tracking snapshot '%s' overflowed, "
+                                   "next backup does a full scan" %
+                                   tracker['id'])
+                else:
+                    changes = {
+                        'timestamp': tracker['timestamp'],
+                        'chunk_size': chunk_size,
+                        'chunks': sorted(chunks),
+                    }
+            except ScrubError, e:
+                logger.warning("Unable to read tracking snapshot '%s': %s" %
+                               (tracker['id'], e))
+
+        lock = JsonLockFile(self._changes_file(volume_id))
+        with lock:
+            lock.write(changes)
+        lock.close()
+
+        for tracker in trackers:
+            self.remove_lvm_snapshot(tracker)
+
     def _copy_clone(self, snapshot, clone_id, size, iscsi_device, cinder=None):
         def progress_callback(percent):
             try:
@@ -652,7 +750,8 @@ class VolumeHelper(object):
         setproctitle("lunr-clone: %s %s" % (snapshot['origin'], clone_id))
         try:
             iscsi_device.copy_file_out(snapshot['path'],
-                                       callback=progress_callback)
+                                       callback=progress_callback,
+                                       budget=self.budget)
         except (ISCSINotConnected, ISCSICopyFailed), e:
             logger.error("copy_file_out failed: %s" % str(e))
             raise
@@ -715,7 +814,15 @@ class VolumeHelper(object):
             op_start = time()
             volume = self.get(snapshot['origin'])
             logger.rename('lunr.storage.helper.volume.remove_lvm_snapshot')
-            self.scrub.scrub_snapshot(snapshot, volume)
+            siblings = [v for v in self._scan_volumes()
+                        if v['origin'] == snapshot['origin'] and
+                        v['id'] != snapshot['id']]
+            if siblings:
+                # a tracker and a backup snapshot share the origin, lvremove
+                # reloads it without this one and keeps the others' cow
+                self.scrub.scrub_live_cow(snapshot)
+            else:
+                self.scrub.scrub_snapshot(snapshot, volume)
             self.remove(snapshot['path'])
             # TODO: Failure to scrub a snapshot is un-acceptable
             # If we catch an exception, we should mark the snapshot
@@ -790,6 +897,8 @@ class VolumeHelper(object):
                 raise ServiceUnavailable(
                     "Refusing to delete volume '%s' "
                     "with an active backup" % volume['id'])
+            for tracker in self._get_tracking_snapshots(volume['id']):
+                self.remove_lvm_snapshot(tracker)
             try:
                 self.update_tags(volume, {'zero': True})
             except NotFound:
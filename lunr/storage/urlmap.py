@@ -67,5 +67,5 @@ lunr_connect(urlmap, '/volumes/{volume_id}/clones/{id}',
 lunr_connect(urlmap, '/status', StatusController, {'GET': 'index'})
 lunr_connect(urlmap, '/status/api', StatusController, {'GET': 'api_status'})
 lunr_connect(urlmap, '/status/conf', StatusController, {'GET': 'conf_status'})
-lunr_connect(urlmap, '/status/{helper_type:(volumes|exports|backups)}',
+lunr_connect(urlmap, '/status/{helper_type:(volumes|exports|backups|budget)}',
              StatusController, {'GET': 'show'})
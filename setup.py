@@ -50,4 +50,5 @@ setup(
             'lunr-orbit = lunr.orbit.console:main',
             ],
         }, requires=['sqlalchemy'],
+    extras_require={'blake2b': ['pyblake2']},
     )
@@ -45,7 +45,7 @@ class MockResponse(object):
 
 class MockUrllib(object):
 
-    def urlopen(self, req):
+    def urlopen(self, req, timeout=None):
         resp = self.responses.next()
         try:
             return resp(req)
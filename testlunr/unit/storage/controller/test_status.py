@@ -47,12 +47,19 @@ class MockBackupHelper(object):
         return {'backups_status': 'OK'}
 
 
+class MockBudget(object):
+
+    def status(self):
+        return {'budget_status': 'OK'}
+
+
 class MockHelper(object):
 
     def __init__(self):
         self.volumes = MockVolumeHelper()
         self.exports = MockExportHelper()
         self.backups = MockBackupHelper()
+        self.budget = MockBudget()
 
     def api_status(self):
         return {'api_status': 'OK'}
@@ -200,6 +207,12 @@ class TestStatusController(WsgiTestBase):
         self.assert_('Something unexpected happened' not in
                      resp.body['reason'])
 
+    def test_budget_status(self):
+        self.app = StorageWsgiApp(self.test_conf, urlmap, MockHelper())
+        resp = self.request('/status/budget')
+        self.assertEquals(resp.code // 100, 2)
+        self.assertEquals(resp.body, {'budget_status': 'OK'})
+
     def test_status(self):
         self.app = StorageWsgiApp(self.test_conf, urlmap, MockHelper())
         resp = self.request('/status')
@@ -209,6 +222,7 @@ class TestStatusController(WsgiTestBase):
             'volumes': {'volumes_status': 'OK'},
             'exports': {'exports_status': 'OK'},
             'backups': {'backups_status': 'OK'},
+            'budget': {'budget_status': 'OK'},
         }
         self.assertEquals(resp.body, expected)
 
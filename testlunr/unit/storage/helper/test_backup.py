@@ -27,7 +27,8 @@ from time import sleep
 import logging
 
 from lunr.storage.helper.utils import jobs, ServiceUnavailable
-from lunr.storage.helper.utils.manifest import Manifest
+from lunr.storage.helper.utils.manifest import Manifest, PackedHashes, \
+    fetch_manifest
 from lunr.storage.helper.utils.worker import Block
 from lunr.storage.helper import backup
 from lunr.storage.helper.utils.client import get_conn
@@ -159,16 +160,107 @@ class TestBackupHelper(unittest.TestCase):
             self.assert_(callback.ran)
 
         conn = get_conn(self.conf)
-        _headers, raw_json_string = conn.get_object('vol1',
-                                                    'manifest', newest=True)
-        m = Manifest.loads(raw_json_string)
+        m = fetch_manifest(conn, 'vol1')
         self.assertEquals(m.block_count, 1)
         self.assertEquals(m.backups['backup1'], 1.0)
         self.assertEquals(m.history, [1.0])
-        self.assert_(isinstance(m[m.history[0]], list))
+        # stored as json until the manifest is upgraded
+        self.assertEquals(m.version, '1.3')
+        self.assertFalse(isinstance(m[m.history[0]], PackedHashes))
         stats_path = h._stats_file('vol1')
         self.assertFalse(os.path.exists(stats_path))
 
+    def test_create_first_backup_block_size(self):
+        h = backup.BackupHelper(self.conf)
+        snapshot = {
+            'id': 'bak1',
+            'timestamp': 1.0,
+            'path': os.path.join(self.scratch, 'bak1'),
+            'origin': 'vol1',
+            'size': 4 * 1024 * 1024,
+        }
+        with open(snapshot['path'], 'w') as f:
+            f.write('\x00' * snapshot['size'])
+
+        with mock_spawn() as j:
+            h.create(snapshot, 'backup1', lambda: None,
+                     block_size=1024 * 1024)
+            j.run_job()
+
+        conn = get_conn(self.conf)
+        m = fetch_manifest(conn, 'vol1')
+        self.assertEquals(m.block_size, 1024 * 1024)
+        self.assertEquals(m.block_count, 4)
+
+    def test_block_size(self):
+        self.conf.set('backup', 'block_size', 8 * 1024 * 1024)
+        self.conf.set('backup_block_size', 'ssd', 1024 * 1024)
+        h = backup.BackupHelper(self.conf)
+        self.assertEquals(h.block_size(), 8 * 1024 * 1024)
+        self.assertEquals(h.block_size('sata'), 8 * 1024 * 1024)
+        self.assertEquals(h.block_size('ssd'), 1024 * 1024)
+        self.assertEquals(h.block_size('ssd', '16777216'), 16 * 1024 * 1024)
+        self.assertRaises(ValueError, h.block_size, 'ssd', '1000')
+
+    def test_dedup_domain(self):
+        self.conf.set('backup', 'dedup_domain', 'account')
+        h = backup.BackupHelper(self.conf)
+        self.assertEquals(h.domain(), None)
+        domain = h.domain(account='acct1', volume_type='ssd')
+        self.assertEquals(domain, 'dedup-account-acct1')
+        conn = get_conn(self.conf)
+
+        def blocks():
+            _headers, listing = conn.get_container(domain)
+            return [o['name'] for o in listing
+                    if not o['name'].startswith('domain')]
+
+        # two clones of the same image
+        for volume_id in ('vol1', 'vol2'):
+            snapshot = {
+                'id': 'bak-%s' % volume_id,
+                'timestamp': 1.0,
+                'path': os.path.join(self.scratch, volume_id),
+                'origin': volume_id,
+                'size': 8 * 1024 * 1024,
+            }
+            with open(snapshot['path'], 'w') as f:
+                f.write('a' * 4 * 1024 * 1024)
+                f.write('b' * 4 * 1024 * 1024)
+            with mock_spawn() as j:
+                h.create(snapshot, 'backup-%s' % volume_id, lambda: None,
+                         domain=domain)
+                j.run_job()
+            self.assertEquals(len(blocks()), 2)
+
+        manifests = [fetch_manifest(conn, v) for v in ('vol1', 'vol2')]
+        self.assertEquals(manifests[0].domain, domain)
+        self.assertEquals(manifests[0].salt, manifests[1].salt)
+        self.assertEquals(manifests[0].replay(), manifests[1].replay())
+        _headers, listing = conn.get_container('vol1')
+        self.assertEquals(sorted(o['name'] for o in listing),
+                          ['domain', 'manifest'] +
+                          sorted(manifests[0].segments))
+
+        # vol2 still needs the blocks after vol1's backup is gone
+        h.prune({'id': 'vol1'}, 'backup-vol1')
+        h.audit({'id': 'vol1'})
+        self.assertEquals(len(blocks()), 2)
+        self.assertEquals(conn.get_container('vol1')[1], [])
+        h.prune({'id': 'vol2'}, 'backup-vol2')
+        h.audit({'id': 'vol2'})
+        self.assertEquals(blocks(), [])
+        self.assertEquals(conn.get_container('vol2')[1], [])
+
+    def test_codec(self):
+        self.conf.set('backup_codec', 'archive', 'zlib')
+        self.conf.set('backup_codec', 'broken', 'rar')
+        h = backup.BackupHelper(self.conf)
+        self.assertEquals(h.codec(), 'lz4')
+        self.assertEquals(h.codec('sata'), 'lz4')
+        self.assertEquals(h.codec('archive'), 'zlib')
+        self.assertRaises(ValueError, h.codec, 'broken')
+
     def test_create_fail_ioerror(self):
         h = backup.BackupHelper(self.conf)
 
@@ -587,7 +587,7 @@ class TestHelper(BaseHelper):
         h = base.Helper(self.conf)
         self.assertEquals(cinder_host, h.cinder_host)
 
-    def _mock_urlopen(self, req):
+    def _mock_urlopen(self, req, timeout=None):
         validator = self.validator_gen.next()
         code, info = validator(req)
         body = StringIO(dumps(info))
@@ -20,6 +20,7 @@ from tempfile import mkdtemp
 from shutil import rmtree
 import socket
 from uuid import uuid4
+import json
 
 from testlunr.unit.storage.helper.test_helper import BaseHelper
 from testlunr.unit import patch, MockResourceLock
@@ -740,6 +741,9 @@ class TestVolumeNameEncoding(unittest.TestCase):
         # image conversion
         result = encode_tag(image_id='someimageid')
         self.assertEquals(result, 'convert.someimageid')
+        # tracking snapshot
+        result = encode_tag(tracking=True, timestamp=1)
+        self.assertEquals(result, 'track.1')
 
     def test_decode_tag(self):
         # normal volume
@@ -764,6 +768,11 @@ class TestVolumeNameEncoding(unittest.TestCase):
         self.assertEquals(decode_tag('convert.someimageid'), {
                 'image_id': 'someimageid',
             })
+        # tracking snapshot
+        self.assertEquals(decode_tag('track.1'), {
+                'tracking': True,
+                'timestamp': 1.0,
+            })
 
     def test_unknown_tag(self):
         self.assertEquals(decode_tag('blah'), {'volume': True})
@@ -844,6 +853,78 @@ class TestVolumeSnapshot(BaseHelper):
             h.delete(snap_id1, lock=MockResourceLock())
             h.delete(volume_id, lock=MockResourceLock())
 
+    def test_snapshot_track_changes(self):
+        scrubbed = []
+
+        def mock_scrub(snap, vol=None):
+            scrubbed.append(snap['id'])
+
+        def mock_changed_chunks(snap):
+            return 4096, set([1024, 1])
+
+        self.conf.set('volume', 'track_changes', True)
+        h = volume.VolumeHelper(self.conf)
+        changes_file = h._changes_file('v1')
+        h.create('v1')
+        with patch(h.scrub, 'scrub_snapshot', mock_scrub), \
+                patch(h.scrub, 'scrub_live_cow', mock_scrub):
+            with patch(h.scrub, 'changed_chunks', mock_changed_chunks):
+                # first backup has nothing to go on
+                h.create_snapshot('v1', 'b1', timestamp=1)
+                with open(changes_file) as f:
+                    self.assertEquals(json.loads(f.read()), {})
+                self.assertEquals([v['id'] for v in h.list()], ['v1', 'b1'])
+                self.assertEquals(h._get_snapshot('v1')['id'], 'b1')
+                h.delete('b1')
+
+                h.create_snapshot('v1', 'b2', timestamp=2)
+                with open(changes_file) as f:
+                    self.assertEquals(json.loads(f.read()), {
+                        'timestamp': 1.0,
+                        'chunk_size': 4096,
+                        'chunks': [1, 1024],
+                    })
+                trackers = h._get_tracking_snapshots('v1')
+                self.assertEquals([t['id'] for t in trackers],
+                                  ['v1.track.2'])
+                h.delete('b2')
+                h.delete('v1', lock=MockResourceLock())
+        self.assertEquals(scrubbed, ['b1', 'v1.track.1', 'b2', 'v1.track.2'])
+        self.assertEquals(self.storage.volumes, [])
+
+    def test_remove_snapshot_keeps_siblings(self):
+        reloaded = []
+        live = []
+
+        def mock_scrub(snap, vol):
+            # reloads the origin, which takes every snapshot's cow with it
+            reloaded.append((snap['id'], sorted(
+                v['id'] for v in h._scan_volumes()
+                if v['origin'] == vol['id'] and v['id'] != snap['id'])))
+
+        def mock_scrub_live_cow(snap):
+            live.append(snap['id'])
+
+        def mock_changed_chunks(snap):
+            return 4096, set([1])
+
+        self.conf.set('volume', 'track_changes', True)
+        h = volume.VolumeHelper(self.conf)
+        h.create('v1')
+        with patch(h.scrub, 'scrub_snapshot', mock_scrub), \
+                patch(h.scrub, 'scrub_live_cow', mock_scrub_live_cow):
+            with patch(h.scrub, 'changed_chunks', mock_changed_chunks):
+                h.create_snapshot('v1', 'b1', timestamp=1)
+                # the tracker is still on the origin
+                h.delete('b1')
+                # the new tracker and backup snapshot are on the origin
+                h.create_snapshot('v1', 'b2', timestamp=2)
+                h.delete('b2')
+                h.delete('v1', lock=MockResourceLock())
+        self.assertEquals(live, ['b1', 'v1.track.1', 'b2'])
+        # the origin was only reloaded once nothing else was on it
+        self.assertEquals(reloaded, [('v1.track.2', [])])
+
 
 if __name__ == "__main__":
     unittest.main()
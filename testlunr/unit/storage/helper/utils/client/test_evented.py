@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import unittest
+from StringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from hashlib import md5
+from httplib import HTTPException
+from SocketServer import ThreadingMixIn
+from urllib import unquote
+from urlparse import urlparse
+
+from lunr.storage.helper.utils.client import swift
+from lunr.storage.helper.utils.client.evented import AsyncConnection, \
+    Response
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        with server.lock:
+            server.requests += 1
+            server.tokens.add(self.headers['x-auth-token'])
+            if server.failures:
+                return self._reply(server.failures.pop(0))
+        if self.headers['x-auth-token'] in server.rejected:
+            return self._reply(401)
+        parsed = urlparse(self.path)
+        parts = [unquote(part) for part in parsed.path.split('/')]
+        if len(parts) == 4:
+            listing = [{'name': name} for name in sorted(server.objects)]
+            if 'marker=' in parsed.query:
+                marker = unquote(parsed.query.split('marker=')[1])
+                listing = [item for item in listing if item['name'] > marker]
+            return self._reply(200, json.dumps(listing[:2]))
+        name = parts[4]
+        if self.command == 'PUT':
+            server.objects[name] = body
+            return self._reply(201, headers={'Etag': md5(body).hexdigest()})
+        if name not in server.objects:
+            return self._reply(404)
+        if self.command == 'GET':
+            return self._reply(200, server.objects[name])
+        del server.objects[name]
+        self._reply(204)
+
+    do_GET = do_PUT = do_DELETE = _handle
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestResponse(unittest.TestCase):
+
+    def test_content_length(self):
+        resp = Response('GET')
+        resp.feed('HTTP/1.1 200 OK\r\nContent-Length: 5\r\nX-A: b\r\n\r\nab')
+        self.assertEquals(resp.status, 200)
+        self.assertEquals(resp.getheader('x-a'), 'b')
+        self.assertFalse(resp.complete)
+        resp.feed('cde')
+        self.assert_(resp.complete)
+        self.assertEquals(resp.body, 'abcde')
+        self.assertFalse(resp.will_close)
+
+    def test_chunked(self):
+        resp = Response('GET')
+        data = ('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                '3\r\nabc\r\na;ext=1\r\n0123456789\r\n0\r\n\r\n')
+        for i in range(len(data)):
+            self.assertFalse(resp.complete)
+            resp.feed(data[i])
+        self.assert_(resp.complete)
+        self.assertEquals(resp.body, 'abc0123456789')
+
+    def test_until_closed(self):
+        resp = Response('GET')
+        resp.feed('HTTP/1.0 200 OK\r\n\r\nabc')
+        self.assert_(resp.will_close)
+        self.assertFalse(resp.complete)
+        resp.feed('')
+        self.assertEquals(resp.body, 'abc')
+
+    def test_short(self):
+        resp = Response('GET')
+        resp.feed('HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nab')
+        self.assertRaises(HTTPException, resp.feed, '')
+        self.assertRaises(HTTPException, Response('GET').feed, '')
+
+
+class TestAsyncConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.objects = {}
+        self.server.requests = 0
+        self.server.tokens = set()
+        self.server.rejected = set()
+        self.server.failures = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:%s/v1/acct' % self.server.server_port
+        self.auths = []
+
+        def get_auth():
+            self.auths.append('token%s' % len(self.auths))
+            return url, self.auths[-1]
+        self.conn = swift.Connection('http://auth', 'user', 'key', 'USA',
+                                     retries=2, preauthurl=url,
+                                     preauthtoken='token', starting_backoff=0)
+        self.conn.get_auth = get_auth
+        self.aconn = AsyncConnection(self.conn, max_in_flight=4, timeout=5)
+
+    def tearDown(self):
+        self.aconn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_many_in_flight(self):
+        requests = [self.aconn.submit_put_object('vol1', 'block %s' % i,
+                                                 'data%s' % i)
+                    for i in range(10)]
+        self.assertEquals(len(self.aconn), 10)
+        self.assertEquals(len(self.aconn.active), 4)
+        finished = []
+        while len(self.aconn):
+            finished.extend(self.aconn.run())
+        self.assertEquals(sorted(finished), sorted(requests))
+        for i, request in enumerate(requests):
+            self.assertEquals(request.result(),
+                              md5('data%s' % i).hexdigest())
+        self.assertEquals(len(self.server.objects), 10)
+        self.assertEquals(self.aconn.stats['handshakes'], 4)
+        self.assertEquals(self.aconn.stats['reused'], 6)
+
+    def test_blocking(self):
+        class Contents(object):
+            def read(self, size=None):
+                return 'abc'[:size]
+        self.aconn.put_object('vol1', 'a', Contents(), content_length=2)
+        self.aconn.put_object('vol1', 'b', 'b')
+        self.aconn.put_object('vol1', 'c', '')
+        self.assertEquals(self.aconn.get_object('vol1', 'a')[1], 'ab')
+        headers, listing = self.aconn.get_container('vol1', full_listing=True)
+        self.assertEquals([item['name'] for item in listing], ['a', 'b', 'c'])
+        self.assertEquals(len(self.aconn.get_container('vol1')[1]), 2)
+        self.aconn.delete_object('vol1', 'a')
+        try:
+            self.aconn.get_object('vol1', 'a')
+        except swift.ClientException, e:
+            self.assertEquals(e.http_status, 404)
+        else:
+            self.fail('get_object did not raise')
+
+    def test_unjoined_body(self):
+        class Contents(StringIO):
+            def read(self, size=None):
+                raise AssertionError('body copied out with read')
+        body = ''.join(chr(i % 251) for i in range(3 * 1024 * 1024))
+        request = self.aconn.submit_put_object('vol1', 'big', Contents(body))
+        self.assertEquals(request.encode(self.conn.url, 'token')[-4:],
+                          '\r\n\r\n')
+        # bigger than a socket takes in one send
+        self.assertEquals(request.result(), md5(body).hexdigest())
+        self.assertEquals(self.server.objects['big'], body)
+        self.aconn.put_object('vol1', 'part', memoryview('abcd')[1:],
+                              content_length=2)
+        self.assertEquals(self.server.objects['part'], 'bc')
+
+    def test_retries(self):
+        self.server.failures = [503, 408]
+        self.aconn.put_object('vol1', 'a', 'a')
+        self.assertEquals(self.aconn.stats['retries'], 2)
+        self.server.failures = [503, 500, 503]
+        self.assertRaises(swift.ClientException, self.aconn.put_object,
+                          'vol1', 'b', 'b')
+        self.assertEquals(sorted(self.server.objects), ['a'])
+
+    def test_reauth(self):
+        self.server.rejected.add('token')
+        requests = [self.aconn.submit_put_object('vol1', str(i), 'x')
+                    for i in range(3)]
+        for request in requests:
+            request.result()
+        # authenticated once for all of them
+        self.assertEquals(self.auths, ['token0'])
+        self.server.rejected.add('token0')
+        self.server.rejected.add('token1')
+        try:
+            self.aconn.put_object('vol1', 'x', 'x')
+        except swift.ClientException, e:
+            self.assertEquals(e.http_status, 401)
+        else:
+            self.fail('put_object did not raise')
+
+    def test_stale(self):
+        self.aconn.put_object('vol1', 'a', 'a')
+        # the server hangs up on the idle connection
+        for channels in self.aconn.idle.values():
+            for channel in channels:
+                channel.sock.shutdown(0)
+        self.aconn.put_object('vol1', 'b', 'b')
+        self.assertEquals(sorted(self.server.objects), ['a', 'b'])
+        self.assertEquals(self.aconn.stats['retries'], 0)
+        self.assertEquals(self.aconn.stats['stale'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
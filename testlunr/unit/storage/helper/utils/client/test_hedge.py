@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from lunr.storage.helper.utils.client import hedge
+from lunr.storage.helper.utils.client.hedge import HedgePolicy, get_policy
+from testlunr.unit import patch
+
+
+class TestHedgePolicy(unittest.TestCase):
+
+    def test_delay(self):
+        policy = HedgePolicy(90, min_delay=0.1, window=10, min_samples=5)
+        for i in range(4):
+            policy.record(1.0)
+        # not enough seen to know what's slow
+        self.assertEquals(policy.delay(), None)
+        policy.record(1.0)
+        self.assertEquals(policy.delay(), 1.0)
+        for i in range(10):
+            policy.record(i / 100.0)
+        # only the window counts
+        self.assertEquals(policy.delay(), 0.1)
+        for i in range(10):
+            policy.record(i + 1.0)
+        self.assertEquals(policy.delay(), 10.0)
+        policy = HedgePolicy(50, min_delay=0, min_samples=1)
+        for i in range(10):
+            policy.record(i)
+        self.assertEquals(policy.delay(), 5)
+
+    def test_stats(self):
+        policy = HedgePolicy(min_samples=1)
+        policy.record(0.5)
+        policy.hedged(True)
+        policy.hedged(False)
+        self.assertEquals(policy.stats(), {'requests': 1, 'hedged': 2,
+                                           'hedge_wins': 1, 'delay': 0.5})
+
+    def test_schedule(self):
+        policy = HedgePolicy()
+        called = []
+        done = threading.Event()
+
+        def call(name):
+            called.append(name)
+            if name == 'c':
+                done.set()
+        cancel = policy.schedule(0.01, lambda: call('b'))
+        policy.schedule(0.02, lambda: call('c'))
+        policy.schedule(0, lambda: call('a'))
+        thread = policy.thread
+        cancel()
+        done.wait(5)
+        self.assertEquals(called, ['a', 'c'])
+        thread.join(5)
+        # nothing left to call, so the thread is done
+        self.assertEquals(policy.thread, None)
+
+    def test_get_policy(self):
+        with patch(hedge, '_policies', {}):
+            with patch(hedge.os, 'getpid', lambda: 100):
+                policy = get_policy(99)
+                self.assertEquals(policy.percentile, 99)
+                self.assert_(get_policy() is policy)
+            with patch(hedge.os, 'getpid', lambda: 101):
+                self.assert_(get_policy() is not policy)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import Queue
+import threading
+import unittest
+
+from lunr.storage.helper.utils.client import listing
+from lunr.storage.helper.utils.client.listing import account_pages, \
+    container_pages, next_marker, prefetch_pages
+
+
+class PagedConnection(object):
+
+    def __init__(self, names, page_size=2):
+        self.names = sorted(names)
+        self.page_size = page_size
+        self.markers = []
+
+    def _page(self, marker, prefix):
+        self.markers.append(marker)
+        names = [name for name in self.names
+                 if name > marker and name.startswith(prefix or '')]
+        return {}, [{'name': name} for name in names[:self.page_size]]
+
+    def get_container(self, container, marker=None, limit=None, prefix=None,
+                      delimiter=None):
+        return self._page(marker, prefix)
+
+    def get_account(self, marker=None, limit=None, prefix=None):
+        return self._page(marker, prefix)
+
+
+class TestListing(unittest.TestCase):
+
+    def test_next_marker(self):
+        self.assertEquals(next_marker([{'name': 'a'}, {'name': 'b'}]), 'b')
+        listing = [{'name': 'a'}, {'subdir': 'b/'}]
+        self.assertEquals(next_marker(listing, delimiter='/'), 'b/')
+
+    def test_container_pages(self):
+        conn = PagedConnection(['a', 'b', 'c', 'd', 'e'])
+        pages = [[obj['name'] for obj in listing]
+                 for listing in container_pages(conn, 'foo')]
+        self.assertEquals(pages, [['a', 'b'], ['c', 'd'], ['e']])
+        # every page picks up where the last ended
+        self.assertEquals(conn.markers, [None, 'b', 'd', 'e'])
+        conn = PagedConnection(['a', 'b', 'ba', 'c'])
+        pages = list(container_pages(conn, 'foo', marker='a', prefix='b'))
+        self.assertEquals(pages, [[{'name': 'b'}, {'name': 'ba'}]])
+
+    def test_account_pages(self):
+        conn = PagedConnection(['a', 'b', 'c'])
+        self.assertEquals(len(list(account_pages(conn))), 2)
+        self.assertEquals(conn.markers, [None, 'b', 'c'])
+
+    def test_pages_are_lazy(self):
+        conn = PagedConnection(['a', 'b', 'c', 'd', 'e'])
+        pages = container_pages(conn, 'foo')
+        pages.next()
+        self.assertEquals(conn.markers, [None])
+
+    def test_prefetch_pages(self):
+        names = ['block%03d' % i for i in range(25)]
+        for depth in (1, 2, 10):
+            conn = PagedConnection(names)
+            pages = prefetch_pages(container_pages(conn, 'foo'), depth)
+            listed = [obj['name'] for listing in pages for obj in listing]
+            self.assertEquals(listed, names)
+
+    def test_prefetch_pages_error(self):
+        def pages():
+            yield [{'name': 'a'}]
+            raise Exception('listing failed')
+        listing = prefetch_pages(pages(), 2)
+        self.assertEquals(listing.next(), [{'name': 'a'}])
+        self.assertRaises(Exception, listing.next)
+
+    def test_prefetch_pages_stop_early(self):
+        conn = PagedConnection(['block%03d' % i for i in range(100)])
+        pages = prefetch_pages(container_pages(conn, 'foo'), 1)
+        pages.next()
+        pages.close()
+        # the thread gives up rather than listing everything
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(1)
+        self.assert_(len(conn.markers) < 50)
+
+    def test_put_stopped(self):
+        queue = Queue.Queue(1)
+        stop = threading.Event()
+        self.assert_(listing._put(queue, 'a', stop))
+        # full, the put waits until the caller stops
+        threading.Timer(listing.STOP_POLL * 2, stop.set).start()
+        self.assertFalse(listing._put(queue, 'b', stop))
+        self.assertEquals(queue.get_nowait(), 'a')
+        self.assertFalse(listing._put(queue, 'c', stop))
+        self.assert_(queue.empty())
+
+    def test_prefetch_pages_stop_at_end(self):
+        last = threading.Event()
+
+        def pages():
+            yield [{'name': 'a'}]
+            yield [{'name': 'b'}]
+            last.set()
+            yield [{'name': 'c'}]
+        before = set(threading.enumerate())
+        fetched = prefetch_pages(pages(), 1)
+        fetched.next()
+        thread, = set(threading.enumerate()) - before
+        last.wait(1)
+        fetched.close()
+        # whether or not the last page got in after the queue was emptied
+        # the thread doesn't wait on the queue with the pages all fetched
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import unittest
+from urlparse import urlparse
+
+from lunr.storage.helper.utils.client import pool as pool_module
+from lunr.storage.helper.utils.client.pool import ConnectionPool, get_pool
+from testlunr.unit import patch
+
+URL = 'http://storage:8080/v1/acct'
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class Factory(object):
+
+    def __init__(self):
+        self.made = []
+
+    def __call__(self, url):
+        self.made.append(FakeConnection())
+        return urlparse(url), self.made[-1]
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = Factory()
+
+    def tearDown(self):
+        for conn in self.factory.made:
+            conn.close()
+            conn.peer.close()
+
+    def test_reuse(self):
+        pool = ConnectionPool(size=2)
+        first = pool.get(URL, self.factory)
+        second = pool.get(URL, self.factory)
+        self.assertEquals(len(self.factory.made), 2)
+        pool.put(URL, first)
+        pool.put(URL, second)
+        # another account on the same endpoint
+        parsed, conn = pool.get('http://storage:8080/v1/other', self.factory)
+        self.assertEquals(len(self.factory.made), 2)
+        self.assertEquals(parsed.path, '/v1/other')
+        self.assert_(conn is second[1])
+        stats = pool.stats()['http://storage:8080']
+        self.assertEquals(stats['handshakes'], 2)
+        self.assertEquals(stats['reused'], 1)
+        self.assertEquals(stats['in_flight'], 1)
+        self.assertEquals(stats['idle'], 1)
+        self.assertAlmostEquals(stats['reuse_rate'], 1 / 3.0)
+        # a different endpoint gets its own
+        pool.get('https://storage/v1/acct', self.factory)
+        self.assertEquals(len(self.factory.made), 3)
+
+    def test_size(self):
+        pool = ConnectionPool(size=1)
+        conns = [pool.get(URL, self.factory) for i in range(3)]
+        for http_conn in conns:
+            pool.put(URL, http_conn)
+        stats = pool.stats()['http://storage:8080']
+        self.assertEquals(stats['idle'], 1)
+        self.assertEquals(stats['evicted'], 2)
+        self.assertEquals(stats['in_flight'], 0)
+        # the most recent is kept
+        self.assert_(pool.get(URL, self.factory)[1] is conns[-1][1])
+        self.assertEquals(conns[0][1].sock, None)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=30)
+        with patch(pool_module, 'time', lambda: 1000.0):
+            pool.put(URL, pool.get(URL, self.factory))
+        with patch(pool_module, 'time', lambda: 1031.0):
+            pool.get(URL, self.factory)
+        self.assertEquals(len(self.factory.made), 2)
+        self.assertEquals(self.factory.made[0].sock, None)
+        self.assertEquals(pool.stats()['http://storage:8080']['evicted'], 1)
+
+    def test_dropped(self):
+        pool = ConnectionPool()
+        pool.put(URL, pool.get(URL, self.factory))
+        # the server hangs up while it's idle
+        self.factory.made[0].peer.close()
+        pool.get(URL, self.factory)
+        self.assertEquals(len(self.factory.made), 2)
+        self.assertEquals(pool.stats()['http://storage:8080']['dropped'], 1)
+
+    def test_closed(self):
+        pool = ConnectionPool()
+        http_conn = pool.get(URL, self.factory)
+        # httplib closes it when the response says so
+        http_conn[1].close()
+        pool.put(URL, http_conn)
+        stats = pool.stats()['http://storage:8080']
+        self.assertEquals(stats['closed'], 1)
+        self.assertEquals(stats['idle'], 0)
+
+    def test_releasing(self):
+        pool = ConnectionPool()
+        http_conn = pool.get(URL, self.factory)
+        body = pool.releasing(URL, http_conn, iter(['a', 'b']))
+        self.assertEquals(pool.stats()['http://storage:8080']['idle'], 0)
+        self.assertEquals(''.join(body), 'ab')
+        self.assertEquals(pool.stats()['http://storage:8080']['idle'], 1)
+        # abandoned part way through, it may be in the middle of a response
+        http_conn = pool.get(URL, self.factory)
+        body = pool.releasing(URL, http_conn, iter(['a', 'b']))
+        body.next()
+        body.close()
+        stats = pool.stats()['http://storage:8080']
+        self.assertEquals(stats['discarded'], 1)
+        self.assertEquals(stats['idle'], 0)
+        self.assertEquals(stats['in_flight'], 0)
+
+    def test_get_pool(self):
+        with patch(pool_module, '_pools', {}):
+            with patch(pool_module.os, 'getpid', lambda: 100):
+                pool = get_pool()
+                self.assert_(get_pool() is pool)
+            # a forked child doesn't share its parent's sockets
+            with patch(pool_module.os, 'getpid', lambda: 101):
+                self.assert_(get_pool() is not pool)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,12 +14,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import socket
+import threading
 import unittest
 import json
+from httplib import HTTPConnection
+from shutil import rmtree
 from StringIO import StringIO
+from tempfile import mkdtemp
 
 from lunr.common.config import LunrConfig
 from lunr.storage.helper.utils.client import swift
+from lunr.storage.helper.utils.client.hedge import HedgePolicy
+from lunr.storage.helper.utils.client.pool import ConnectionPool
+from lunr.storage.helper.utils.client.tokens import TokenCache
 from testlunr.unit import patch
 
 # from lunr.common import logger
@@ -89,6 +98,8 @@ class TestSwiftClient(unittest.TestCase):
         conf = LunrConfig()
         conn = swift.connect(conf)
         self.assert_(conn)
+        # nothing is sent again unless asked for
+        self.assertEquals(conn.hedge, None)
 
     def test_fail_after_500(self):
         head_container = AuthFailAfter500()
@@ -109,6 +120,196 @@ class TestSwiftClient(unittest.TestCase):
                               self.conn._retry, None, head_container)
         self.assertEquals(head_container.count, 2)
 
+    def test_2_auth_shared_cache(self):
+        scratch = mkdtemp()
+        try:
+            cache = TokenCache(os.path.join(scratch, 'auth_tokens'))
+            tokens = []
+
+            def authenticate():
+                tokens.append('token%s' % len(tokens))
+                return 'http://storage/v1/acct', tokens[-1]
+
+            conns = []
+            for i in range(2):
+                conn = swift.Connection('http:/localauth.com/auth1/',
+                                        'user', 'key', 'USA',
+                                        token_cache=cache)
+                conn._authenticate = authenticate
+                conn.http_connection = lambda: None
+                conns.append(conn)
+            head_container = SimulateAuthCacheFail()
+            with patch(swift, 'sleep', sleep):
+                conns[0]._retry(None, head_container)
+            self.assertEquals(head_container.count, 2)
+            # the rejected token was replaced once for both connections
+            self.assertEquals(tokens, ['token0', 'token1'])
+            conns[1]._retry(None, lambda url, token, http_conn: None)
+            self.assertEquals(conns[1].token, 'token1')
+            self.assertEquals(conns[1].copy().token_cache, cache)
+            self.assertEquals(len(tokens), 2)
+        finally:
+            rmtree(scratch)
+
+    def test_timeouts(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        url = 'http://127.0.0.1:%s/v1/acct' % listener.getsockname()[1]
+        try:
+            with patch(swift, 'HTTPConnection', HTTPConnection):
+                parsed, conn = swift.http_connection(url, connect_timeout=3,
+                                                     read_timeout=7)
+                self.assertEquals(conn.timeout, 3)
+                conn.connect()
+                self.assertEquals(conn.sock.gettimeout(), 7)
+                conn.close()
+        finally:
+            listener.close()
+
+    def test_hedged_get(self):
+        slow = threading.Event()
+        calls = []
+        threads = []
+
+        def get_object(url, token, container, name, **kwargs):
+            calls.append(name)
+            threads.append(threading.current_thread())
+            if len(calls) == 1:
+                # an object server that takes its time
+                slow.wait(5)
+                return {}, 'slow'
+            return {}, 'fast'
+        policy = HedgePolicy(min_delay=0.01, min_samples=1)
+        policy.record(0.01)
+        conn = swift.Connection('http:/localauth.com/auth1/', 'user', 'key',
+                                'USA', preauthurl='http://storage/v1/acct',
+                                preauthtoken='token', hedge=policy)
+        cancel = conn.cancel
+
+        def cancelled():
+            cancel()
+            slow.set()
+        try:
+            with patch(swift, 'get_object', get_object):
+                with patch(conn, 'cancel', cancelled):
+                    self.assertEquals(
+                        conn.get_object('vol1', 'a', resp_chunk_size=10),
+                        ({}, 'fast'))
+        finally:
+            slow.set()
+        self.assertEquals(calls, ['a', 'a'])
+        # the first is made by the caller, only the second by a thread
+        self.assert_(threads[0] is threading.current_thread())
+        self.assert_(threads[1] is not threading.current_thread())
+        self.assertFalse(conn.cancelled)
+        stats = policy.stats()
+        self.assertEquals(stats['hedged'], 1)
+        self.assertEquals(stats['hedge_wins'], 1)
+
+    def test_hedged_get_in_time(self):
+        calls = []
+
+        def get_object(url, token, container, name, **kwargs):
+            calls.append(threading.current_thread())
+            return {}, 'fast'
+
+        def copy():
+            raise Exception('nothing should be sent again')
+        policy = HedgePolicy(min_delay=5, min_samples=1)
+        policy.record(5)
+        conn = swift.Connection('http:/localauth.com/auth1/', 'user', 'key',
+                                'USA', preauthurl='http://storage/v1/acct',
+                                preauthtoken='token', hedge=policy)
+        with patch(swift, 'get_object', get_object):
+            with patch(conn, 'copy', copy):
+                self.assertEquals(
+                    conn.get_object('vol1', 'a', resp_chunk_size=10),
+                    ({}, 'fast'))
+                # only streamed blocks are sent again
+                policy.record(0)
+                policy.min_delay = 0
+                self.assertEquals(conn.get_object('vol1', 'a'), ({}, 'fast'))
+        self.assertEquals(calls, [threading.current_thread()] * 2)
+        self.assertEquals(policy.stats().get('hedged', 0), 0)
+
+    def test_hedged_get_errors(self):
+        def get_object(url, token, container, name, **kwargs):
+            raise swift.ClientException('Object GET failed', http_status=404)
+        # nothing has been seen, so nothing is sent again
+        policy = HedgePolicy()
+        conn = swift.Connection('http:/localauth.com/auth1/', 'user', 'key',
+                                'USA', preauthurl='http://storage/v1/acct',
+                                preauthtoken='token', hedge=policy)
+        with patch(swift, 'get_object', get_object):
+            self.assertRaises(swift.ClientException, conn.get_object,
+                              'vol1', 'a')
+        self.assertEquals(policy.stats().get('hedged', 0), 0)
+
+    def test_cancel(self):
+        head_container = Always500()
+        self.conn.cancel()
+        self.assertRaises(swift.ClientException, self.conn._retry, None,
+                          head_container)
+        self.assertEquals(head_container.count, 0)
+
+    def test_cancelled_not_pooled(self):
+        class Pool(object):
+            def __init__(self):
+                self.returned, self.discarded = [], []
+
+            def get(self, url, factory):
+                return 'parsed', 'http_conn'
+
+            def put(self, url, http_conn):
+                self.returned.append(http_conn)
+
+            def discard(self, url, http_conn):
+                self.discarded.append(http_conn)
+        pool = Pool()
+        conn = swift.Connection('http:/localauth.com/auth1/', 'user', 'key',
+                                'USA', preauthurl='http://storage/v1/acct',
+                                preauthtoken='token', pool=pool)
+        conn.http_conn = conn.http_connection()
+        conn.cancel()
+        conn._release()
+        # its socket may have been shut down under it
+        self.assertEquals(pool.returned, [])
+        self.assertEquals(pool.discarded, [('parsed', 'http_conn')])
+        # once it has been let go cancel() can't get at it
+        conn.cancel()
+        self.assertEquals(conn.http_conn, None)
+
+    def test_full_listing_resumes(self):
+        names = ['block%d' % i for i in range(7)]
+        markers = []
+
+        def get_container(url, token, container, marker=None, limit=None,
+                          prefix=None, delimiter=None, http_conn=None):
+            markers.append(marker)
+            if marker == 'block3' and markers.count(marker) == 1:
+                raise swift.ClientException("Some 500 Error", http_status=500)
+            listing = [{'name': name} for name in names if name > marker]
+            return {}, listing[:2]
+
+        with patch(swift, 'get_container', get_container):
+            with patch(swift, 'sleep', sleep):
+                _headers, listing = self.conn.get_container(
+                    'vol1', full_listing=True)
+        self.assertEquals([obj['name'] for obj in listing], names)
+        # the page that failed was the only one fetched again
+        self.assertEquals(markers, [None, 'block1', 'block3', 'block3',
+                                    'block5', 'block6'])
+
+        del markers[:]
+        self.conn.url, self.conn.token = 'http://localhost/v1/AUTH_1', 'tk'
+        with patch(swift, 'get_container', get_container):
+            with patch(swift, 'sleep', sleep):
+                pages = list(self.conn.iter_container('vol1', prefetch=2))
+        self.assertEquals([obj['name'] for page in pages for obj in page],
+                          names)
+        self.assertEquals(len(pages), 4)
+
     def test_retry_408_errors(self):
         head_container = Always408()
         with patch(swift, 'sleep', sleep):
@@ -135,6 +336,7 @@ class MockResponse(object):
 
     def __init__(self, status=200, body='', headers=None):
         self.status = status
+        self.reason = ''
         self.headers = headers or {}
         self.body = body
 
@@ -237,7 +439,12 @@ def _stub_auth_response():
 
 class MockHTTPConnection(object):
 
-    def __init__(self, host):
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.port = None
+        self.timeout = timeout
+
+    def connect(self):
         pass
 
     def request(self, method, path, body, headers):
@@ -329,6 +536,85 @@ class TestSwiftClientConnection(unittest.TestCase):
         # body should be string
         self.assertEquals(body, full_body)
 
+    def test_pooled(self):
+        socks = []
+
+        def factory(*args, **kwargs):
+            conn = mock_connection_factory(self)(*args, **kwargs)
+            conn.sock, peer = socket.socketpair()
+            socks.extend([conn.sock, peer])
+            return conn
+        swift.HTTPConnection = factory
+        self.validators = []
+        self.responses = [_stub_auth_response(), MockResponse(body='a' * 20),
+                          MockResponse(body='b'), MockResponse(status=404)]
+        pool = ConnectionPool()
+        try:
+            c = swift.Connection(
+                'http://localauth.com/auth1/', 'user', 'key', 'USA',
+                pool=pool)
+            headers, body = c.get_object('vol1', 'chunk1',
+                                         resp_chunk_size=10)
+            # checked out until the body has been read
+            other = c.copy()
+            self.assertEquals(other.get_object('vol1', 'chunk2')[1], 'b')
+            self.assertEquals(''.join(body), 'a' * 20)
+            self.assertRaises(swift.ClientException, other.head_object,
+                              'vol1', 'chunk3')
+            stats, = pool.stats().values()
+            self.assertEquals(stats['handshakes'], 2)
+            self.assertEquals(stats['reused'], 1)
+            self.assertEquals(stats['idle'], 2)
+            self.assertEquals(stats['in_flight'], 0)
+        finally:
+            for sock in socks:
+                sock.close()
+
+    def test_bulk_delete(self):
+        def bulk_delete_validator(method, path, body, headers):
+            self.assertEquals(method, 'DELETE')
+            self.assertEquals(path, '?bulk-delete')
+            self.assertEquals(body, '/vol1/chunk1\n/vol1/chunk%202')
+            self.assertEquals(headers['Accept'], 'application/json')
+        self.validators = [lambda *args: None, bulk_delete_validator]
+        result = {'Number Deleted': 1, 'Number Not Found': 1, 'Errors': [],
+                  'Response Status': '200 OK'}
+        self.responses = [_stub_auth_response(),
+                          MockResponse(body=json.dumps(result))]
+        c = swift.Connection(
+            'http://localauth.com/auth1/', 'user', 'key', 'USA')
+        self.assertEquals(
+            c.bulk_delete([('vol1', 'chunk1'), ('vol1', 'chunk 2')]), result)
+        self.assert_(bulk_delete_validator.called)
+
+    def test_bulk_delete_failed(self):
+        self.validators = []
+        # the middleware answers 200 before it knows how it went
+        result = {'Number Deleted': 0, 'Number Not Found': 0, 'Errors': [],
+                  'Response Status': '400 Bad Request'}
+        self.responses = [_stub_auth_response(),
+                          MockResponse(body=json.dumps(result))]
+        c = swift.Connection(
+            'http://localauth.com/auth1/', 'user', 'key', 'USA')
+        try:
+            c.bulk_delete([('vol1', 'chunk1')])
+        except swift.ClientException, e:
+            self.assertEquals(e.http_status, 400)
+        else:
+            self.fail('bulk_delete did not raise')
+
+    def test_get_capabilities(self):
+        def info_validator(method, path, body, headers):
+            self.assertEquals(method, 'GET')
+            self.assertEquals(path, '/info')
+        self.validators = [lambda *args: None, info_validator]
+        info = {'bulk_delete': {'max_deletes_per_request': 10000}}
+        self.responses = [_stub_auth_response(),
+                          MockResponse(body=json.dumps(info))]
+        c = swift.Connection(
+            'http://localauth.com/auth1/', 'user', 'key', 'USA')
+        self.assertEquals(c.get_capabilities(), info)
+
 
 class TestAuthConnection(unittest.TestCase):
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lunr.storage.helper.utils.client import tokens
+from lunr.storage.helper.utils.client.tokens import TokenCache, cache_key
+from testlunr.unit import patch
+
+
+class Auth(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return 'http://storage/v1/acct', 'token%s' % self.count
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = mkdtemp()
+        self.path = os.path.join(self.scratch, 'run', 'auth_tokens')
+        self.key = cache_key('http://auth/v2.0/tokens', 'user', 'DFW')
+
+    def tearDown(self):
+        rmtree(self.scratch)
+
+    def test_shared(self):
+        auth = Auth()
+        self.assertEquals(TokenCache(self.path).get(self.key, auth),
+                          ('http://storage/v1/acct', 'token1'))
+        # another process finds the same token
+        self.assertEquals(TokenCache(self.path).get(self.key, auth),
+                          ('http://storage/v1/acct', 'token1'))
+        self.assertEquals(auth.count, 1)
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEquals(mode, 0600)
+
+    def test_keys(self):
+        auth = Auth()
+        cache = TokenCache(self.path)
+        other = cache_key('http://auth/v2.0/tokens', 'user', 'ORD')
+        self.assertNotEquals(self.key, other)
+        self.assertEquals(cache.get(self.key, auth)[1], 'token1')
+        self.assertEquals(cache.get(other, auth)[1], 'token2')
+        self.assertEquals(cache.get(self.key, auth)[1], 'token1')
+
+    def test_expires(self):
+        auth = Auth()
+        cache = TokenCache(self.path, ttl=60)
+        with patch(tokens, 'time', lambda: 1000.0):
+            self.assertEquals(cache.get(self.key, auth)[1], 'token1')
+        with patch(tokens, 'time', lambda: 1059.0):
+            self.assertEquals(cache.get(self.key, auth)[1], 'token1')
+        with patch(tokens, 'time', lambda: 1060.0):
+            self.assertEquals(cache.get(self.key, auth)[1], 'token2')
+        self.assertEquals(auth.count, 2)
+
+    def test_invalidate(self):
+        auth = Auth()
+        cache = TokenCache(self.path)
+        self.assertEquals(cache.get(self.key, auth)[1], 'token1')
+        cache.invalidate(self.key, 'token1')
+        self.assertEquals(cache.get(self.key, auth)[1], 'token2')
+        # a process still holding the old token leaves the new one
+        cache.invalidate(self.key, 'token1')
+        self.assertEquals(cache.get(self.key, auth)[1], 'token2')
+        self.assertEquals(auth.count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
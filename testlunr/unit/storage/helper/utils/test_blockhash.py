@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import hashlib
+
+from lunr.storage.helper.utils import blockhash
+
+
+class TestBlockHash(unittest.TestCase):
+
+    def test_md5(self):
+        # the same names blocks always had
+        expected = hashlib.md5('data' + 'salt').hexdigest()
+        self.assertEquals(blockhash.block_hash('data', 'salt'), expected)
+        self.assertEquals(blockhash.block_hash(buffer('data'), 'salt', 'md5'),
+                          expected)
+
+    def test_validate(self):
+        self.assertEquals(blockhash.validate_algorithm('md5'), 'md5')
+        self.assertRaises(blockhash.HashAlgorithmError,
+                          blockhash.validate_algorithm, 'crc32')
+        self.assertRaises(ValueError, blockhash.block_hash, 'data', 'salt',
+                          'crc32')
+
+    def test_default(self):
+        orig_blake2b = blockhash.blake2b
+        try:
+            blockhash.blake2b = None
+            self.assertRaises(blockhash.HashAlgorithmError,
+                              blockhash.validate_algorithm, 'blake2b')
+            blockhash.blake2b = lambda *args, **kwargs: None
+            self.assertEquals(blockhash.validate_algorithm('blake2b'),
+                              'blake2b')
+            # md5 unless configured, whatever is installed
+            self.assertEquals(blockhash.DEFAULT_ALGORITHM, 'md5')
+        finally:
+            blockhash.blake2b = orig_blake2b
+
+    @unittest.skipUnless(blockhash.available('blake2b'),
+                         'pyblake2 is not installed')
+    def test_blake2b(self):
+        digest = blockhash.block_hash('data', 'salt', 'blake2b')
+        self.assertEquals(len(digest), 32)
+        self.assertNotEquals(digest,
+                             blockhash.block_hash('data', 'pepper', 'blake2b'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lunr.common.config import LunrConfig
+from lunr.storage.helper.utils import budget
+from lunr.storage.helper.utils.budget import Budget, BACKUP, SCRUB, \
+    READ, WRITE, NETWORK, READ_IOPS
+
+MB = 1024 ** 2
+
+
+class TestBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = mkdtemp()
+        self.now = 1000.0
+        self.slept = []
+        budget.time = lambda: self.now
+        budget.sleep = self.slept.append
+
+    def tearDown(self):
+        reload(budget)
+        rmtree(self.scratch)
+
+    def conf(self, **kwargs):
+        return LunrConfig({
+            'storage': {'run_dir': self.scratch},
+            'budget': kwargs,
+            'budget_weight': {'scrub': 0.5},
+        })
+
+    def test_unlimited(self):
+        b = Budget(self.conf())
+        self.assertFalse(b.enabled)
+        self.assertEquals(b.take(BACKUP, READ, 100 * MB), 0)
+        self.assertEquals(b.status(), {})
+        self.assertFalse(os.path.exists(b.path))
+
+    def test_take(self):
+        b = Budget(self.conf(read_mbps=10))
+        # starts with a full burst
+        self.assertEquals(b.take(BACKUP, READ, 10 * MB), 0)
+        # then pays the debt off at the rate
+        self.assertEquals(b.take(BACKUP, READ, 5 * MB), 0.5)
+        self.assertEquals(b.take(BACKUP, READ, 5 * MB), 1.0)
+        self.now += 1
+        self.assertEquals(b.take(BACKUP, READ, 5 * MB), 0.5)
+        self.assertEquals(self.slept, [0.5, 1.0, 0.5])
+        # other resources aren't limited
+        self.assertEquals(b.take(BACKUP, WRITE, 100 * MB), 0)
+
+    def test_shared(self):
+        conf = self.conf(network_mbps=10)
+        Budget(conf).take(BACKUP, NETWORK, 10 * MB)
+        # another process sees the same buckets
+        self.assertEquals(Budget(conf).take(BACKUP, NETWORK, 10 * MB), 1.0)
+
+    def test_weight(self):
+        b = Budget(self.conf(write_mbps=10))
+        # scrubs only get half of the node
+        self.assertEquals(b.take(SCRUB, WRITE, 10 * MB), 1.0)
+        # but what they take comes out of the node's bucket too
+        self.assertEquals(b.take(BACKUP, WRITE, 5 * MB), 0.5)
+
+    def test_status(self):
+        b = Budget(self.conf(write_mbps=10))
+        b.take(SCRUB, WRITE, 10 * MB)
+        status = b.status()
+        self.assertEquals(status.keys(), [WRITE])
+        self.assertEquals(status[WRITE]['node']['bytes'], 10 * MB)
+        self.assertEquals(status[WRITE]['node']['tokens'], 0)
+        self.assertEquals(status[WRITE]['scrub'], {
+            'rate': 5 * MB, 'tokens': -5 * MB, 'bytes': 10 * MB,
+            'waited': 1.0})
+        self.assertEquals(status[WRITE]['backup']['bytes'], 0)
+
+    def test_iops(self):
+        b = Budget(self.conf(read_iops=10))
+        self.assert_(b.enabled)
+        # the burst is ten reads, however big
+        for i in range(10):
+            self.assertEquals(b.take(BACKUP, READ, 100 * MB), 0)
+        self.assertEquals(b.take(BACKUP, READ, MB), 0.1)
+        self.assertEquals(b.take(BACKUP, READ, MB, ops=2), 0.3)
+        # the network has no operations to count
+        self.assertEquals(b.take(BACKUP, NETWORK, MB), 0)
+        status = b.status()
+        self.assertEquals(status.keys(), [READ_IOPS])
+        self.assertEquals(status[READ_IOPS]['node']['ops'], 13)
+        self.assertEquals(status[READ_IOPS]['backup']['waited'], 0.4)
+
+    def test_iops_and_mbps(self):
+        b = Budget(self.conf(write_mbps=10, write_iops=10))
+        # small writes run out of operations first
+        for i in range(10):
+            self.assertEquals(b.take(BACKUP, WRITE, 1024), 0)
+        self.assertEquals(b.take(BACKUP, WRITE, 1024), 0.1)
+        # and big ones out of bytes, the longer wait is slept
+        self.assertAlmostEquals(b.take(BACKUP, WRITE, 20 * MB), 1.001, 3)
+        self.assertEquals(len(self.slept), 2)
+
+    def test_threads(self):
+        b = Budget(self.conf(read_mbps=10))
+        read = b._read
+
+        def slow_read(bucket, resource):
+            record = read(bucket, resource)
+            # let another thread in between the read and the write
+            time.sleep(0.001)
+            return record
+        b._read = slow_read
+
+        def take():
+            for i in range(10):
+                b.take(BACKUP, READ, MB)
+        threads = [threading.Thread(target=take) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # no thread's debit was lost
+        status = b.status()
+        self.assertEquals(status[READ]['node']['bytes'], 40 * MB)
+        self.assertEquals(status[READ]['node']['tokens'], -30 * MB)
+
+
+if __name__ == "__main__":
+    unittest.main()
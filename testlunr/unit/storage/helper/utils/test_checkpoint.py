@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lunr.storage.helper.utils.checkpoint import SaveCheckpoint
+
+
+class TestSaveCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = mkdtemp()
+        self.path = os.path.join(self.scratch, 'volumes', 'vol1',
+                                 'checkpoint')
+        self.key = {'backup_id': 'backup1', 'history': [1.0]}
+
+    def tearDown(self):
+        rmtree(self.scratch)
+
+    def test_watermark(self):
+        checkpoint = SaveCheckpoint(self.path, self.key)
+        checkpoint.read(0, 'a', True, True)
+        checkpoint.read(1, 'b', False, False)
+        checkpoint.read(2, 'c', True, True)
+        checkpoint.read(3, 'd', True, False)
+        self.assertEquals(checkpoint.watermark, -1)
+        # uploads finishing out of order only move it past what's stored
+        checkpoint.stored(2)
+        self.assertEquals(checkpoint.watermark, -1)
+        self.assertEquals(checkpoint.uploaded, set(['c']))
+        checkpoint.stored(0)
+        self.assertEquals(checkpoint.watermark, 3)
+        self.assertEquals(checkpoint.changed, {0: 'a', 2: 'c', 3: 'd'})
+        self.assertEquals(checkpoint.uploaded, set())
+
+    def test_write_load(self):
+        checkpoint = SaveCheckpoint(self.path, self.key)
+        checkpoint.read(0, 'a', True, False)
+        checkpoint.read(1, 'b', True, True)
+        checkpoint.read(2, 'c', True, True)
+        checkpoint.stored(2)
+        checkpoint.write({'c': 'x', 'y': 'z'})
+
+        loaded = SaveCheckpoint.load(self.path, self.key)
+        self.assertEquals(loaded.watermark, 0)
+        self.assertEquals(loaded.changed, {0: 'a'})
+        self.assertEquals(loaded.uploaded, set(['c']))
+        self.assertEquals(loaded.deltas, {'c': 'x'})
+        self.assertEquals(SaveCheckpoint.referenced(self.path),
+                          set(['a', 'c']))
+
+        other = dict(self.key, history=[1.0, 2.0])
+        self.assertEquals(SaveCheckpoint.load(self.path, other), None)
+
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEquals(SaveCheckpoint.load(self.path, self.key), None)
+        self.assertEquals(SaveCheckpoint.referenced(self.path), set())
+        # already gone
+        checkpoint.remove()
+
+    def test_due(self):
+        checkpoint = SaveCheckpoint(self.path, self.key, interval=0)
+        self.assertFalse(checkpoint.due())
+        checkpoint = SaveCheckpoint(self.path, self.key, interval=1)
+        self.assertFalse(checkpoint.due())
+        checkpoint._written -= 1
+        self.assert_(checkpoint.due())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import os
+
+import lz4
+
+from lunr.storage.helper.utils import compression
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_codecs(self):
+        data = 'abcd' * 64 * 1024
+        for codec in compression.CODECS:
+            used, body = compression.compress(buffer(data), codec)
+            self.assertEquals(used, codec)
+            self.assertEquals(compression.codec_of(body), codec)
+            self.assertEquals(compression.decompress(body), data)
+        self.assertRaises(ValueError, compression.compress, data, 'rar')
+
+    def test_incompressible(self):
+        data = os.urandom(256 * 1024)
+        used, body = compression.compress(data, 'zlib')
+        self.assertEquals(used, 'raw')
+        self.assertEquals(len(body), len(data) + compression.HEADER.size)
+        self.assertEquals(compression.decompress(body), data)
+        # too small to sample, but still no gain
+        used, body = compression.compress(data[:1024], 'lz4')
+        self.assertEquals(used, 'raw')
+
+    def test_legacy_lz4(self):
+        data = 'x' * 4096
+        body = lz4.compress(data)
+        self.assertEquals(compression.codec_of(body), 'lz4')
+        self.assertEquals(compression.decompress(body), data)
+
+    def test_unknown_codec_id(self):
+        body = compression.HEADER.pack(compression.MAGIC, 99) + 'data'
+        self.assertRaises(compression.CodecError, compression.decompress,
+                          body)
+
+    def test_decompressor(self):
+        data = 'abcd' * 64 * 1024
+        bodies = [compression.compress(data, codec)[1]
+                  for codec in compression.CODECS]
+        bodies.append(lz4.compress(data))
+        for body in bodies:
+            decompressor = compression.Decompressor()
+            # pieces shorter than the header too
+            for offset in xrange(0, len(body), 3):
+                decompressor.feed(body[offset:offset + 3])
+            self.assertEquals(decompressor.finish(), data)
+            self.assertEquals(decompressor.codec, compression.codec_of(body))
+        # never got as far as the header
+        decompressor = compression.Decompressor()
+        decompressor.feed(compression.MAGIC)
+        self.assertRaises(Exception, decompressor.finish)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from lunr.storage.helper.utils import delta
+from lunr.storage.helper.utils.slab import SlabPool
+
+
+class TestDelta(unittest.TestCase):
+
+    def test_fingerprint(self):
+        prints = delta.fingerprint('a' * 64 + 'b' * 30, 16)
+        self.assertEquals(delta.chunk_count(prints), 6)
+        self.assertEquals(delta.diff(prints, prints), [])
+        other = delta.fingerprint('a' * 16 + 'c' + 'a' * 47 + 'b' * 29 + 'c',
+                                  16)
+        self.assertEquals(delta.diff(prints, other), [1, 5])
+        # taken with a different sub chunk size
+        self.assertEquals(delta.diff(prints, delta.fingerprint('a' * 94, 32)),
+                          None)
+
+    def test_encode_apply(self):
+        old = 'a' * 100
+        new = 'a' * 20 + 'b' * 10 + 'a' * 60 + 'c' * 5
+        indexes = delta.diff(delta.fingerprint(old, 10),
+                             delta.fingerprint(new, 10))
+        self.assertEquals(indexes, [2, 9])
+        codec, body = delta.encode(u'parent', 10, new, indexes)
+        self.assertEquals(codec, 'lz4')
+        self.assert_(delta.is_delta(body))
+        self.assertFalse(delta.is_delta(old))
+        d = delta.Delta(body)
+        self.assertEquals(d.parent, 'parent')
+        self.assertEquals(d.indexes, indexes)
+        self.assertEquals(d.length, 95)
+        pool = SlabPool(1, 4096)
+        try:
+            slab = pool.acquire()
+            pool.write(slab, old)
+            d.apply(pool, slab)
+            self.assertEquals(str(pool.buffer(slab)), new)
+        finally:
+            pool.close()
+
+    def test_not_a_delta(self):
+        self.assertRaises(delta.DeltaError, delta.Delta, 'LD')
+        self.assertRaises(delta.DeltaError, delta.Delta, 'x' * 64)
+
+
+if __name__ == "__main__":
+    unittest.main()
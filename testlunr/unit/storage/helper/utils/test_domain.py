@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from lunr.storage.helper.utils import domain
+from lunr.storage.helper.utils.client import memory
+from lunr.storage.helper.utils.manifest import Manifest
+from testlunr.unit import patch
+
+
+class TestDedupDomain(unittest.TestCase):
+
+    def setUp(self):
+        memory.reset()
+        self.conn = memory.Connection()
+        self.domain = domain.DedupDomain(self.conn, 'dedup-account-acct1')
+
+    def test_domain_container(self):
+        self.assertEquals(domain.domain_container('', 'acct1', 'ssd'), None)
+        self.assertEquals(domain.domain_container('account', 'acct1', 'ssd'),
+                          'dedup-account-acct1')
+        self.assertEquals(domain.domain_container('volume_type', 'acct1',
+                                                  'ssd'), 'dedup-type-ssd')
+        self.assertEquals(domain.domain_container('account', None, 'ssd'),
+                          None)
+
+    def test_adopt(self):
+        self.assertEquals(self.domain.block_size, None)
+        for volume_id in ('vol1', 'vol2'):
+            self.conn.put_container(volume_id)
+        first = Manifest.blank(2, 1024 * 1024)
+        self.domain.adopt(first, 'vol1')
+        self.assertEquals(self.domain.block_size, 1024 * 1024)
+        second = Manifest.blank(2)
+        self.domain.adopt(second, 'vol2')
+        self.assertEquals(second.salt, first.salt)
+        self.assertEquals(second.domain, 'dedup-account-acct1')
+        self.assertEquals(self.conn.get_object('vol2', 'domain')[1],
+                          'dedup-account-acct1')
+        # members join once they have a backup
+        self.assertEquals(self.domain.members(), [])
+
+    def test_members_and_block_set(self):
+        self.conn.put_container('dedup-account-acct1')
+        for volume_id, blocks in (('vol1', ['a', 'b']), ('vol2', ['b', 'c'])):
+            self.conn.put_container(volume_id)
+            m = Manifest.blank(2)
+            backup = m.create_backup('backup')
+            backup[0], backup[1] = blocks
+            self.conn.put_object(volume_id, 'manifest', m.dumps())
+            self.domain.join(volume_id)
+        # a member whose manifest went missing
+        self.domain.join('vol3')
+        self.assertEquals(self.domain.members(), ['vol1', 'vol2', 'vol3'])
+        self.assertEquals(self.domain.block_set(), set(['a', 'b', 'c']))
+        self.domain.leave('vol1')
+        self.domain.leave('vol1')
+        self.assertEquals(self.domain.block_set(), set(['b', 'c']))
+
+    def test_block_set_cached(self):
+        self.conn.put_container('dedup-account-acct1')
+        downloads = []
+        get_object = self.conn.get_object
+
+        def counting_get(container, name, **kwargs):
+            rv = get_object(container, name, **kwargs)
+            downloads.append(container)
+            return rv
+        for volume_id in ('vol1', 'vol2'):
+            self.conn.put_container(volume_id)
+            m = Manifest.blank(1)
+            m.create_backup('backup')[0] = volume_id
+            self.conn.put_object(volume_id, 'manifest', m.dumps())
+            self.domain.join(volume_id)
+        scratch = mkdtemp()
+        try:
+            cached = domain.DedupDomain(self.conn, 'dedup-account-acct1',
+                                        cache_dir=scratch)
+            with patch(self.conn, 'get_object', counting_get):
+                self.assertEquals(cached.block_set(),
+                                  set(['vol1', 'vol2']))
+                self.assertEquals(downloads, ['vol1', 'vol2'])
+                # only what changed is downloaded again
+                m.create_backup('backup2')[0] = 'vol2-2'
+                self.conn.put_object('vol2', 'manifest', m.dumps())
+                self.assertEquals(cached.block_set(),
+                                  set(['vol1', 'vol2', 'vol2-2']))
+                self.assertEquals(downloads, ['vol1', 'vol2', 'vol2'])
+            # the copies of volumes that left are removed
+            cached.leave('vol1')
+            self.assertEquals(cached.block_set(), set(['vol2', 'vol2-2']))
+            self.assertEquals(os.listdir(scratch), ['vol2'])
+        finally:
+            rmtree(scratch)
+
+    def test_saving(self):
+        self.conn.put_container('dedup-account-acct1')
+        self.domain.start_save('vol1')
+        self.domain.start_save('vol2')
+        self.assertEquals(self.domain.saving(), ['vol1', 'vol2'])
+        self.domain.finish_save('vol1')
+        self.domain.finish_save('vol1')
+        self.assertEquals(self.domain.saving(), ['vol2'])
+        # left behind by a save that died
+        self.assertEquals(self.domain.saving(expiry=-1), [])
+        self.assertEquals(self.domain._listing(domain.SAVING), [])
+        # saves join first, so their markers are found by name
+        self.assertEquals(self.domain.members(), ['vol1', 'vol2'])
+
+    def test_saving_not_listed(self):
+        self.conn.put_container('dedup-account-acct1')
+        self.domain.start_save('vol1')
+        listing = self.domain._listing
+
+        def stale_listing(prefix):
+            if prefix == domain.SAVING:
+                return []
+            return listing(prefix)
+        with patch(self.domain, '_listing', stale_listing):
+            self.assertEquals(self.domain.saving(), ['vol1'])
+
+    def test_audit(self):
+        self.conn.put_container('dedup-account-acct1')
+        self.assertEquals(self.domain.auditing(), None)
+        self.assert_(self.domain.start_audit('vol1'))
+        self.assertEquals(self.domain.auditing(), 'vol1')
+        other = domain.DedupDomain(self.conn, 'dedup-account-acct1')
+        self.assertFalse(other.start_audit('vol2'))
+        other.finish_audit('vol2')
+        self.assertEquals(self.domain.auditing(), 'vol1')
+        # left behind by an audit that died
+        self.assertEquals(self.domain.auditing(expiry=-1), None)
+        self.domain.finish_audit('vol1')
+        self.assertEquals(self.domain.auditing(), None)
+        self.assertEquals(self.domain.last_swept(), 0)
+        self.domain.swept(1.5)
+        self.assertEquals(other.last_swept(), 1.5)
+
+    def test_audit_race(self):
+        self.conn.put_container('dedup-account-acct1')
+        other = domain.DedupDomain(self.conn, 'dedup-account-acct1')
+        self.assert_(self.domain.start_audit('vol1'))
+        # the other checked for an audit just before we registered, the
+        # last to register wins
+        with patch(other, 'auditing', lambda: None):
+            self.assert_(other.start_audit('vol2'))
+        self.assertFalse(self.domain.holds_audit('vol1'))
+        now = [time() + domain.HEARTBEAT_INTERVAL]
+        with patch(domain, 'time', lambda: now[0]):
+            self.assertFalse(self.domain.heartbeat())
+            self.assert_(other.heartbeat())
+        self.assertEquals(self.domain._marked, {})
+        self.assertEquals(other.auditing(), 'vol2')
+        other.finish_audit('vol2')
+        # and the one that registered first backs off
+        mark = other._mark
+
+        def overtaken(name, owner=''):
+            mark(name, owner)
+            self.domain._mark(domain.AUDIT, 'vol1')
+        with patch(other, '_mark', overtaken):
+            with patch(other, 'auditing', lambda: None):
+                self.assertFalse(other.start_audit('vol2'))
+        self.assertEquals(other._marked, {})
+        self.assert_(self.domain.holds_audit('vol1'))
+
+    def test_save_waits_for_audit(self):
+        self.conn.put_container('dedup-account-acct1')
+        auditor = domain.DedupDomain(self.conn, 'dedup-account-acct1')
+        auditor.start_audit('vol1')
+        waits = []
+
+        def sleep(secs):
+            # the audit sees our save and gives up
+            self.assertEquals(auditor.saving(), ['vol2'])
+            waits.append(secs)
+            auditor.finish_audit('vol1')
+        with patch(domain, 'sleep', sleep):
+            self.domain.start_save('vol2', poll_interval=5)
+        self.assertEquals(waits, [5])
+        self.assertEquals(self.domain.saving(), ['vol2'])
+
+    def test_heartbeat(self):
+        self.conn.put_container('dedup-account-acct1')
+        now = [1000.0]
+        with patch(domain, 'time', lambda: now[0]):
+            self.domain.start_save('vol1')
+            self.domain.start_audit('vol1')
+            now[0] += domain.HEARTBEAT_INTERVAL - 1
+            self.domain.heartbeat()
+            now[0] += domain.MARKER_EXPIRY - domain.HEARTBEAT_INTERVAL + 2
+            # not refreshed in time
+            self.assertEquals(self.domain.auditing(), None)
+            now[0] = 1000.0 + domain.HEARTBEAT_INTERVAL
+            self.domain.heartbeat()
+            now[0] += domain.MARKER_EXPIRY - 1
+            self.assertEquals(self.domain.auditing(), 'vol1')
+            self.assertEquals(self.domain.saving(), ['vol1'])
+            self.domain.finish_save('vol1')
+            self.domain.finish_audit('vol1')
+            self.assertEquals(self.domain._marked, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lunr.storage.helper.utils.gc import GCJournal
+
+
+class TestGCJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = mkdtemp()
+        self.path = os.path.join(self.scratch, 'volumes', 'vol1', 'gc')
+
+    def tearDown(self):
+        rmtree(self.scratch)
+
+    def test_batches(self):
+        journal = GCJournal(self.path)
+        self.assertEquals(journal.batches(), [])
+        journal.add('vol1', set(['b', 'a']), 1.0)
+        journal.add('dedup', ['c'], 2.0)
+        # survives the process that wrote it
+        journal = GCJournal(self.path)
+        self.assertEquals(journal.batches(), [[1.0, 'vol1', ['a', 'b']],
+                                              [2.0, 'dedup', ['c']]])
+        journal.done(1.0)
+        self.assertEquals(journal.batches(), [[2.0, 'dedup', ['c']]])
+
+    def test_swept(self):
+        journal = GCJournal(self.path)
+        self.assertEquals(journal.last_swept(), 0)
+        journal.add('vol1', ['a'], 1.0)
+        journal.swept(5.0)
+        self.assertEquals(journal.last_swept(), 5.0)
+        self.assertEquals(len(journal.batches()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,10 +19,15 @@ from collections import defaultdict
 from StringIO import StringIO
 from time import time as _orig_time
 from random import randint
+import hashlib
 import json
+import os
+import shutil
+from tempfile import mkdtemp
 
 from testlunr.unit import temp_disk_file
 from lunr.storage.helper.utils import manifest
+from lunr.storage.helper.utils.client import memory
 
 
 def mock_time(start=_orig_time()):
@@ -50,14 +55,18 @@ def mock_time(start=_orig_time()):
     return mock
 
 
+# Timestamps are keys of the manifest, starting every test from the same one
+# keeps whatever depends on their order the same from run to run
+START = 1400000000.0
+
+
 class ManifestTestCase(unittest.TestCase):
 
-    VERSION = '1.0'
+    VERSION = '1.3'
 
     def setUp(self):
-        start = _orig_time()
-        manifest.time = mock_time(start)
-        self.time = mock_time(start)
+        manifest.time = mock_time(START)
+        self.time = mock_time(START)
 
     def tearDown(self):
         manifest.time = _orig_time
@@ -215,6 +224,71 @@ class TestManifest(ManifestTestCase):
         self.assert_('backup3' not in m.backups)
         self.assertEquals(m.replay(), expected)
 
+    def test_delta_parents(self):
+        m = manifest.Manifest.blank(2)
+        backup = m.create_backup('base')
+        backup[0], backup[1] = '0000', '1111'
+        self.time()
+        backup = m.create_backup('backup1')
+        backup[1] = '1112'
+        self.time()
+        backup = m.create_backup('backup2')
+        backup[1] = '1113'
+        m.add_deltas({'1112': '1111'})
+        m.add_deltas({'1113': '1112'})
+        self.assertEquals(m.delta_depth('1113'), 2)
+        self.assertEquals(m.delta_depth('0000'), 0)
+        m.set_fingerprints({'1113': 'new', '1112': 'old'})
+        self.assertEquals(m.fingerprints, {'1113': 'new'})
+        # the parents stay in the block set after their backups are gone
+        m.delete_backup('base')
+        m.delete_backup('backup1')
+        self.assertEquals(m.block_set, set(['0000', '1111', '1112', '1113']))
+        self.assertEquals(m.deltas, {'1113': '1112', '1112': '1111'})
+        m.delete_backup('backup2')
+        self.assertEquals(m.deltas, {})
+
+    def test_incremental_indexes(self):
+        size = 20
+        m = manifest.Manifest.blank(size)
+        m.create_backup('base')
+        for blockno in range(size):
+            m.base[blockno] = 'base%s' % blockno
+
+        def check():
+            history = sorted(k for k in m if k not in m.NAMED_KEYS)
+            self.assertEquals(m.history, history)
+            expected = list(m[history[0]])
+            referenced = set(expected)
+            for ts in history:
+                if ts != history[0]:
+                    for blockno, hash_ in m[ts].items():
+                        expected[blockno] = hash_
+                        referenced.add(hash_)
+                # the replay to every backup, from whatever was kept
+                self.assertEquals(m.replay(ts), expected)
+            self.assertEquals(m.block_set, referenced)
+
+        backup_ids = []
+        for i in range(3 * manifest.REPLAY_INTERVAL):
+            self.time()
+            backup_id = 'backup%s' % i
+            backup = m.create_backup(backup_id)
+            backup_ids.append(backup_id)
+            # filled in after the backup is created
+            for blockno in range(i % size, size, 7):
+                backup[blockno] = '%s-%s' % (i, blockno)
+            check()
+            if i % 3 == 2:
+                # from the middle, or the newest
+                backup_id = backup_ids.pop(randint(0, len(backup_ids) - 1))
+                m.delete_backup(backup_id)
+                check()
+        self.assert_(m._replays)
+        while backup_ids:
+            m.delete_backup(backup_ids.pop())
+            check()
+
 
 class MockConnection(object):
 
@@ -261,7 +335,7 @@ class TestJSON(ManifestTestCase):
         stuff = {
             0: [],
             'backups': {},
-            'version': '2.0'
+            'version': '3.0'
         }
         c.put_object('vol1', 'manifest', json.dumps(stuff))
         with temp_disk_file() as lock_file:
@@ -297,6 +371,59 @@ class TestJSON(ManifestTestCase):
             m = manifest.load_manifest(c, 'vol1', lock_file)
         self.assertEquals(m.salt, '')
 
+    def test_load_version_1_0(self):
+        c = MockConnection()
+        stuff = {
+            0: [],
+            'backups': {},
+            'version': '1.0',
+            'salt': 'salty!'
+        }
+        c.put_object('vol1', 'manifest', json.dumps(stuff))
+        with temp_disk_file() as lock_file:
+            m = manifest.load_manifest(c, 'vol1', lock_file)
+        self.assertEquals(m.version, '1.0')
+        self.assertEquals(m.block_size, manifest.DEFAULT_BLOCK_SIZE)
+        # old manifests are written back the way they were found
+        self.assertEquals(json.loads(m.dumps())['version'], '1.0')
+        self.assertFalse('block_size' in json.loads(m.dumps()))
+
+    def test_block_size(self):
+        m = manifest.Manifest.blank(1)
+        self.assertEquals(m.block_size, 4 * 1024 ** 2)
+        m = manifest.Manifest.blank(1, 1024 ** 2)
+        self.assertEquals(m.block_size, 1024 ** 2)
+        self.assertEquals(m.history, [])
+        m.create_backup('id1')
+        m = manifest.Manifest.loads(m.dumps())
+        self.assertEquals(m.block_size, 1024 ** 2)
+        self.assertEquals(m.history, [m.backups['id1']])
+        for block_size in (0, 4096, 3 * 1024 ** 2, 128 * 1024 ** 2, 'a'):
+            self.assertRaises(ValueError, manifest.Manifest.blank, 1,
+                              block_size)
+
+    def test_hash_algorithm(self):
+        m = manifest.Manifest.blank(1)
+        self.assertEquals(m.hash_algorithm, 'md5')
+        self.assertEquals(m.hash_algorithms, ['md5'])
+        self.assertRaises(ValueError, manifest.Manifest.blank, 1,
+                          hash_algorithm='crc32')
+        # version 1.1 manifests were all md5
+        m = manifest.Manifest.loads(json.dumps({
+            0: [], 'backups': {}, 'version': '1.1', 'salt': 'salty!',
+            'block_size': 1024 ** 2}))
+        self.assertEquals(m.hash_algorithm, 'md5')
+        self.assertEquals(m.version, '1.1')
+        m['hash_algorithms'] = ['md5', 'other']
+        m['hash_algorithm'] = 'other'
+        m.set_hash_algorithm('md5')
+        self.assertEquals(m.hash_algorithm, 'md5')
+        self.assertEquals(m.hash_algorithms, ['md5', 'other'])
+        self.assertEquals(m.version, manifest.Manifest.VERSION)
+        m = manifest.Manifest.loads(m.dumps())
+        self.assertEquals(m.hash_algorithms, ['md5', 'other'])
+        self.assertEquals(m.history, [0])
+
     def test_integer_backup_id(self):
         size = 2
         m = manifest.Manifest.blank(size)
@@ -327,6 +454,328 @@ class TestJSON(ManifestTestCase):
             self.assertEquals(vol1, vol1_str)
             self.assertEquals(m.get_backup('id2'), vol2)
 
+    def test_load_cached(self):
+        c = memory.Connection()
+        c.put_container('vol1')
+        fetched = []
+        get_object = c.get_object
+
+        def counting_get_object(*args, **kwargs):
+            headers, body = get_object(*args, **kwargs)
+            fetched.append(body)
+            return headers, body
+        c.get_object = counting_get_object
+
+        m = manifest.Manifest.blank(2)
+        m.create_backup('id0')
+        with temp_disk_file() as lock_file:
+            manifest.save_manifest(m, c, 'vol1', lock_file)
+            # our own save is already in the cache
+            m = manifest.load_manifest(c, 'vol1', lock_file)
+            manifest.release_lock(lock_file)
+            self.assertEquals(fetched, [])
+            self.assertEquals(m.backups.keys(), ['id0'])
+            # changed somewhere else, and smaller than the local copy
+            other = manifest.Manifest.blank(1)
+            c.put_object('vol1', 'manifest', other.dumps())
+            m = manifest.load_manifest(c, 'vol1', lock_file)
+            manifest.release_lock(lock_file)
+            self.assertEquals(fetched, [other.dumps()])
+            self.assertEquals(m.backups, {})
+            with open(lock_file) as f:
+                self.assertEquals(f.read(), other.dumps())
+            # a broken local copy is never trusted
+            with open(lock_file, 'a') as f:
+                f.write('garbage')
+            m = manifest.load_manifest(c, 'vol1', lock_file)
+            manifest.release_lock(lock_file)
+            self.assertEquals(len(fetched), 2)
+
+    def test_cached_manifest(self):
+        c = memory.Connection()
+        c.put_container('vol1')
+        m = manifest.Manifest.blank(1)
+        m.create_backup('id0')
+        with temp_disk_file() as lock_file:
+            manifest.save_manifest(m, c, 'vol1', lock_file)
+            m.create_backup('id1')
+            c.put_object('vol1', 'manifest', m.dumps())
+            self.assertEquals(
+                sorted(manifest.cached_manifest(c, 'vol1', lock_file).backups),
+                ['id0', 'id1'])
+            # a worker holding the lock already has it fresh
+            manifest.aquire_lock(lock_file)
+            c.put_object('vol1', 'manifest',
+                         manifest.Manifest.blank(1).dumps())
+            self.assertEquals(
+                sorted(manifest.cached_manifest(c, 'vol1', lock_file).backups),
+                ['id0', 'id1'])
+            manifest.release_lock(lock_file)
+            c.delete_object('vol1', 'manifest')
+            self.assertRaises(manifest.ManifestEmptyError,
+                              manifest.cached_manifest, c, 'vol1', lock_file)
+
+
+class TestBinary(ManifestTestCase):
+
+    def _hash(self, i):
+        return hashlib.md5(str(i)).hexdigest()
+
+    def _manifest(self):
+        m = manifest.Manifest.blank(8)
+        m.upgrade()
+        base = m.create_backup('id0')
+        for blockno in range(1, 8):
+            base[blockno] = self._hash(blockno)
+        diff = m.create_backup('id1')
+        diff[5] = self._hash(50)
+        diff[2] = manifest.EMPTY_BLOCK
+        m.create_backup('id2')[7] = self._hash(70)
+        return m
+
+    def test_round_trip(self):
+        m = self._manifest()
+        body = m.dumps()
+        self.assert_(body.startswith(manifest.MAGIC))
+        loaded = manifest.Manifest.loads(body)
+        self.assertEquals(loaded, m)
+        self.assertEquals(loaded.version, '2.0')
+        base, diff = loaded[loaded.history[0]], loaded[loaded.history[1]]
+        self.assert_(isinstance(base, manifest.PackedHashes))
+        self.assert_(isinstance(diff, manifest.PackedDiff))
+        self.assertEquals(base[0], manifest.EMPTY_BLOCK)
+        self.assertEquals(base[-1], self._hash(7))
+        self.assertEquals(diff[2], manifest.EMPTY_BLOCK)
+        self.assertRaises(KeyError, diff.__getitem__, 3)
+        self.assertEquals(sorted(diff.iteritems()),
+                          [(2, manifest.EMPTY_BLOCK), (5, self._hash(50))])
+        for backup_id in ('id0', 'id1', 'id2'):
+            self.assertEquals(loaded.get_backup(backup_id),
+                              m.get_backup(backup_id))
+        self.assertEquals(loaded.block_set, m.block_set)
+        # untouched tables are written back as they were loaded
+        self.assertEquals(loaded.dumps(), body)
+        # squashing unpacks what it changes
+        loaded.delete_backup('id0')
+        m.delete_backup('id0')
+        self.assertEquals(loaded, m)
+        self.assertEquals(manifest.Manifest.loads(loaded.dumps()), m)
+
+    def test_much_smaller(self):
+        m = manifest.Manifest.blank(1024)
+        m.upgrade()
+        base = m.create_backup('id0')
+        for blockno in range(1024):
+            base[blockno] = self._hash(blockno)
+        body = m.dumps()
+        self.assert_(len(body) < 1024 * 17 + 1024)
+        m['version'] = '1.3'
+        self.assert_(len(m.dumps()) > 1024 * 32)
+
+    def test_upgrade_json(self):
+        m = self._manifest()
+        m['version'] = '1.3'
+        body = m.dumps()
+        self.assertEquals(json.loads(body)['version'], '1.3')
+        loaded = manifest.Manifest.loads(body)
+        loaded.upgrade()
+        loaded = manifest.Manifest.loads(loaded.dumps())
+        self.assertEquals(loaded.version, '2.0')
+        m.upgrade()
+        self.assertEquals(loaded, m)
+        # nothing is stored the new way until it has been upgraded
+        m = manifest.Manifest.blank(8)
+        m['hash_algorithm'] = 'other'
+        m.set_hash_algorithm('md5')
+        self.assertEquals(json.loads(m.dumps())['version'], '1.3')
+        m.upgrade()
+        m['hash_algorithm'] = 'other'
+        m.set_hash_algorithm('md5')
+        self.assertEquals(m.version, '2.0')
+
+    def test_not_digests(self):
+        m = manifest.Manifest.blank(2)
+        m.upgrade()
+        m.create_backup('id0')[0] = 'x00'
+        m.create_backup('id1')[1] = self._hash(1).upper()
+        m.create_backup('id2')[1.5] = self._hash(1)
+        loaded = manifest.Manifest.loads(m.dumps())
+        self.assertEquals(loaded, m)
+        for ts in loaded.history:
+            self.assertFalse(isinstance(
+                loaded[ts], (manifest.PackedHashes, manifest.PackedDiff)))
+
+    def test_short(self):
+        body = self._manifest().dumps()
+        self.assertRaises(ValueError, manifest.Manifest.loads,
+                          body[:len(body) - 1])
+        self.assertRaises(ValueError, manifest.Manifest.loads,
+                          manifest.MAGIC)
+
+    def test_segments(self):
+        m = self._manifest()
+        segments = {}
+        root = m.dumps(segments=segments)
+        self.assertEquals(len(segments), 3)
+        self.assertEquals(sorted(manifest.Manifest.segment_names(root)),
+                          sorted(segments))
+        for name, data in segments.items():
+            self.assertEquals(name, manifest.SEGMENT_PREFIX +
+                              hashlib.md5(data).hexdigest())
+        self.assert_(len(root) < len(m.dumps()))
+        self.assertEquals(manifest.Manifest.loads(root, segments=segments), m)
+        self.assertRaises(ValueError, manifest.Manifest.loads, root)
+        self.assertEquals(manifest.Manifest.segment_names(m.dumps()), [])
+
+    def test_fingerprints(self):
+        m = self._manifest()
+        m.set_fingerprints({self._hash(70): 'a' * 10, self._hash(1): 'b',
+                            self._hash(7): 'c'})
+        # only the chunks of the most recent backup are kept
+        expected = {self._hash(70): 'a' * 10, self._hash(1): 'b'}
+        self.assertEquals(m.fingerprints, expected)
+        body = m.dumps()
+        meta, _offset = manifest.Manifest._meta(body)
+        self.assertFalse('fingerprints' in meta)
+        self.assertEquals(meta['tables'][-1][:3],
+                          ['fingerprints', manifest.PRINTS, 2])
+        loaded = manifest.Manifest.loads(body)
+        self.assert_(isinstance(loaded.fingerprints,
+                                manifest.PackedFingerprints))
+        self.assertEquals(loaded.fingerprints, expected)
+        self.assertRaises(KeyError, loaded.fingerprints.__getitem__,
+                          self._hash(7))
+        self.assertRaises(KeyError, loaded.fingerprints.__getitem__, 'x')
+        self.assertEquals(loaded.dumps(), body)
+        # new ones are added to those still in the most recent backup
+        loaded.set_fingerprints({self._hash(3): 'd', self._hash(1): 'e'})
+        expected.update({self._hash(3): 'd', self._hash(1): 'e'})
+        self.assertEquals(loaded.fingerprints, expected)
+        self.assertEquals(
+            manifest.Manifest.loads(loaded.dumps()).fingerprints, expected)
+        # and are written back the old way by older versions
+        loaded['version'] = '1.3'
+        self.assertEquals(
+            manifest.Manifest.loads(loaded.dumps()).fingerprints, expected)
+
+    def test_deferred_fingerprints(self):
+        m = self._manifest()
+        m.set_fingerprints({self._hash(70): 'a' * 10})
+        segments = {}
+        root = m.dumps(segments=segments)
+        self.assertEquals(len(segments), 4)
+        needed = manifest.Manifest.segment_names(root, deferred=False)
+        self.assertEquals(len(needed), 3)
+        loaded = manifest.Manifest.loads(
+            root, segments=dict((n, segments[n]) for n in needed))
+        # saved again without ever being loaded
+        again = {}
+        self.assertEquals(loaded.dumps(segments=again), root)
+        self.assertEquals(set(again), set(segments))
+        self.assertEquals([n for n in again if again[n] is None],
+                          list(set(segments) - set(needed)))
+        # nowhere to load them from
+        self.assertEquals(loaded.fingerprints, {})
+        self.assertRaises(manifest.ManifestParseError, loaded.dumps)
+        loaded._fetch_segment = segments.__getitem__
+        self.assertEquals(loaded.fingerprints, {self._hash(70): 'a' * 10})
+        self.assertEquals(loaded.dumps(), m.dumps())
+
+    def test_save_deferred_fingerprints(self):
+        c = memory.Connection()
+        c.put_container('vol1')
+        scratch = mkdtemp()
+        lock_file = os.path.join(scratch, 'manifest')
+        gets = []
+        get_object = c.get_object
+
+        def counting_get(container, name, **kwargs):
+            gets.append(name)
+            return get_object(container, name, **kwargs)
+        c.get_object = counting_get
+
+        try:
+            m = self._manifest()
+            m.set_fingerprints({self._hash(70): 'a' * 10})
+            manifest.save_manifest(m, c, 'vol1', lock_file)
+            shutil.rmtree(lock_file + '.d')
+            loaded = manifest.load_manifest(c, 'vol1', lock_file)
+            self.assertEquals(len(gets), 4)
+            # the fingerprints are still in swift after saving without them
+            manifest.save_manifest(loaded, c, 'vol1', lock_file)
+            self.assertEquals(loaded.segments, m.segments)
+            self.assertEquals(len(c.get_container(
+                'vol1', prefix=manifest.SEGMENT_PREFIX)[1]), 4)
+            self.assertEquals(loaded.fingerprints, {self._hash(70): 'a' * 10})
+            self.assertEquals(len(gets), 5)
+            self.assertEquals(
+                manifest.read_local_manifest(lock_file).fingerprints,
+                loaded.fingerprints)
+        finally:
+            shutil.rmtree(scratch)
+
+    def test_save_segments(self):
+        c = memory.Connection()
+        c.put_container('vol1')
+        scratch = mkdtemp()
+        lock_file = os.path.join(scratch, 'manifest')
+
+        def segments():
+            _headers, listing = c.get_container(
+                'vol1', prefix=manifest.SEGMENT_PREFIX)
+            return set(o['name'] for o in listing)
+
+        puts = []
+        put_object = c.put_object
+
+        def counting_put(container, name, body, **kwargs):
+            if name.startswith(manifest.SEGMENT_PREFIX):
+                puts.append(name)
+            return put_object(container, name, body, **kwargs)
+        c.put_object = counting_put
+
+        try:
+            m = self._manifest()
+            manifest.save_manifest(m, c, 'vol1', lock_file)
+            self.assertEquals(len(puts), 3)
+            self.assertEquals(segments(), m.segments)
+            # another backup only uploads its own diff
+            del puts[:]
+            m.create_backup('id3')[0] = self._hash(80)
+            manifest.save_manifest(m, c, 'vol1', lock_file)
+            self.assertEquals(len(puts), 1)
+            self.assertEquals(len(m.segments), 4)
+            # a prune rewrites the base, the old one is deleted
+            del puts[:]
+            old = m.segments
+            m.delete_backup('id0')
+            manifest.save_manifest(m, c, 'vol1', lock_file)
+            self.assertEquals(len(puts), 1)
+            self.assertEquals(segments(), m.segments)
+            self.assertEquals(len(old - m.segments), 2)
+            # loaded from the local copies, then from swift without them
+            del puts[:]
+            loaded = manifest.load_manifest(c, 'vol1', lock_file)
+            manifest.release_lock(lock_file)
+            self.assertEquals(loaded, m)
+            self.assertEquals(loaded.segments, m.segments)
+            shutil.rmtree(lock_file + '.d')
+            loaded = manifest.load_manifest(c, 'vol1', lock_file)
+            manifest.release_lock(lock_file)
+            self.assertEquals(loaded, m)
+            self.assertEquals(sorted(os.listdir(lock_file + '.d')),
+                              sorted(m.segments))
+            self.assertEquals(manifest.read_local_manifest(lock_file), m)
+            self.assertEquals(manifest.fetch_manifest(c, 'vol1'), m)
+            c.delete_object('vol1', sorted(m.segments)[0])
+            self.assertRaises(manifest.ManifestParseError,
+                              manifest.fetch_manifest, c, 'vol1')
+            manifest.delete_manifest(c, 'vol1', lock_file)
+            self.assertEquals(c.get_container('vol1')[1], [])
+            self.assertFalse(os.path.exists(lock_file + '.d'))
+        finally:
+            shutil.rmtree(scratch)
+
 
 if __name__ == "__main__":
     unittest.main()
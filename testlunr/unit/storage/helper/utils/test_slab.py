@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright (c) 2011-2016 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import multiprocessing
+import Queue
+
+from lunr.storage.helper.utils.slab import SlabPool
+
+
+class TestSlabPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SlabPool(2, 4096)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_bounded(self):
+        self.assertEquals(self.pool.size, 8192)
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertNotEquals(first, second)
+        self.assertRaises(Queue.Empty, self.pool.acquire, timeout=0.01)
+        self.pool.release(first)
+        self.assertEquals(self.pool.acquire(timeout=1), first)
+
+    def test_write_and_zero(self):
+        slab = self.pool.acquire()
+        self.assertEquals(self.pool.write(slab, 'abc'), 3)
+        self.assertEquals(str(self.pool.buffer(slab)), 'abc')
+        self.pool.zero(slab, 16)
+        self.assertEquals(str(self.pool.buffer(slab)), '\x00' * 16)
+
+    def test_patch_and_truncate(self):
+        slab = self.pool.acquire()
+        self.pool.write(slab, 'abcdef')
+        self.pool.patch(slab, 2, 'XY')
+        self.assertEquals(str(self.pool.buffer(slab)), 'abXYef')
+        self.pool.truncate(slab, 3)
+        self.assertEquals(str(self.pool.buffer(slab)), 'abX')
+
+    def test_aligned(self):
+        for slab in xrange(self.pool.count):
+            self.assertEquals(self.pool.address(slab) % 4096, 0)
+
+    def test_shared_with_child(self):
+        slab = self.pool.acquire()
+
+        def fill():
+            self.pool.write(slab, 'from the child')
+
+        child = multiprocessing.Process(target=fill)
+        child.start()
+        child.join()
+        self.assertEquals(str(self.pool.buffer(slab)), 'from the child')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -39,7 +39,7 @@ class MockPopen(object):
 class TestUtils(unittest.TestCase):
 
     def test_make_api_request_defaults(self):
-        def mock_urlopen(req, data=None):
+        def mock_urlopen(req, data=None, timeout=None):
             expected = 'http://localhost:8080/v1.0/admin/nodes'
             self.assertEquals(req.get_full_url(), expected)
             mock_urlopen.called = True
@@ -48,7 +48,7 @@ class TestUtils(unittest.TestCase):
         self.assert_(mock_urlopen.called)
 
     def test_make_api_request_raise(self):
-        def mock_urlopen(req, data=None):
+        def mock_urlopen(req, data=None, timeout=None):
             raise HTTPError(req.get_full_url(), 404, 'Not Found',
                             {}, StringIO('{"reason": "not found"}'))
         with patch(utils, 'urlopen', mock_urlopen):
@@ -130,7 +130,7 @@ class TestUtils(unittest.TestCase):
         volume_name = 'volume_name'
         cinder_host = 'node_cinder_host'
 
-        def mock_urlopen(req, data=None):
+        def mock_urlopen(req, data=None, timeout=None):
             expected = 'http://localhost:8080/v1.0/admin/volumes/v1'
             self.assertEquals(req.get_full_url(), expected)
             mock_urlopen.called = True
@@ -17,18 +17,45 @@
 import unittest
 import multiprocessing
 import os
+import threading
 from tempfile import mkdtemp
 from shutil import rmtree
-from time import sleep
+from time import sleep, time
 import json
+import hashlib
+
+import lz4
 
 from lunr.common.config import LunrConfig
 from lunr.common.lock import JsonLockFile
 from lunr.storage.helper.utils import get_conn
+from lunr.storage.helper.utils import blockhash, compression
+from lunr.storage.helper.utils.client import swift
 from lunr.storage.helper.utils.client.memory import ClientException, reset
-from lunr.storage.helper.utils.manifest import Manifest, save_manifest
+from lunr.storage.helper.utils.checkpoint import SaveCheckpoint
+from lunr.storage.helper.utils.domain import DedupDomain, SAVING
+from lunr.storage.helper.utils.manifest import Manifest, save_manifest, \
+    fetch_manifest, SEGMENT_PREFIX
+from lunr.storage.helper.utils.slab import SlabPool
 from lunr.storage.helper.utils.worker import Worker, SaveProcess,\
-    StatsSaveProcess, RestoreProcess, StatsRestoreProcess, Block
+    StatsSaveProcess, RestoreProcess, StatsRestoreProcess, Block, Deleter, \
+    prefetch_listing, AsyncSaveProcess, SaveFailedInvalidCow
+from testlunr.unit import patch
+from testlunr.unit.storage.helper.utils.client.test_evented import Server, \
+    Handler
+
+
+class MockBlake2b(object):
+    """
+    Stands in for pyblake2.blake2b, which may not be installed.
+    """
+    def __init__(self, data, digest_size, key):
+        self.hasher = hashlib.sha1(key)
+        self.hasher.update(data)
+        self.digest_size = digest_size
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()[:self.digest_size * 2]
 
 
 class MockCinder(object):
@@ -166,14 +193,16 @@ class TestSaveProcess(unittest.TestCase):
                     })
         self.conn = get_conn(self.conf)
         self.conn.put_container(self.volume_id)
+        self.pool = SlabPool(3, 4 * 1024 ** 2)
         self.process = SaveProcess(self.conf, self.volume_id,
                                    self.block_queue, self.result_queue,
-                                   self.stat_queue)
+                                   self.stat_queue, self.pool)
         self.process.start()
 
     def tearDown(self):
         rmtree(self.scratch)
         self.assertFalse(self.process.is_alive())
+        self.pool.close()
 
     def test_upload(self):
         dev = '/dev/zero'
@@ -181,12 +210,12 @@ class TestSaveProcess(unittest.TestCase):
 
         block_count = 3
         for i in xrange(block_count):
-            block = Block(dev, i, salt)
-            # Lie about the hash.
+            slab = self.pool.acquire()
+            block = Block(dev, i, salt, pool=self.pool, slab=slab)
             block._hydrate()
+            # Lie about the hash.
             hash_ = "hash_%s" % i
-            block._hash = hash_
-            self.block_queue.put(block)
+            self.block_queue.put((i, hash_, slab, None))
 
         self.block_queue.put(None)
         while self.process.is_alive():
@@ -197,6 +226,68 @@ class TestSaveProcess(unittest.TestCase):
         self.assertEquals(len(errors.keys()), 0)
         headers, listing = self.conn.get_container(self.volume_id)
         self.assertEquals(len(listing), block_count)
+        # every slab went back to the pool
+        for i in xrange(self.pool.count):
+            self.pool.acquire(timeout=1)
+
+
+class TestAsyncSaveProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.objects = {}
+        self.server.requests = 0
+        self.server.tokens = set()
+        self.server.rejected = set()
+        self.server.failures = [503]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.block_queue = multiprocessing.JoinableQueue()
+        self.result_queue = multiprocessing.Queue()
+        self.stat_queue = multiprocessing.Queue()
+        self.scratch = mkdtemp()
+        conf = LunrConfig({'backup': {'client': 'swift'},
+                           'storage': {'run_dir': self.scratch}})
+        self.pool = SlabPool(4, 4 * 1024 ** 2)
+        self.process = AsyncSaveProcess(conf, 'vol1', self.block_queue,
+                                        self.result_queue, self.stat_queue,
+                                        self.pool, in_flight=2)
+        url = 'http://127.0.0.1:%s/v1/acct' % self.server.server_port
+        self.process.conn = swift.Connection(
+            'http://auth', 'user', 'key', 'USA', preauthurl=url,
+            preauthtoken='token', starting_backoff=0)
+        self.process.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.scratch)
+        self.assertFalse(self.process.is_alive())
+        self.pool.close()
+
+    def test_upload(self):
+        block_count = 6
+        for i in xrange(block_count):
+            slab = self.pool.acquire()
+            block = Block('/dev/zero', i, 'salt', pool=self.pool, slab=slab)
+            block._hydrate()
+            self.block_queue.put((i, 'hash_%s' % i, slab, None))
+        self.block_queue.put(None)
+        self.block_queue.join()
+
+        stats, errors = self.result_queue.get()
+        self.assertEquals(stats['uploaded'], block_count)
+        self.assertEquals(dict(errors), {})
+        # two connections carried all of them, one upload went twice
+        self.assertEquals(stats['http_handshakes'], 2)
+        self.assertEquals(stats['http_reused'], block_count - 1)
+        self.assertEquals(sorted(self.server.objects),
+                          ['hash_%s' % i for i in xrange(block_count)])
+        self.process.join()
+        for i in xrange(self.pool.count):
+            self.pool.acquire(timeout=1)
 
 
 class TestWorker(unittest.TestCase):
@@ -220,6 +311,20 @@ class TestWorker(unittest.TestCase):
         self.assert_(worker1.empty_block_hash != worker2.empty_block_hash)
         self.assertEquals(worker1.empty_block, worker2.empty_block)
 
+    def test_async_uploads(self):
+        conf = LunrConfig({'backup': {'client': 'memory',
+                                      'async_uploads': 32}})
+        worker = Worker('vol1', conf, Manifest())
+        # only swift connections can be driven from an event loop
+        self.assertEquals(worker.async_uploads, 0)
+        self.assertEquals(worker.num_workers, 10)
+        conf = LunrConfig({'backup': {'client': 'swift',
+                                      'async_uploads': 32},
+                           'storage': {'run_dir': self.scratch}})
+        worker = Worker('vol1', conf, Manifest())
+        self.assertEquals(worker.async_uploads, 32)
+        self.assertEquals(worker.num_workers, 1)
+
     def test_delete_with_missing_blocks(self):
         stats_path = os.path.join(self.scratch, 'stats')
         manifest = Manifest.blank(2)
@@ -248,6 +353,7 @@ class TestWorker(unittest.TestCase):
 
     def test_audit(self):
         manifest = Manifest.blank(2)
+        manifest.upgrade()
         worker = Worker('foo',
                         LunrConfig({
                             'backup': {'client': 'memory'},
@@ -267,14 +373,253 @@ class TestWorker(unittest.TestCase):
         conn.put_object('foo', 'stuff2', 'unreferenced stuff2')
         conn.put_object('foo', 'stuff3', 'unreferenced stuff3')
 
+        # A segment left behind by a save that died.
+        conn.put_object('foo', SEGMENT_PREFIX + 'stale', 'stale')
+
         _headers, original_list = conn.get_container('foo')
-        # Manifest, 2 blocks, 3 stuffs.
-        self.assertEquals(len(original_list), 6)
+        # Manifest, its segment, 2 blocks, 3 stuffs, stale segment.
+        self.assertEquals(len(original_list), 8)
 
         worker.audit()
         _headers, new_list = conn.get_container('foo')
-        # Manifest, 2 blocks.
-        self.assertEquals(len(new_list), 3)
+        # Manifest, its segment, 2 blocks.
+        self.assertEquals(len(new_list), 4)
+        self.assertEquals(fetch_manifest(conn, 'foo').replay(), backup)
+
+    def test_delete_collects(self):
+        manifest = Manifest.blank(2)
+        worker = Worker('foo',
+                        LunrConfig({
+                            'backup': {'client': 'memory'},
+                            'storage': {'run_dir': self.scratch}
+                        }),
+                        manifest=manifest)
+        conn = worker.conn
+        conn.put_container('foo')
+        backup = manifest.create_backup('bak1', timestamp=1)
+        backup[0], backup[1] = 'block1', 'block2'
+        backup = manifest.create_backup('bak2', timestamp=2)
+        backup[1] = 'block3'
+        save_manifest(manifest, conn, worker.id, worker._lock_path())
+        for name in ('block1', 'block2', 'block3', 'gone', 'stuff'):
+            conn.put_object('foo', name, name)
+
+        def names():
+            _headers, listing = conn.get_container('foo')
+            return [o['name'] for o in listing
+                    if not o['name'].startswith(SEGMENT_PREFIX)]
+
+        # a prune that died after the journal was written, but before the
+        # manifest without block1 was saved
+        worker.journal.add('foo', ['block1', 'gone'], 1.5)
+        worker.collect()
+        self.assertEquals(names(), ['block1', 'block2', 'block3', 'manifest',
+                                    'stuff'])
+        self.assertEquals(worker.journal.batches(), [])
+        worker.delete('bak1')
+        self.assertEquals(names(), ['block1', 'block3', 'manifest', 'stuff'])
+        worker.delete('bak2')
+        # the manifest's segments went with it
+        self.assertEquals(conn.get_container('foo')[1], [{'name': 'stuff'}])
+        # the first audit lists everything, later ones wait a while
+        worker.audit()
+        self.assertEquals(names(), [])
+        conn.put_object('foo', 'stuff', 'stuff')
+        worker.audit()
+        self.assertEquals(names(), ['stuff'])
+        worker.audit(sweep=True)
+        self.assertEquals(names(), [])
+
+    def test_audit_domain(self):
+        manifest = Manifest.blank(2)
+        manifest['domain'] = 'dedup'
+        worker = Worker('foo',
+                        LunrConfig({
+                            'backup': {'client': 'memory'},
+                            'storage': {'run_dir': self.scratch}
+                        }),
+                        manifest=manifest)
+        conn = worker.conn
+        conn.put_container('foo')
+        conn.put_container('dedup')
+        backup = manifest.create_backup('bak1')
+        backup[0] = 'block1'
+        backup[1] = 'block2'
+        save_manifest(manifest, conn, worker.id, worker._lock_path())
+        worker.domain.join('foo')
+        # another volume in the domain
+        conn.put_container('bar')
+        other = Manifest.blank(1)
+        other['domain'] = 'dedup'
+        other.create_backup('bak2')[0] = 'block3'
+        conn.put_object('bar', 'manifest', other.dumps())
+        worker.domain.join('bar')
+        for name in ('block1', 'block2', 'block3', 'stuff1'):
+            conn.put_object('dedup', name, name)
+        worker.domain.start_save('baz')
+        self.assertFalse(worker.audit())
+        worker.domain.finish_save('baz')
+        # another member is auditing the domain
+        other = DedupDomain(conn, 'dedup')
+        other.start_audit('bar')
+        self.assertFalse(worker.audit())
+        other.finish_audit('bar')
+        self.assert_(worker.audit())
+        _headers, listing = conn.get_container('dedup')
+        # baz joined when its save started
+        self.assertEquals([o['name'] for o in listing],
+                          ['block1', 'block2', 'block3', 'domain.member.bar',
+                           'domain.member.baz', 'domain.member.foo',
+                           'domain.swept'])
+        # the sweep covers every member until it's due again
+        conn.put_object('dedup', 'stuff2', 'stuff2')
+        manifest = Manifest.blank(1)
+        manifest['domain'] = 'dedup'
+        member = Worker('bar', worker.conf, manifest=manifest)
+        self.assert_(member.audit())
+        self.assert_('stuff2' in [o['name'] for o in
+                                  conn.get_container('dedup')[1]])
+
+    def test_save_domain_fails(self):
+        manifest = Manifest.blank(1)
+        manifest['domain'] = 'dedup'
+        worker = Worker('foo',
+                        LunrConfig({
+                            'backup': {'client': 'memory'},
+                            'storage': {'run_dir': self.scratch}
+                        }),
+                        manifest=manifest)
+        worker.conn.put_container('foo')
+        worker.conn.put_container('dedup')
+        # joined while the first save was in progress
+        self.assertRaises(SaveFailedInvalidCow, worker.save,
+                          os.path.join(self.scratch, 'missing'), 'bak1',
+                          timestamp=1)
+        self.assertEquals(worker.domain.members(), [])
+        self.assertEquals(worker.domain.saving(), [])
+
+    def test_audit_domain_save_starts(self):
+        manifest = Manifest.blank(2)
+        manifest['domain'] = 'dedup'
+        worker = Worker('foo',
+                        LunrConfig({
+                            'backup': {'client': 'memory'},
+                            'storage': {'run_dir': self.scratch}
+                        }),
+                        manifest=manifest)
+        conn = worker.conn
+        conn.put_container('foo')
+        conn.put_container('dedup')
+        manifest.create_backup('bak1')[0] = 'block1'
+        save_manifest(manifest, conn, worker.id, worker._lock_path())
+        worker.domain.join('foo')
+        for name in ('block1', 'block2', 'block3'):
+            conn.put_object('dedup', name, name)
+        # a save which checked for audits just before this one registered
+        saver = DedupDomain(conn, 'dedup')
+        iterblocks = worker._iterblocks
+
+        def interleaved():
+            for name in iterblocks():
+                if not saver.saving():
+                    conn.put_object('dedup', SAVING + 'bar', str(time()))
+                yield name
+        with patch(worker, '_iterblocks', interleaved):
+            self.assertFalse(worker.audit(sweep=True))
+        self.assertEquals([o['name'] for o in conn.get_container('dedup')[1]
+                           if not o['name'].startswith('domain')],
+                          ['block1', 'block2', 'block3'])
+        # and saves which start later wait for the audit
+        self.assertEquals(saver.auditing(), None)
+        saver.finish_save('bar')
+        self.assert_(worker.audit(sweep=True))
+        self.assertEquals([o['name'] for o in conn.get_container('dedup')[1]
+                           if not o['name'].startswith('domain')],
+                          ['block1'])
+
+    def test_audit_deletes(self):
+        stats_path = os.path.join(self.scratch, 'statsfile')
+        for bulk, workers, prefetch in ((True, 4, 2), (False, 4, 0),
+                                        (False, 0, 1)):
+            manifest = Manifest.blank(1)
+            conf = LunrConfig({
+                'backup': {'client': 'memory',
+                           'audit_bulk_delete': bulk,
+                           'audit_workers': workers,
+                           'audit_listing_prefetch': prefetch},
+                'storage': {'run_dir': self.scratch,
+                            'stats_update_interval': 10},
+            })
+            worker = Worker('foo', conf, manifest=manifest,
+                            stats_path=stats_path)
+            self.assertEquals(worker._bulk_size(), 1000 if bulk else 0)
+            conn = worker.conn
+            conn.put_container('foo')
+            manifest.create_backup('bak1')[0] = 'block0'
+            save_manifest(manifest, conn, worker.id, worker._lock_path())
+            for i in range(50):
+                conn.put_object('foo', 'block%s' % i, 'block')
+            worker.audit(sweep=True)
+            _headers, listing = conn.get_container('foo')
+            self.assertEquals(
+                [o['name'] for o in listing
+                 if not o['name'].startswith('manifest')], ['block0'])
+            with JsonLockFile(stats_path) as lock:
+                stats = lock.read()
+            self.assertEquals(stats['blocks_listed'], 50)
+            self.assertEquals(stats['blocks_deleted'], 49)
+            self.assertEquals(stats['progress'], 100.0)
+            self.assert_(stats['delete_rate'] > 0)
+            reset()
+
+    def test_deleter_errors(self):
+        conf = LunrConfig({'backup': {'client': 'memory'}})
+        conn = get_conn(conf)
+        conn.put_container('foo')
+        for name in ('block1', 'block2'):
+            conn.put_object('foo', name, name)
+        for size, bulk_size in ((0, 0), (2, 0), (2, 10)):
+            deleter = Deleter(conf, size, bulk_size=bulk_size)
+            for name in ('block1', 'block2', 'gone'):
+                deleter.delete('foo', name, 1)
+            deleter.finish()
+            self.assertEquals(deleter.deleted, 2)
+            self.assertEquals(deleter.not_found, 1)
+            self.assertEquals(conn.get_container('foo')[1], [])
+            conn.put_object('foo', 'block1', 'block1')
+            conn.put_object('foo', 'block2', 'block2')
+
+        def delete_object(container, name, **kwargs):
+            raise ClientException('Server Error', 500)
+        with patch(conn, 'delete_object', delete_object):
+            # deleting inline raises straight away
+            deleter = Deleter(conf, 0)
+            self.assertRaises(ClientException, deleter.delete, 'foo',
+                              'block1', 1)
+            # the threads' first error comes out of finish
+            deleter = Deleter(conf, 2)
+            deleter.delete('foo', 'block1', 1)
+            self.assertRaises(ClientException, deleter.finish)
+
+    def test_prefetch_listing(self):
+        conf = LunrConfig({'backup': {'client': 'memory'}})
+        conn = get_conn(conf)
+        conn.put_container('foo')
+        names = ['block%02d' % i for i in range(20)]
+        for name in names:
+            conn.put_object('foo', name, name)
+        for depth in (0, 1, 3):
+            self.assertEquals(list(prefetch_listing(conf, 'foo', depth)),
+                              names)
+            self.assertEquals(
+                list(prefetch_listing(conf, 'foo', depth, prefix='block1')),
+                names[10:])
+            # stopping early leaves nothing behind
+            listing = prefetch_listing(conf, 'foo', depth)
+            self.assertEquals(listing.next(), names[0])
+            listing.close()
+            listing = prefetch_listing(conf, 'bar', depth)
+            self.assertRaises(ClientException, list, listing)
 
     def test_save_stats(self):
         manifest = Manifest.blank(2)
@@ -297,6 +642,554 @@ class TestWorker(unittest.TestCase):
         except ValueError:
             self.fail("stats path does not contain valid json")
 
+    def test_save_parallel_readers(self):
+        block_size = 4 * 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write('\x00' * block_size)
+            f.write('a' * block_size)
+            f.write('b' * block_size)
+            f.write('c' * 1024)
+        manifest = Manifest.blank(5)
+        conf = LunrConfig({
+            'backup': {'client': 'disk', 'read_workers': 2,
+                       'readahead_blocks': 1},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=manifest)
+        worker.conn.put_container('foo')
+
+        worker.save(path, 'backup_id', timestamp=1)
+
+        expected = [Block(path, i, manifest.salt).hash for i in xrange(5)]
+        self.assertEquals(manifest.replay(), expected)
+        self.assertEquals(expected[1], worker.empty_block_hash)
+        _headers, listing = worker.conn.get_container('foo')
+        # manifest, 'a', 'b' and 'c'
+        self.assertEquals(len(listing), 4)
+
+    def test_save_changed_blocks(self):
+        block_size = 4 * 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size * 4)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        manifest = Manifest.blank(4)
+        worker = Worker('foo', conf, manifest=manifest)
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup1', timestamp=1)
+
+        with open(path, 'r+') as f:
+            f.seek(block_size)
+            f.write('b' * block_size)
+            f.write('c' * block_size)
+        # only the chunk at the start of block 2 was tracked
+        changes = {'timestamp': 1, 'chunk_size': 4096,
+                   'chunks': [2 * block_size / 4096]}
+        worker = Worker('foo', conf)
+        worker.save(path, 'backup2', timestamp=2, changes=changes)
+        diff = worker.manifest[2.0]
+        self.assertEquals(diff.keys(), [2])
+        self.assertEquals(diff[2], Block(path, 2, manifest.salt).hash)
+
+        # a tracker from some other backup forces a full scan
+        changes['timestamp'] = 1
+        worker = Worker('foo', conf)
+        worker.save(path, 'backup3', timestamp=3, changes=changes)
+        diff = worker.manifest[3.0]
+        self.assertEquals(sorted(diff.keys()), [0, 1, 2, 3])
+        self.assertEquals(diff[1], Block(path, 1, manifest.salt).hash)
+
+        # nothing written since the last backup
+        changes = {'timestamp': 3, 'chunk_size': 4096, 'chunks': []}
+        worker = Worker('foo', conf)
+        worker.save(path, 'backup4', timestamp=4, changes=changes)
+        self.assertEquals(worker.manifest[4.0], {})
+
+    def test_save_resume(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size * 4)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        manifest = Manifest.blank(4, block_size)
+        worker = Worker('foo', conf, manifest=manifest)
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup1', timestamp=1)
+        self.assertFalse(os.path.exists(worker._checkpoint_path()))
+
+        with open(path, 'r+') as f:
+            f.seek(block_size)
+            f.write('b' * block_size)
+            f.write('c' * block_size)
+            f.write('d' * block_size)
+        hashes = [Block(path, i, manifest.salt, block_size=block_size).hash
+                  for i in xrange(4)]
+        # a save of backup2 was killed after block 1 and the upload of
+        # block 3 were stored
+        worker = Worker('foo', conf)
+        key = {
+            'backup_id': 'backup2',
+            'block_dev': path,
+            'history': [1.0, 2.0],
+            'block_size': block_size,
+            'hash_algorithm': worker.manifest.hash_algorithm,
+        }
+        checkpoint = SaveCheckpoint(worker._checkpoint_path(), key)
+        checkpoint.read(0, hashes[0], False, False)
+        checkpoint.read(1, hashes[1], True, True)
+        checkpoint.read(2, hashes[2], True, True)
+        checkpoint.read(3, hashes[3], True, True)
+        checkpoint.stored(1)
+        checkpoint.stored(3)
+        self.assertEquals(checkpoint.watermark, 1)
+        checkpoint.write({})
+        worker.conn.put_object('foo', hashes[1], 'b')
+        worker.conn.put_object('foo', hashes[3], 'd')
+        # nothing a dead save uploaded is collected
+        worker.audit()
+        _headers, listing = worker.conn.get_container('foo')
+        names = set(o['name'] for o in listing)
+        self.assert_(set([hashes[1], hashes[3]]) <= names)
+
+        worker.save(path, 'backup2', timestamp=2)
+        self.assertEquals(worker.manifest[2.0],
+                          {0: hashes[0], 1: hashes[1], 2: hashes[2],
+                           3: hashes[3]})
+        self.assertFalse(os.path.exists(worker._checkpoint_path()))
+        # only block 2 was uploaded again
+        _headers, body = worker.conn.get_object('foo', hashes[1])
+        self.assertEquals(body, 'b')
+        _headers, body = worker.conn.get_object('foo', hashes[3])
+        self.assertEquals(body, 'd')
+        _headers, body = worker.conn.get_object('foo', hashes[2])
+        self.assertEquals(compression.decompress(body), 'c' * block_size)
+
+        # a checkpoint from some other save is ignored
+        checkpoint.write({})
+        worker = Worker('foo', conf)
+        worker.save(path, 'backup3', timestamp=3)
+        self.assertEquals(len(worker.manifest[3.0]), 4)
+        self.assertFalse(os.path.exists(worker._checkpoint_path()))
+
+    def test_restore(self):
+        block_size = 4 * 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write('\x00' * block_size)
+            f.write('b' * block_size)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=Manifest.blank(3))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup_id', timestamp=1)
+
+        dest = os.path.join(self.scratch, 'dest')
+        with open(dest, 'w') as f:
+            f.write('x' * 3 * block_size)
+        worker = Worker('foo', conf)
+        worker.restore('backup_id', dest)
+        with open(path) as f:
+            expected = f.read()
+        with open(dest) as f:
+            self.assertEquals(f.read(), expected)
+
+    def test_restore_duplicate_blocks(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            for c in 'a\x00ab\x00a':
+                f.write(c * block_size)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=Manifest.blank(6, block_size))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup_id', timestamp=1)
+
+        worker = Worker('foo', conf)
+        backup = worker.manifest.get_backup('backup_id')
+        empty = worker.empty_block_hash
+        # each stored block is fetched once, empty ones are never fetched
+        self.assertEquals(worker._restore_plan(backup), [
+            [([0, 2, 5], backup[0])],
+            [([1], empty)],
+            [([3], backup[3])],
+            [([4], empty)],
+        ])
+
+        dest = os.path.join(self.scratch, 'dest')
+        with open(dest, 'w') as f:
+            f.write('x' * 6 * block_size)
+        worker.restore('backup_id', dest)
+        with open(path) as f:
+            expected = f.read()
+        with open(dest) as f:
+            self.assertEquals(f.read(), expected)
+
+    def test_restore_runs(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            for c in 'abcd\x00efghij':
+                f.write(c * block_size)
+            # a short block at the end
+            f.write('k' * 4096)
+        conf = LunrConfig({
+            'backup': {'client': 'disk', 'restore_run_blocks': 3},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=Manifest.blank(12, block_size))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup_id', timestamp=1)
+
+        worker = Worker('foo', conf)
+        backup = worker.manifest.get_backup('backup_id')
+        plan = [[blocknos for blocknos, hash_ in run]
+                for run in worker._restore_plan(backup)]
+        self.assertEquals(plan, [[[0], [1], [2]], [[3]], [[4]],
+                                 [[5], [6], [7]], [[8], [9], [10]], [[11]]])
+
+        dest = os.path.join(self.scratch, 'dest')
+        with open(dest, 'w') as f:
+            f.write('x' * (11 * block_size + 4096))
+        worker.restore('backup_id', dest)
+        with open(path) as f:
+            expected = f.read()
+        with open(dest) as f:
+            self.assertEquals(f.read(), expected)
+
+    def test_restore_zeroed(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write('\x00' * block_size)
+            f.write('b' * block_size)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=Manifest.blank(3, block_size))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup_id', timestamp=1)
+
+        dest = os.path.join(self.scratch, 'dest')
+        with open(dest, 'w') as f:
+            f.write('x' * 3 * block_size)
+        # trusted to be zeroed, so the empty block isn't written
+        worker = Worker('foo', conf)
+        worker.restore('backup_id', dest, zeroed=True)
+        with open(dest) as f:
+            self.assertEquals(f.read(), 'a' * block_size +
+                              'x' * block_size + 'b' * block_size)
+        # a file can't do BLKZEROOUT, so zeros are written
+        worker = Worker('foo', conf)
+        worker.restore('backup_id', dest)
+        with open(path) as f:
+            expected = f.read()
+        with open(dest) as f:
+            self.assertEquals(f.read(), expected)
+
+    def test_restore_prefetch(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            for c in 'abcdefgh':
+                f.write(c * block_size)
+        for prefetch in (0, 2):
+            conf = LunrConfig({
+                'backup': {'client': 'disk', 'restore_prefetch': prefetch,
+                           'restore_run_blocks': 1, 'restore_workers': 1,
+                           'codec': 'zlib'},
+                'disk': {'path': os.path.join(self.scratch, 'backups')},
+                'storage': {'run_dir': self.scratch},
+            })
+            worker = Worker('foo', conf,
+                            manifest=Manifest.blank(8, block_size))
+            worker.conn.put_container('foo')
+            worker.save(path, 'backup_id', timestamp=1)
+
+            dest = os.path.join(self.scratch, 'dest')
+            with open(dest, 'w') as f:
+                f.write('x' * 8 * block_size)
+            worker = Worker('foo', conf)
+            worker.restore('backup_id', dest)
+            with open(path) as f:
+                expected = f.read()
+            with open(dest) as f:
+                self.assertEquals(f.read(), expected)
+
+    def test_save_restore_deltas(self):
+        block_size = 1024 ** 2
+        sub_chunk_size = 64 * 1024
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write('b' * block_size)
+        conf = {
+            'backup': {'client': 'disk', 'delta_chunk_size': sub_chunk_size,
+                       'delta_max_chain': 2},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        }
+        # json manifests would carry every fingerprint
+        worker = Worker('foo', LunrConfig(conf),
+                        manifest=Manifest.blank(2, block_size))
+        self.assertEquals(worker.delta_chunk_size, 0)
+        conf['backup']['upgrade_manifest'] = 'true'
+        conf = LunrConfig(conf)
+        worker = Worker('foo', conf, manifest=Manifest.blank(2, block_size))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup1', timestamp=1)
+        contents = {}
+        with open(path) as f:
+            contents['backup1'] = f.read()
+
+        def write(offset, data):
+            with open(path, 'r+') as f:
+                f.seek(offset)
+                f.write(data)
+
+        # a small write in the second block
+        write(block_size + 3 * sub_chunk_size, 'c' * 4096)
+        worker = Worker('foo', conf)
+        worker.save(path, 'backup2', timestamp=2)
+        with open(path) as f:
+            contents['backup2'] = f.read()
+        new_hash = worker.manifest[2.0][1]
+        self.assertEquals(worker.manifest.deltas,
+                          {new_hash: worker.manifest.base[1]})
+        _headers, body = worker.conn.get_object('foo', new_hash)
+        self.assert_(len(body) < sub_chunk_size)
+
+        # the chain grows until it hits the cap, then the block is re-based
+        for ts in (3, 4):
+            write(block_size + ts * sub_chunk_size, 'd' * 4096)
+            worker = Worker('foo', conf)
+            worker.save(path, 'backup%d' % ts, timestamp=ts)
+            with open(path) as f:
+                contents['backup%d' % ts] = f.read()
+        head = worker.manifest.replay()
+        self.assertEquals(worker.manifest.delta_depth(head[1]), 0)
+        self.assertEquals(len(worker.manifest.deltas), 2)
+
+        # too many sub chunks changed for a delta
+        write(0, 'e' * (block_size / 2))
+        worker = Worker('foo', conf)
+        worker.save(path, 'backup5', timestamp=5)
+        with open(path) as f:
+            contents['backup5'] = f.read()
+        self.assertFalse(worker.manifest[5.0][0] in worker.manifest.deltas)
+
+        dest = os.path.join(self.scratch, 'dest')
+        for backup_id, expected in contents.items():
+            with open(dest, 'w') as f:
+                f.write('x' * 2 * block_size)
+            worker = Worker('foo', conf)
+            worker.restore(backup_id, dest)
+            with open(dest) as f:
+                self.assertEquals(f.read(), expected)
+
+        # parents outlive the backups that referenced them
+        worker = Worker('foo', conf)
+        worker.delete('backup1')
+        worker.delete('backup2')
+        self.assertEquals(len(worker.manifest.deltas), 2)
+        worker = Worker('foo', conf)
+        worker.restore('backup3', dest)
+        with open(dest) as f:
+            self.assertEquals(f.read(), contents['backup3'])
+        worker = Worker('foo', conf)
+        worker.delete('backup3')
+        self.assertEquals(worker.manifest.deltas, {})
+        worker.audit()
+        _headers, listing = worker.conn.get_container('foo')
+        names = set(o['name'] for o in listing) - set(['manifest']) - \
+            worker.manifest.segments
+        self.assertEquals(names, worker.manifest.block_set)
+        for backup_id in ('backup4', 'backup5'):
+            worker = Worker('foo', conf)
+            worker.restore(backup_id, dest)
+            with open(dest) as f:
+                self.assertEquals(f.read(), contents[backup_id])
+
+    def test_save_upgrade_manifest(self):
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * 65536)
+        conf = {
+            'backup': {'client': 'memory'},
+            'storage': {'run_dir': self.scratch},
+        }
+        worker = Worker('foo', LunrConfig(conf),
+                        manifest=Manifest.blank(1, 65536))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup1', timestamp=1)
+        # older nodes can still read it
+        self.assertEquals(fetch_manifest(worker.conn, 'foo').version, '1.3')
+        conf['backup']['upgrade_manifest'] = 'true'
+        worker = Worker('foo', LunrConfig(conf))
+        worker.save(path, 'backup2', timestamp=2)
+        manifest = fetch_manifest(worker.conn, 'foo')
+        self.assertEquals(manifest.version, '2.0')
+        _headers, listing = worker.conn.get_container(
+            'foo', prefix=SEGMENT_PREFIX)
+        self.assertEquals(set(o['name'] for o in listing), manifest.segments)
+
+    def test_save_restore_block_size(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write('\x00' * block_size)
+            f.write('b' * block_size)
+            f.write('a' * block_size)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=Manifest.blank(4, block_size))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup_id', timestamp=1)
+        _headers, listing = worker.conn.get_container('foo')
+        # manifest, 'a' and 'b'
+        self.assertEquals(len(listing), 3)
+
+        dest = os.path.join(self.scratch, 'dest')
+        with open(dest, 'w') as f:
+            f.write('x' * 4 * block_size)
+        worker = Worker('foo', conf)
+        self.assertEquals(worker.manifest.block_size, block_size)
+        worker.restore('backup_id', dest)
+        with open(path) as f:
+            expected = f.read()
+        with open(dest) as f:
+            self.assertEquals(f.read(), expected)
+
+    def test_save_restore_codecs(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write(os.urandom(block_size))
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        worker = Worker('foo', conf, manifest=Manifest.blank(2, block_size))
+        worker.conn.put_container('foo')
+        worker.save(path, 'backup1', timestamp=1, codec='zlib')
+        codecs = []
+        for hash_ in worker.manifest.replay():
+            _headers, body = worker.conn.get_object('foo', hash_)
+            codecs.append(compression.codec_of(body))
+        self.assertEquals(codecs, ['zlib', 'raw'])
+        # a block stored before codecs were recorded
+        with open(path, 'r+') as f:
+            f.seek(block_size)
+            f.write('c' * block_size)
+        legacy = Block(path, 1, worker.manifest.salt,
+                       block_size=block_size).hash
+        worker.conn.put_object('foo', legacy, lz4.compress('c' * block_size))
+        worker.manifest.create_backup('backup2', timestamp=2)[1] = legacy
+        save_manifest(worker.manifest, worker.conn, worker.id,
+                      worker._lock_path())
+
+        dest = os.path.join(self.scratch, 'dest')
+        with open(dest, 'w') as f:
+            f.write('x' * 2 * block_size)
+        worker = Worker('foo', conf)
+        worker.restore('backup2', dest)
+        with open(path) as f:
+            expected = f.read()
+        with open(dest) as f:
+            self.assertEquals(f.read(), expected)
+
+    def test_save_restore_mixed_hash_algorithms(self):
+        block_size = 1024 ** 2
+        path = os.path.join(self.scratch, 'snapshot')
+        with open(path, 'w') as f:
+            f.write('a' * block_size)
+            f.write('\x00' * block_size)
+        conf = LunrConfig({
+            'backup': {'client': 'disk'},
+            'disk': {'path': os.path.join(self.scratch, 'backups')},
+            'storage': {'run_dir': self.scratch},
+        })
+        orig_blake2b = blockhash.blake2b
+        blockhash.blake2b = MockBlake2b
+        try:
+            worker = Worker('foo', conf,
+                            manifest=Manifest.blank(2, block_size))
+            worker.conn.put_container('foo')
+            worker.save(path, 'backup1', timestamp=1)
+            md5_hashes = worker.manifest.replay()
+
+            worker = Worker('foo', conf)
+            worker.manifest.set_hash_algorithm('blake2b')
+            with open(path, 'r+') as f:
+                f.write('b' * block_size)
+            worker.save(path, 'backup2', timestamp=2)
+            self.assertEquals(worker.manifest.hash_algorithms,
+                              ['md5', 'blake2b'])
+            blake2b_hashes = worker.manifest.replay()
+            self.assertEquals(
+                blake2b_hashes, [Block(path, i, worker.manifest.salt,
+                                       block_size=block_size,
+                                       hash_algorithm='blake2b').hash
+                                 for i in xrange(2)])
+            # the empty block changed name, and neither one was uploaded
+            self.assertNotEquals(md5_hashes[1], blake2b_hashes[1])
+            _headers, listing = worker.conn.get_container('foo')
+            # manifest, 'a' and 'b'
+            self.assertEquals(len(listing), 3)
+
+            dest = os.path.join(self.scratch, 'dest')
+            expected = {'backup1': 'a' * block_size + '\x00' * block_size,
+                        'backup2': 'b' * block_size + '\x00' * block_size}
+            for backup_id in ('backup1', 'backup2'):
+                with open(dest, 'w') as f:
+                    f.write('x' * 2 * block_size)
+                worker = Worker('foo', conf)
+                worker.restore(backup_id, dest)
+                with open(dest) as f:
+                    self.assertEquals(f.read(), expected[backup_id])
+
+            # a node without the volume's algorithm can't back it up or
+            # restore it, rather than uploading every block again
+            blockhash.blake2b = None
+            worker = Worker('foo', conf)
+            self.assertRaises(blockhash.HashAlgorithmError, worker.restore,
+                              'backup2', dest)
+            self.assertRaises(blockhash.HashAlgorithmError, worker.save,
+                              path, 'backup3', timestamp=3)
+            worker = Worker('foo', conf)
+            self.assertEquals(worker.manifest.hash_algorithm, 'blake2b')
+            self.assertEquals(worker.manifest.history, [1, 2])
+        finally:
+            blockhash.blake2b = orig_blake2b
+
 
 if __name__ == "__main__":
     unittest.main()